@@ -2,12 +2,17 @@ import os
 import sys
 import time
 import copy
+import collections
+import threading
+import json
+import hashlib
 import inspect
 import contextlib
 import logging
 import http.client
 
 import mini_buildd.misc
+import mini_buildd.schema
 
 LOG = logging.getLogger(__name__)
 
@@ -25,6 +30,49 @@ def django_pseudo_configure():
     call_command("migrate", interactive=False, run_syncdb=True, verbosity=0)
 
 
+def _msgpack():
+    """Optional: msgpack output needs python3-msgpack."""
+    try:
+        import msgpack
+        return msgpack
+    except ImportError:
+        raise Exception("API: Output 'msgpack' not available (please install python3-msgpack)")
+
+
+# Structured output types: {output: content type}
+STRUCTURED_OUTPUTS = {"json": "application/json",
+                      "msgpack": "application/msgpack"}
+
+
+def _dump(document, output):
+    if output == "msgpack":
+        return _msgpack().packb(document, use_bin_type=True)
+    return json.dumps(document, separators=(",", ":")).encode("UTF-8")
+
+
+def encode(command, output):
+    """
+    Encode structured result of a command (that has been run) to bytes.
+
+    >>> decode(encode(Status({}), "json"), "json").load
+    0.0
+    """
+    return _dump({"command": command.COMMAND,
+                  "version": command.RESULT_VERSION,
+                  "result": command.result()}, output)
+
+
+def decode(data, output):
+    """Decode structured result (bytes) to a command object (does not need django)."""
+    document = _msgpack().unpackb(data, raw=False) if output == "msgpack" else json.loads(data.decode("UTF-8"))
+    cls = COMMANDS_DICT.get(document["command"])
+    if cls is None:
+        raise Exception("API: Unknown command in result: '{c}'".format(c=document["command"]))
+    if document["version"] != cls.RESULT_VERSION:
+        raise Exception("API: '{c}': Unsupported result version {v} (we support {s})".format(c=cls.COMMAND, v=document["version"], s=cls.RESULT_VERSION))
+    return cls.from_result(document["result"])
+
+
 class Argument():
     def __init__(self, id_list, doc="Undocumented", default=None):
         """
@@ -76,6 +124,14 @@ class Argument():
     def false2none(self):
         return self.raw_value if self.raw_value else None
 
+    def schema(self):
+        """Get argument schema (see ``get_schema()``)."""
+        return {"id_list": self.id_list,
+                "type": self.TYPE,
+                "doc": self.doc,
+                "default": self.default,
+                "choices": self.argparse_kvsargs.get("choices", [])}
+
 
 class StringArgument(Argument):
     TYPE = "string"
@@ -153,6 +209,17 @@ class Command():
     NEEDS_RUNNING_DAEMON = False
     ARGUMENTS = []
 
+    # Argument choices (only needed to render forms, see ``update_choices()``): Arguments the choices depend on
+    CHOICES_ARGS = []
+    _CHOICES_CACHE = collections.OrderedDict()
+    _CHOICES_CACHE_MAX = 100
+    _CHOICES_LOCK = threading.Lock()
+
+    # Structured result (json/msgpack output): Attributes (plain python types only; 'plain' is the plain text result)
+    # Increment RESULT_VERSION on incompatible changes.
+    RESULT = ["plain"]
+    RESULT_VERSION = 1
+
     # Used in: migrate, remove, port
     COMMON_ARG_VERSION = StringArgument(["--version", "-V"], default="", doc="""
 limit command to that version. Use it for the rare case of
@@ -203,7 +270,49 @@ auto-ports=buster-test-unstable
         self._update()
 
     def _update(self):
-        pass
+        """Update arguments after they have been given (like setting reasonable defaults)."""
+
+    def _update_choices(self):
+        """Compute argument choices (daemon is available)."""
+
+    def update_choices(self):
+        """
+        Populate argument choices (only needed to render forms).
+
+        Choices are cached per command (and values of ``CHOICES_ARGS``), configuration and daemon state version.
+
+        >>> import types
+        >>> daemon = types.SimpleNamespace(state_generation=mini_buildd.misc.Generation(),
+        ...                                get_config=lambda: types.SimpleNamespace(version=0),
+        ...                                get_active_repositories=lambda: print("Querying repositories") or [types.SimpleNamespace(identity="test")])
+        >>> PrintUploaders({}, daemon=daemon).update_choices()
+        Querying repositories
+        >>> u = PrintUploaders({}, daemon=daemon)
+        >>> u.update_choices()
+        >>> u.args["repository"].choices
+        ['test']
+        >>> _gen = daemon.state_generation.bump()
+        >>> PrintUploaders({}, daemon=daemon).update_choices()
+        Querying repositories
+        """
+        if not self.daemon:
+            return
+
+        version = (self.daemon.get_config().version, self.daemon.state_generation.value)
+        key = (self.COMMAND, tuple(self.args[a].raw_value for a in self.CHOICES_ARGS))
+        with self._CHOICES_LOCK:
+            cached = self._CHOICES_CACHE.get(key)
+        if cached is None or cached[0] != version:
+            self._update_choices()
+            cached = (version, {a.identity: a.choices for a in self.args.values() if isinstance(a, SelectArgument)})
+            with self._CHOICES_LOCK:
+                self._CHOICES_CACHE[key] = cached
+                self._CHOICES_CACHE.move_to_end(key)
+                while len(self._CHOICES_CACHE) > self._CHOICES_CACHE_MAX:
+                    self._CHOICES_CACHE.popitem(last=False)
+
+        for identity, choices in cached[1].items():
+            self.args[identity].choices = list(choices)
 
     def run(self):
         # Sanity checks
@@ -221,7 +330,7 @@ auto-ports=buster-test-unstable
         """
         Workaround so objects of this class can be pickled.
 
-        .. note:: This must be removed eventually. RoadMap: 1.11: API: Fix up result handling, and use json instead of pickle/python to interchange computable data.
+        .. note:: Only needed for the (deprecated) 'python' output; use structured output (see ``encode()``) to interchange computable data.
         """
         pstate = copy.copy(self.__dict__)
         del pstate["msglog"]
@@ -233,6 +342,26 @@ auto-ports=buster-test-unstable
     def __str__(self):
         return self._plain_result
 
+    def etag(self):
+        """Get ETag (changing whenever the result would change), or None if not supported. Checked before running the command."""
+        return None
+
+    @classmethod
+    def _result_attr(cls, key):
+        return "_plain_result" if key == "plain" else key
+
+    def result(self):
+        """Get structured result (dict)."""
+        return {key: getattr(self, self._result_attr(key)) for key in self.RESULT}
+
+    @classmethod
+    def from_result(cls, result):
+        """Get (client side) command object from structured result."""
+        command = cls({})
+        for key in cls.RESULT:
+            setattr(command, cls._result_attr(key), result[key])
+        return command
+
     @classmethod
     def docstring(cls):
         auth_strings = {cls.NONE: "anonymous",
@@ -284,6 +413,7 @@ class Status(DaemonCommand):
     """Show the status of the mini-buildd instance."""
 
     COMMAND = "status"
+    RESULT = ["version", "http", "ftp", "running", "load", "chroots", "repositories", "remotes", "packaging", "building", "plain"]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -299,7 +429,54 @@ class Status(DaemonCommand):
         self.packaging = []
         self.building = []
 
-    def _run(self):
+    # Cached results, shared by all calls (treat as read-only): {part: (version, {attribute: value})}
+    _CACHE = {}
+
+    def etag(self):
+        return self.daemon.get_status_version()
+
+    @classmethod
+    def get_cached(cls, version):
+        """
+        Get status command object from cache if still valid for this status version (see ``Daemon.get_status_version()``), else None.
+
+        Does not need django or database access (used by the HTTP server's native status handler).
+
+        >>> Status.get_cached("no-such-version") is None
+        True
+        """
+        cached = cls._CACHE.get("status")
+        if cached is None or cached[0] != version:
+            return None
+        return cls.from_result(cached[1])
+
+    @classmethod
+    def _cached(cls, part, version, compute):
+        cached = cls._CACHE.get(part)
+        if cached is None or cached[0] != version:
+            cached = (version, compute())
+            cls._CACHE[part] = cached
+        return cached[1]
+
+    def _compute_config(self):
+        """Configuration dependent part (only recomputed on configuration changes)."""
+        config = self.daemon.get_config()
+        result = {"chroots": {}, "repositories": {}}
+
+        # chroots: {"squeeze": ["i386", "amd64"], "wheezy": ["amd64"]}
+        for c in config.chroots:
+            result["chroots"].setdefault(c.codename, [])
+            result["chroots"][c.codename].append(c.architecture)
+
+        # repositories: {"repo1": ["sid", "wheezy"], "repo2": ["squeeze"]}
+        for r in config.repositories:
+            result["repositories"][r.identity] = [d.base_source.codename for d in r.distributions.all()]
+
+        # remotes: ["host1.xyz.org:8066", "host2.xyz.org:8066"]
+        result["remotes"] = [r.http for r in config.remotes]
+        return result
+
+    def _compute(self):
         # version string
         self.version = mini_buildd.__version__
 
@@ -315,17 +492,8 @@ class Status(DaemonCommand):
         # float value: 0 =< load <= 1+
         self.load = self.daemon.build_queue.load
 
-        # chroots: {"squeeze": ["i386", "amd64"], "wheezy": ["amd64"]}
-        for c in self.daemon.get_active_chroots():
-            self.chroots.setdefault(c.source.codename, [])
-            self.chroots[c.source.codename].append(c.architecture.name)
-
-        # repositories: {"repo1": ["sid", "wheezy"], "repo2": ["squeeze"]}
-        for r in self.daemon.get_active_repositories():
-            self.repositories[r.identity] = [d.base_source.codename for d in r.distributions.all()]
-
-        # remotes: ["host1.xyz.org:8066", "host2.xyz.org:8066"]
-        self.remotes = [r.http for r in self.daemon.get_active_or_auto_reactivate_remotes()]
+        for key, value in self._cached("config", self.daemon.get_config().version, self._compute_config).items():
+            setattr(self, key, value)
 
         # packaging/building: string/unicode
         self.packaging = ["{0}".format(p) for p in list(self.daemon.packages.values())]
@@ -355,6 +523,11 @@ Builder: {b_len} building
               p="\n".join(self.packaging) + "\n" if self.packaging else "",
               b_len=len(self.building),
               b="\n".join(self.building) + "\n" if self.building else "")
+        return self.result()
+
+    def _run(self):
+        for key, value in self._cached("status", self.daemon.get_status_version(), self._compute).items():
+            setattr(self, self._result_attr(key), value)
 
     def repositories_str(self):
         return ", ".join(["{i}: {c}".format(i=identity, c=" ".join(codenames)) for identity, codenames in list(self.repositories.items())])
@@ -407,9 +580,8 @@ class PrintUploaders(DaemonCommand):
     NEEDS_RUNNING_DAEMON = True
     ARGUMENTS = [SelectArgument(["--repository", "-R"], default=".*", doc="repository name regex.")]
 
-    def _update(self):
-        if self.daemon:
-            self.args["repository"].choices = [r.identity for r in self.daemon.get_active_repositories()]
+    def _update_choices(self):
+        self.args["repository"].choices = [r.identity for r in self.daemon.get_active_repositories()]
 
     def _uploader_lines(self):
         for r in self.daemon.get_active_repositories().filter(identity__regex=r"^{r}$".format(r=self.args["repository"].value)):
@@ -490,15 +662,15 @@ class KeyringPackages(DaemonCommand):
     ]
 
     def _update(self):
-        if self.daemon:
-            # Possible choices
-            self.args["distributions"].choices = []
-            for r in self.daemon.get_active_repositories():
-                self.args["distributions"].choices += r.mbd_distribution_strings(build_keyring_package=True)
+        # Reasonable default
+        if self.daemon and not self.args["distributions"].given:
+            self.update_choices()
+            self.args["distributions"].set(self.args["distributions"].choices)
 
-            # Reasonable default
-            if not self.args["distributions"].given:
-                self.args["distributions"].set(self.args["distributions"].choices)
+    def _update_choices(self):
+        self.args["distributions"].choices = []
+        for r in self.daemon.get_active_repositories():
+            self.args["distributions"].choices += r.mbd_distribution_strings(build_keyring_package=True)
 
     def _run(self):
         uploaded = set()
@@ -553,17 +725,17 @@ class TestPackages(DaemonCommand):
     ]
 
     def _update(self):
-        if self.daemon:
-            # Possible choices
-            self.args["distributions"].choices = []
-            for r in self.daemon.get_active_repositories():
-                self.args["distributions"].choices += r.mbd_distribution_strings(uploadable=True)
-
-            # Reasonable default
-            # Default layout has two (snapshot and experimental) suites flagged as experimental.
-            # So we go here for the string "experimental" (not the flag) to avoid double testing in the standard case.
-            if not self.args["distributions"].given:
-                self.args["distributions"].set([d for d in self.args["distributions"].choices if d.endswith("experimental")])
+        # Reasonable default
+        # Default layout has two (snapshot and experimental) suites flagged as experimental.
+        # So we go here for the string "experimental" (not the flag) to avoid double testing in the standard case.
+        if self.daemon and not self.args["distributions"].given:
+            self.update_choices()
+            self.args["distributions"].set([d for d in self.args["distributions"].choices if d.endswith("experimental")])
+
+    def _update_choices(self):
+        self.args["distributions"].choices = []
+        for r in self.daemon.get_active_repositories():
+            self.args["distributions"].choices += r.mbd_distribution_strings(uploadable=True)
 
     def _run(self):
         for d in self.args["distributions"].value:
@@ -613,11 +785,10 @@ class GetSourcesList(ConfigCommand):
         BoolArgument(["--with-extra-sources", "-x"], default=False, doc="also list extra sources needed.")
     ]
 
-    def _update(self):
-        if self.daemon:
-            self.args["codename"].choices = self.daemon.get_active_codenames()
-            self.args["repository"].choices = [r.identity for r in self.daemon.get_active_repositories()]
-            self.args["suite"].choices = [s.name for s in self.daemon.get_suites()]
+    def _update_choices(self):
+        self.args["codename"].choices = self.daemon.get_active_codenames()
+        self.args["repository"].choices = [r.identity for r in self.daemon.get_active_repositories()]
+        self.args["suite"].choices = [s.name for s in self.daemon.get_suites()]
 
     def _run(self):
         self._plain_result = self.daemon.mbd_get_sources_list(self.args["codename"].value,
@@ -667,6 +838,7 @@ class List(PackageCommand):
     """List packages matching a shell-like glob pattern; matches both source and binary package names."""
 
     COMMAND = "list"
+    RESULT = ["repositories"]
     AUTH = Command.LOGIN
     ARGUMENTS = [
         SelectArgument(["pattern"], doc="limit packages by name (glob pattern)"),
@@ -679,12 +851,11 @@ class List(PackageCommand):
         super().__init__(*args, **kwargs)
         self.repositories = {}
 
-    def _update(self):
-        if self.daemon:
-            self.args["distribution"].choices = []
-            for r in self.daemon.get_active_repositories():
-                self.args["distribution"].choices += r.mbd_distribution_strings()
-            self.args["pattern"].choices = self.daemon.get_last_packages()
+    def _update_choices(self):
+        self.args["distribution"].choices = []
+        for r in self.daemon.get_active_repositories():
+            self.args["distribution"].choices += r.mbd_distribution_strings()
+        self.args["pattern"].choices = self.daemon.get_last_packages()
 
     def _run(self):
         # Save all results of all repos in a top-level dict (don't add repos with empty results).
@@ -731,6 +902,7 @@ class Show(PackageCommand):
     """Show a source package."""
 
     COMMAND = "show"
+    RESULT = ["repositories"]
     ARGUMENTS = [
         SelectArgument(["package"], doc="source package name"),
         BoolArgument(["--verbose", "-v"], default=False, doc="verbose output")
@@ -738,19 +910,18 @@ class Show(PackageCommand):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # List of tuples: (repository, result)
+        # List of tuples: (repository identity, result)
         self.repositories = []
 
-    def _update(self):
-        if self.daemon:
-            self.args["package"].choices = self.daemon.get_last_packages()
+    def _update_choices(self):
+        self.args["package"].choices = self.daemon.get_last_packages()
 
     def _run(self):
         # Save all results of all repos in a top-level dict (don't add repos with empty results).
         for r in self.daemon.get_active_repositories():
             r_result = r.mbd_package_show(self.args["package"].value)
             if r_result:
-                self.repositories.append((r, r_result))
+                self.repositories.append((r.identity, r_result))
 
     def __str__(self):
         if not self.repositories:
@@ -806,12 +977,11 @@ class Migrate(PackageCommand):
         Command.COMMON_ARG_VERSION
     ]
 
-    def _update(self):
-        if self.daemon:
-            self.args["package"].choices = self.daemon.get_last_packages()
-            self.args["distribution"].choices = []
-            for r in self.daemon.get_active_repositories():
-                self.args["distribution"].choices += r.mbd_distribution_strings(migrates_to__isnull=False)
+    def _update_choices(self):
+        self.args["package"].choices = self.daemon.get_last_packages()
+        self.args["distribution"].choices = []
+        for r in self.daemon.get_active_repositories():
+            self.args["distribution"].choices += r.mbd_distribution_strings(migrates_to__isnull=False)
 
     def _run(self):
         repository, distribution, suite, rollback = self.daemon.parse_distribution(self.args["distribution"].value)
@@ -836,12 +1006,11 @@ class Remove(PackageCommand):
         Command.COMMON_ARG_VERSION
     ]
 
-    def _update(self):
-        if self.daemon:
-            self.args["package"].choices = self.daemon.get_last_packages()
-            self.args["distribution"].choices = []
-            for r in self.daemon.get_active_repositories():
-                self.args["distribution"].choices += r.mbd_distribution_strings()
+    def _update_choices(self):
+        self.args["package"].choices = self.daemon.get_last_packages()
+        self.args["distribution"].choices = []
+        for r in self.daemon.get_active_repositories():
+            self.args["distribution"].choices += r.mbd_distribution_strings()
 
     def _run(self):
         repository, distribution, suite, rollback = self.daemon.parse_distribution(self.args["distribution"].value)
@@ -872,19 +1041,20 @@ class Port(PackageCommand):
         MultiSelectArgument(["to_distributions"], doc="comma-separated list of distributions to port to (when this equals the from-distribution, a rebuild will be done)"),
         Command.COMMON_ARG_VERSION,
         Command.COMMON_ARG_OPTIONS]
+    CHOICES_ARGS = ["from_distribution"]
 
-    def _update(self):
-        if self.daemon:
-            self.args["package"].choices = self.daemon.get_last_packages()
-            self.args["from_distribution"].choices = []
+    def _update_choices(self):
+        self.args["package"].choices = self.daemon.get_last_packages()
+        self.args["from_distribution"].choices = []
+        for r in self.daemon.get_active_repositories():
+            self.args["from_distribution"].choices += r.mbd_distribution_strings()
+        if self.args["from_distribution"].value:
+            repository, _distribution, suite, _rollback_no = self.daemon.parse_distribution(self.args["from_distribution"].value)
+            self.args["to_distributions"].choices = repository.mbd_distribution_strings(uploadable=True, experimental=suite.experimental)
+        else:
+            self.args["to_distributions"].choices = []
             for r in self.daemon.get_active_repositories():
-                self.args["from_distribution"].choices += r.mbd_distribution_strings()
-            if self.args["from_distribution"].value:
-                repository, _distribution, suite, _rollback_no = self.daemon.parse_distribution(self.args["from_distribution"].value)
-                self.args["to_distributions"].choices = repository.mbd_distribution_strings(uploadable=True, experimental=suite.experimental)
-            else:
-                for r in self.daemon.get_active_repositories():
-                    self.args["to_distributions"].choices += r.mbd_distribution_strings(uploadable=True)
+                self.args["to_distributions"].choices += r.mbd_distribution_strings(uploadable=True)
 
     def _run(self):
         # Parse and pre-check all dists
@@ -918,11 +1088,10 @@ class PortExt(PackageCommand):
         Command.COMMON_ARG_OPTIONS
     ]
 
-    def _update(self):
-        if self.daemon:
-            self.args["distributions"].choices = []
-            for r in self.daemon.get_active_repositories():
-                self.args["distributions"].choices += r.mbd_distribution_strings(uploadable=True)
+    def _update_choices(self):
+        self.args["distributions"].choices = []
+        for r in self.daemon.get_active_repositories():
+            self.args["distributions"].choices += r.mbd_distribution_strings(uploadable=True)
 
     def _run(self):
         # Parse and pre-check all dists
@@ -946,13 +1115,13 @@ class Retry(PackageCommand):
         SelectArgument(["version"], doc="source package's version"),
         SelectArgument(["--repository", "-R"], default="*", doc="Repository name -- use only in case of multiple matches.")
     ]
+    CHOICES_ARGS = ["package"]
 
-    def _update(self):
-        if self.daemon:
-            self.args["repository"].choices = [r.identity for r in self.daemon.get_active_repositories()]
-            self.args["package"].choices = self.daemon.get_last_packages()
-            if self.args["package"].value:
-                self.args["version"].choices = self.daemon.get_last_versions(self.args["package"].value)
+    def _update_choices(self):
+        self.args["repository"].choices = [r.identity for r in self.daemon.get_active_repositories()]
+        self.args["package"].choices = self.daemon.get_last_packages()
+        if self.args["package"].value:
+            self.args["version"].choices = self.daemon.get_last_versions(self.args["package"].value)
 
     def _run(self):
         pkg_log = mini_buildd.misc.PkgLog(self.args["repository"].value, False, self.args["package"].value, self.args["version"].value)
@@ -964,6 +1133,185 @@ class Retry(PackageCommand):
         self._plain_result = os.path.basename(os.path.basename(pkg_log.changes))
 
 
+class History(PackageCommand):
+    """
+    Query the package or build history.
+
+    Shows one page of matching history entries (latest first),
+    along with the number of all matching entries and the time
+    they took (average, minimum and maximum).
+    """
+
+    COMMAND = "history"
+    RESULT = ["page", "pages", "stats", "entries"]
+    ARGUMENTS = [
+        SelectArgument(["--type", "-T"], default="packages", choices=["packages", "builds"], doc="history type: packages or builds"),
+        SelectArgument(["--package", "-p"], default="", doc="limit to source package name"),
+        StringArgument(["--version", "-V"], default="", doc="limit to source package version"),
+        SelectArgument(["--distribution", "-D"], default="", doc="limit distributions by name (regex)"),
+        SelectArgument(["--architecture", "-a"], default="", doc="limit to architecture (builds only)"),
+        SelectArgument(["--status", "-s"], default="", doc="limit to status (like 'INSTALLED', 'FAILED' or 'BUILT')"),
+        IntArgument(["--days", "-d"], default=0, doc="limit to entries closed within the last N days (0 for no limit)"),
+        IntArgument(["--page", "-P"], default=1, doc="page to show (1 is the latest)"),
+        IntArgument(["--page-size", "-S"], default=50, doc="number of entries per page"),
+    ]
+
+    FILTERS = ["package", "version", "distribution", "architecture", "status"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.page = 0
+        self.pages = 0
+        self.stats = {}
+        self.entries = []
+
+    def _update_choices(self):
+        self.args["distribution"].choices = []
+        for r in self.daemon.get_active_repositories():
+            self.args["distribution"].choices += r.mbd_distribution_strings()
+        self.args["package"].choices = self.daemon.get_last_packages()
+        self.args["architecture"].choices = [c.architecture.name for c in self.daemon.get_active_chroots()]
+
+    def _run(self):
+        history = self.daemon.get_history(self.args["type"].value)
+        filters = {f: self.args[f].value for f in self.FILTERS + ["days"]}
+
+        page = history.mbd_query(page=self.args["page"].value, page_size=self.args["page_size"].value, **filters)
+        self.page = page.number
+        self.pages = page.paginator.num_pages
+        self.stats = history.mbd_stats(**filters)
+        self.entries = [{"closed": e.closed.isoformat(),
+                         "package": e.package,
+                         "version": e.version,
+                         "distribution": e.distribution,
+                         "architecture": getattr(e, "architecture", ""),
+                         "status": e.status,
+                         "started": e.started.isoformat() if e.started else None,
+                         "took": e.took} for e in page]
+
+    def __str__(self):
+        def took(seconds):
+            return "n/a" if seconds is None else "{s:.1f}s".format(s=seconds)
+
+        result = "\n".join(["{c} {s:<10} {p}_{v} ({d}{a}): {t}".format(c=e["closed"][:16].replace("T", " "),
+                                                                                     s=e["status"],
+                                                                                     p=e["package"],
+                                                                                     v=e["version"],
+                                                                                     d=e["distribution"],
+                                                                                     a="/" + e["architecture"] if e["architecture"] else "",
+                                                                                     t=took(e["took"])) for e in self.entries])
+        return "{r}{n}Page {p}/{P}: {c} matching entries, took {avg} on average (min {min}, max {max}).".format(
+            r=result,
+            n="\n\n" if result else "",
+            p=self.page,
+            P=self.pages,
+            c=self.stats.get("count", 0),
+            avg=took(self.stats.get("took_avg")),
+            min=took(self.stats.get("took_min")),
+            max=took(self.stats.get("took_max")))
+
+
+class Batch(PackageCommand):
+    """
+    Run a batch of commands.
+
+    Commands are given as json list, like
+    '[{"command": "migrate", "args": {"package": "foo", "distribution": "buster-test-unstable"}}, ...]',
+    and are run in the given order, with per-command authorization and
+    result. Changed package indices are only exported once per
+    repository, after all commands have run.
+
+    Confirming the batch confirms all its commands.
+    """
+
+    COMMAND = "batch"
+    CONFIRM = True
+    RESULT = ["plain", "results"]
+    ARGUMENTS = [
+        TextArgument(["commands"], doc="json list of commands (objects with 'command' and 'args')"),
+    ]
+
+    # Args that determine the repository a command works on
+    REPOSITORY_ARGS = ["distribution", "from_distribution"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results = []
+
+    @classmethod
+    def parse(cls, commands):
+        """
+        Parse json commands to list of (command class, args) tuples.
+
+        >>> [(c.COMMAND, a) for c, a in Batch.parse('[{"command": "migrate", "args": {"package": "foo", "distribution": "buster-test-unstable"}}, {"command": "status"}]')]
+        [('migrate', {'package': 'foo', 'distribution': 'buster-test-unstable'}), ('status', {})]
+        >>> Batch.parse('[{"command": "batch"}]')
+        Traceback (most recent call last):
+        ...
+        Exception: Batch: Command 1: 'batch' can't be run in a batch
+        """
+        result = []
+        for n, item in enumerate(json.loads(commands), 1):
+            cls_ = COMMANDS_DICT.get(item.get("command"))
+            if cls_ is None or cls_ is COMMAND_GROUP:
+                raise Exception("Batch: Command {n}: Unknown command '{c}'".format(n=n, c=item.get("command")))
+            if cls_ is cls:
+                raise Exception("Batch: Command {n}: '{c}' can't be run in a batch".format(n=n, c=cls_.COMMAND))
+            result.append((cls_, {k: str(v) for k, v in item.get("args", {}).items()}))
+        return result
+
+    def _get_repository(self, args):
+        for key in self.REPOSITORY_ARGS:
+            if args.get(key):
+                try:
+                    return self.daemon.parse_distribution(args[key])[0]
+                except BaseException:
+                    return None  # Command fails on its own
+        return None
+
+    def _run_command(self, cls, args):
+        auth_err = cls.auth_err(self.request.user) if self.request else ""
+        if auth_err:
+            raise Exception(auth_err)
+        if cls.NEEDS_RUNNING_DAEMON and not self.daemon.is_running():
+            raise Exception("API: '{c}': Needs running daemon".format(c=cls.COMMAND))
+
+        command = cls(args, daemon=self.daemon, request=self.request, msglog=self.msglog)
+        command.run()
+        return command
+
+    def _run(self):
+        commands = self.parse(self.args["commands"].value)
+
+        # Defer exports of all repositories involved for the whole batch (entered in fixed order, as this holds the repositories' locks)
+        repositories = {}
+        for _cls, args in commands:
+            repository = self._get_repository(args)
+            if repository is not None:
+                repositories[repository.identity] = repository
+
+        results = []
+        with contextlib.ExitStack() as stack:
+            for identity in sorted(repositories):
+                stack.enter_context(repositories[identity].mbd_reprepro_deferred_export())
+
+            for n, (cls, args) in enumerate(commands, 1):
+                self.msglog.info("Batch: Running '{c}' ({n}/{t})".format(c=cls.COMMAND, n=n, t=len(commands)))
+                try:
+                    command = self._run_command(cls, args)
+                    results.append({"command": cls.COMMAND, "args": args, "ok": True, "result": command.result(), "error": ""})
+                except BaseException as e:
+                    mini_buildd.config.log_exception(self.msglog, "Batch: '{c}' failed".format(c=cls.COMMAND), e, logging.WARNING)
+                    results.append({"command": cls.COMMAND, "args": args, "ok": False, "result": None, "error": str(e)})
+
+        self.results = results
+        self._plain_result = "\n".join(["{n}: {c} {a}: {r}".format(n=n,
+                                                                   c=r["command"],
+                                                                   a=" ".join("{k}={v}".format(k=k, v=v) for k, v in sorted(r["args"].items())),
+                                                                   r="OK" if r["ok"] else "FAILED ({e})".format(e=r["error"]))
+                                         for n, r in enumerate(results, 1)])
+
+
 class UserCommand(Command):
     """User management commands."""
 
@@ -1013,9 +1361,10 @@ class Subscription(UserCommand):
         SelectArgument(["action"], doc="action to run", choices=["list", "add", "remove"]),
         SelectArgument(["subscription"], doc="subscription pattern")
     ]
+    CHOICES_ARGS = ["subscription"]
 
-    def _update(self):
-        if self.daemon and self.args["subscription"].value:
+    def _update_choices(self):
+        if self.args["subscription"].value:
             self.args["subscription"].choices = [self.args["subscription"].value]
             package, _sep, _distribution = self.args["subscription"].value.partition(":")
             for r in self.daemon.get_active_repositories():
@@ -1065,5 +1414,55 @@ for _C in [c for c in sys.modules[__name__].__dict__.values() if inspect.isclass
         _PREVIOUS_GROUP = _GROUP
     COMMANDS.append((_C.COMMAND, _C))
 COMMANDS_DICT = dict(COMMANDS)
-COMMANDS_DEFAULTS = [(cmd, cls({}) if cmd != COMMAND_GROUP else cls) for cmd, cls in COMMANDS]
-COMMANDS_DEFAULTS_DICT = dict(COMMANDS_DEFAULTS)
+
+_COMMANDS_DEFAULTS = None
+
+
+_SCHEMA = None
+
+
+def get_schema():
+    """
+    Get API command schema (plain python types; for thin clients, see ``mini_buildd.schema``).
+
+    The fingerprint changes whenever any command or argument changes.
+
+    >>> schema = get_schema()
+    >>> status = next(c for c in schema["commands"] if c["command"] == "status")
+    >>> status["group"], status["auth"], status["confirm"], status["arguments"]
+    ('Daemon commands.', 0, False, [])
+    >>> next(c for c in schema["commands"] if c["command"] == "migrate")["arguments"][2]
+    {'id_list': ['--full', '-F'], 'type': 'bool', 'doc': "migrate all 'migrates_to' suites up (f.e. unstable->testing->stable).", 'default': False, 'choices': []}
+    """
+    global _SCHEMA  # pylint: disable=global-statement
+    if _SCHEMA is None:
+        commands = []
+        group = None
+        for cmd, cls in COMMANDS:
+            if cmd == COMMAND_GROUP:
+                group = cls
+            else:
+                commands.append({"command": cmd,
+                                 "group": group,
+                                 "doc": cls.docstring(),
+                                 "auth": cls.AUTH,
+                                 "confirm": cls.CONFIRM,
+                                 "needs_running_daemon": cls.NEEDS_RUNNING_DAEMON,
+                                 "arguments": [a.schema() for a in cls.ARGUMENTS]})
+        _SCHEMA = {"version": mini_buildd.schema.SCHEMA_VERSION,
+                   "fingerprint": hashlib.sha1(json.dumps(commands, sort_keys=True).encode("UTF-8")).hexdigest(),
+                   "commands": commands}
+    return _SCHEMA
+
+
+def encode_schema(output):
+    """Encode API command schema to bytes."""
+    return _dump(get_schema(), output)
+
+
+def get_commands_defaults():
+    """Get list of tuples like COMMANDS, but with command objects (with default arguments) instead of classes (only needed for the API index, so built on first use)."""
+    global _COMMANDS_DEFAULTS  # pylint: disable=global-statement
+    if _COMMANDS_DEFAULTS is None:
+        _COMMANDS_DEFAULTS = [(cmd, cls({}) if cmd != COMMAND_GROUP else cls) for cmd, cls in COMMANDS]
+    return _COMMANDS_DEFAULTS
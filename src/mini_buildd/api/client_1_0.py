@@ -1,6 +1,11 @@
 import sys
 import time
+import json
+import socket
 import pickle
+import collections
+import concurrent.futures
+import http.cookiejar
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -10,10 +15,42 @@ import debian.debian_support
 
 import mini_buildd.misc
 import mini_buildd.net
+import mini_buildd.events
 import mini_buildd.api
 
 
+def fan_out(daemons, func, max_workers=None):
+    """
+    Run func(daemon) for all daemons concurrently (so this takes as long as the slowest daemon).
+
+    Returns an ordered dict: daemon url -> result (or the exception raised).
+
+    >>> class D():
+    ...     def __init__(self, host):
+    ...         self.url = "http://{h}:8066".format(h=host)
+    >>> def func(daemon):
+    ...     time.sleep(0.2)
+    ...     if "bad" in daemon.url:
+    ...         raise Exception("Host down")
+    ...     return daemon.url.upper()
+    >>> start = time.monotonic()
+    >>> for url, result in fan_out([D("a"), D("bad"), D("c")], func).items():
+    ...     print(url, repr(result))
+    http://a:8066 'HTTP://A:8066'
+    http://bad:8066 Exception('Host down')
+    http://c:8066 'HTTP://C:8066'
+    >>> time.monotonic() - start < 0.5
+    True
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or max(1, len(daemons))) as executor:
+        futures = [(d, executor.submit(func, d)) for d in daemons]
+    return collections.OrderedDict((d.url, f.exception() or f.result()) for d, f in futures)
+
+
 class Daemon():
+    # HTTP status codes worth a retry (proxy errors, temporary unavailability)
+    RETRY_HTTP_CODES = [502, 503, 504]
+
     def _log(self, message):
         print("{host}: {m}".format(host=self.host, m=message), file=sys.stderr)
 
@@ -27,7 +64,19 @@ class Daemon():
                  auto_confirm=False,
                  dry_run=False,
                  batch_mode=False,
-                 django_mode=True):
+                 django_mode=False,
+                 timeout=300,
+                 retries=2,
+                 retry_backoff=2.0):
+        """
+        Client for one mini-buildd instance.
+
+        API calls use persistent connections, and time out after timeout
+        seconds. Failed calls are retried at most retries times,
+        waiting retry_backoff seconds (doubling each retry). Calls
+        of commands that need confirmation (i.e., that change things)
+        are only retried if the connection could not be established.
+        """
         self.host = host
         self.port = port
         self.proto = proto
@@ -36,9 +85,15 @@ class Daemon():
         self.auto_confirm = auto_confirm
         self.dry_run = dry_run
         self.batch_mode = batch_mode
+        # Django is only needed to decode 'python' (pickle) output
+        self.django_mode = django_mode
         if django_mode:
             mini_buildd.api.django_pseudo_configure()
 
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._pool = mini_buildd.net.ConnectionPool(timeout=timeout, cookiejar=http.cookiejar.CookieJar())
+
         # Extra: status caching
         self._status = None
         # Extra: dputconf caching (for archive identity workaround)
@@ -47,10 +102,44 @@ class Daemon():
     def login(self, user=None):
         """Login. Use the user's mini-buildd keyring for auth, like mini-buildd-tool."""
         keyring = mini_buildd.misc.Keyring("mini-buildd")
-        mini_buildd.net.web_login("{host}:{port}".format(host=self.host, port=self.port), user if (user or self.batch_mode) else input("Username: "), keyring, proto=self.proto)
+        opener = mini_buildd.net.web_login("{host}:{port}".format(host=self.host, port=self.port), user if (user or self.batch_mode) else input("Username: "), keyring, proto=self.proto)
+        # Use the login's session cookies for our connections
+        self._pool.cookiejar = next(h.cookiejar for h in opener.handlers if isinstance(h, urllib.request.HTTPCookieProcessor))
         return self
 
-    def call(self, command, args=None, output="python", raise_on_error=True):
+    def _open(self, url, command):
+        """Open url via persistent connection, with retries."""
+        cls = mini_buildd.api.COMMANDS_DICT.get(command)
+        modifying = cls is None or cls.CONFIRM
+        retry = 0
+        while True:
+            try:
+                return self._pool.open(url)
+            except urllib.error.HTTPError as e:
+                if retry >= self.retries or e.code not in ([503] if modifying else self.RETRY_HTTP_CODES):
+                    raise
+                error = e
+            except OSError as e:
+                if retry >= self.retries or (modifying and not isinstance(e, ConnectionRefusedError)):
+                    raise
+                error = e
+
+            retry += 1
+            delay = self.retry_backoff * 2 ** (retry - 1)
+            self._log("API call failed ({e}): Retry {r}/{m} in {d:.1f} seconds...".format(e=error, r=retry, m=self.retries, d=delay))
+            time.sleep(delay)
+
+    def _decode(self, data, output):
+        if output in mini_buildd.api.STRUCTURED_OUTPUTS:
+            return mini_buildd.api.decode(data, output)
+        if output == "python":
+            if not self.django_mode:
+                mini_buildd.api.django_pseudo_configure()
+                self.django_mode = True
+            return pickle.loads(data)
+        return data
+
+    def call(self, command, args=None, output="json", raise_on_error=True):
         if args is None:
             args = {}
 
@@ -65,8 +154,8 @@ class Daemon():
 
         self._log("Calling API: {}".format(url))
         try:
-            response = mini_buildd.net.urlopen_ca_certificates(url)
-            return pickle.loads(response.read()) if output == "python" else response.read()
+            response = self._open(url, command)
+            return self._decode(response.read(), output)
         except urllib.error.HTTPError as e:
             self._log("API call failed with HTTP Status {status}:".format(status=e.getcode()))
             self._log_daemon_messages(e.headers)
@@ -146,16 +235,64 @@ class Daemon():
 
         return result
 
+    def events(self, timeout=None, keepalives=False, **filters):
+        """
+        Iterate over events (dicts, see ``mini_buildd.events``) from the event stream.
+
+        Events may be filtered by ``repository``, ``package`` and ``distribution`` (regex).
+        With keepalives, None is yielded for each keepalive (sent every 30 seconds).
+        Raises ``socket.timeout`` when nothing arrived within timeout seconds.
+        """
+        url = "{url}/events?{args}".format(url=self.url, args=urllib.parse.urlencode(filters))
+        with mini_buildd.net.urlopen_ca_certificates(url, timeout=timeout) as stream:
+            data = []
+            for line in stream:
+                line = line.decode("UTF-8").rstrip("\r\n")
+                if line.startswith("data:"):
+                    data.append(line[5:].lstrip(" "))
+                elif line.startswith(":") and keepalives:
+                    yield None
+                elif not line and data:
+                    yield mini_buildd.events.Event.decode("\n".join(data))
+                    data = []
+
+    def wait_for_event(self, secs, statuses, **filters):
+        """Block until an event with one of statuses arrives (see ``events()``), but at most secs seconds. Returns the event, or None."""
+        deadline = time.monotonic() + secs
+        try:
+            for event in self.events(timeout=secs, keepalives=True, **filters):
+                if event is not None and event["status"] in statuses:
+                    return event
+                if time.monotonic() >= deadline:
+                    break
+        except socket.timeout:
+            pass
+        except (urllib.error.URLError, OSError) as e:
+            # Event stream not available (mini-buildd < 1.9.x, or network problem): Just idle
+            self._log("Event stream not available ({e}), idling instead.".format(e=e))
+            time.sleep(max(0.0, deadline - time.monotonic()))
+        return None
+
     def wait_for_package(self, distribution, src_package, version=None, or_greater=False,  # pylint: disable=inconsistent-return-statements
                          max_tries=-1, sleep=60, initial_sleep=0,
                          raise_on_error=True):
-        """Block until a specific package is in repository."""
+        """
+        Block until a specific package is in repository.
+
+        Between tries, blocks on the event stream until the package is installed
+        or migrated in distribution (but sleep seconds at most).
+        """
         item = "\"{p}_{v}\" in \"{d}\"".format(p=src_package, v=version, d=distribution)
 
         def _sleep(secs):
             self._log("Waiting for {item}: Idling {s} seconds (Ctrl-C to abort)...".format(item=item, s=secs))
             time.sleep(secs)
 
+        def _wait(secs):
+            if secs > 0:
+                self._log("Waiting for {item}: Waiting for events at most {s} seconds (Ctrl-C to abort)...".format(item=item, s=secs))
+                self.wait_for_event(secs, ["INSTALLED", "MIGRATED"], package=src_package, distribution=re.escape(distribution))
+
         tries = 0
         _sleep(initial_sleep)
         while max_tries < 0 or tries < max_tries:
@@ -168,7 +305,7 @@ class Daemon():
                (version is not None and (actual_version == version or or_greater and debian.debian_support.Version(actual_version) >= debian.debian_support.Version(version))):
                 self._log("Match found: {item}.".format(item=item))
                 return pkg_info
-            _sleep(sleep)
+            _wait(sleep)
             tries += 1
 
         not_found_msg = "Could not find {item} within {s} seconds.".format(item=item, s=initial_sleep + tries * sleep)
@@ -182,8 +319,24 @@ class Daemon():
                                      max_tries=1, sleep=0, initial_sleep=0,
                                      raise_on_error=False)
 
+    def batch(self, commands, batch_size=20):
+        """
+        Run commands (list of (command, args) tuples) via 'batch' calls of at most batch_size commands each.
+
+        Returns the list of per-command results (dicts with 'command', 'args', 'ok', 'result' and 'error').
+
+        Batch calls need confirmation (like the commands they run), see ``auto_confirm``.
+        """
+        results = []
+        for start in range(0, len(commands), batch_size):
+            items = [{"command": c, "args": a} for c, a in commands[start:start + batch_size]]
+            batch = self.call("batch", {"commands": urllib.parse.quote(json.dumps(items, separators=(",", ":")))}, raise_on_error=False)
+            if batch is not None:
+                results += batch.results
+        return results
+
     def bulk_migrate(self, packages, repositories=None, codenames=None, suites=None):
-        """Bulk-migrate a package over repositories, base distributions and suites."""
+        """Bulk-migrate a package over repositories, base distributions and suites (via batch calls)."""
         status = self.call("status")
 
         if repositories is None:
@@ -191,6 +344,7 @@ class Daemon():
         if suites is None:
             suites = ["unstable", "testing"]
 
+        commands = []
         for package in packages:
             for repository in repositories:
                 iter_codenames = codenames
@@ -199,4 +353,7 @@ class Daemon():
                 for codename in iter_codenames:
                     for suite in suites:
                         dist = "{c}-{r}-{s}".format(c=codename, r=repository, s=suite)
-                        self.call("migrate", {"package": package, "distribution": dist}, raise_on_error=False)
+                        commands.append(("migrate", {"package": package, "distribution": dist}))
+
+        for result in self.batch(commands):
+            self._log("Migrate {p} ({d}): {r}".format(p=result["args"]["package"], d=result["args"]["distribution"], r="OK" if result["ok"] else result["error"]))
@@ -0,0 +1,254 @@
+"""
+Benchmarks (for development).
+
+Run via ``./devel benchmark [<name>...]``, or ``python3 -m mini_buildd.benchmark [<name>...]``.
+
+``queries``
+  Count SQL queries of the repository configuration helpers on a large
+  configuration (in-memory pseudo instance).
+
+``imports``
+  Measure startup times of client entry points (each in a fresh
+  interpreter), and check they don't load heavy dependencies.
+
+``httpd``
+  Measure static repository serving (pool and dists files, plain,
+  conditional and range requests) of the HTTP server (in-process, on
+  localhost).
+"""
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+import contextlib
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+def _create_configuration(home, codenames, repositories, architectures):
+    import mini_buildd.config
+    import mini_buildd.net
+    import mini_buildd.daemon
+    import mini_buildd.models.daemon
+    import mini_buildd.models.source
+    import mini_buildd.models.repository
+
+    mini_buildd.config.HOME_DIR = home
+    mini_buildd.config.REPOSITORIES_DIR = os.path.join(home, "repositories")
+    mini_buildd.config.HTTPD_ENDPOINTS = [mini_buildd.net.ServerEndpoint("tcp6:port=8066", mini_buildd.net.Protocol.HTTP)]
+    mini_buildd.daemon.Daemon().model = mini_buildd.models.daemon.Daemon.objects.create(id=1)
+
+    mini_buildd.models.repository.Layout.Admin.mbd_meta_create_defaults(LOG)
+    components = [mini_buildd.models.source.Component.objects.create(name=name) for name in ["main", "contrib", "non-free"]]
+    archs = [mini_buildd.models.source.Architecture.objects.create(name="arch{n}".format(n=n)) for n in range(architectures)]
+
+    distributions = []
+    for n in range(codenames):
+        source = mini_buildd.models.source.Source.objects.create(origin="Debian", codename="codename{n}".format(n=n))
+        source.components.set(components)
+        source.archives.add(mini_buildd.models.source.Archive.objects.create(url="http://archive{n}.example.org/debian/".format(n=n), ping=10.0))
+        extra = mini_buildd.models.source.Source.objects.create(origin="Extra", codename="codename{n}-extra".format(n=n))
+        extra.components.set(components)
+        extra.archives.add(mini_buildd.models.source.Archive.objects.create(url="http://extra{n}.example.org/debian/".format(n=n), ping=10.0))
+
+        distribution = mini_buildd.models.repository.Distribution.objects.create(base_source=source)
+        distribution.components.set(components)
+        distribution.extra_sources.add(mini_buildd.models.source.PrioritySource.objects.create(source=extra, priority=1))
+        for a in archs:
+            mini_buildd.models.repository.ArchitectureOption.objects.create(architecture=a, distribution=distribution)
+        distributions.append(distribution)
+
+    layout = mini_buildd.models.repository.Layout.objects.get(name="Default")
+    for n in range(repositories):
+        repository = mini_buildd.models.repository.Repository.objects.create(identity="repo{n}".format(n=n), layout=layout)
+        repository.distributions.set(distributions)
+
+
+def queries(codenames=10, repositories=5, architectures=4):
+    """Count queries of repository configuration helpers; returns a dict: helper -> number of queries."""
+    import django.db
+    import django.test.utils
+
+    import mini_buildd.api
+    mini_buildd.api.django_pseudo_configure()
+
+    import mini_buildd.misc
+    import mini_buildd.models.repository
+    import mini_buildd.models.snapshot
+
+    result = {}
+
+    def count(name, func):
+        with django.test.utils.CaptureQueriesContext(django.db.connection) as context:
+            func()
+        result[name] = len(context.captured_queries)
+
+    def for_all(func):
+        def run():
+            for r in mini_buildd.models.repository.Repository.mbd_get_active():
+                for d in r.distributions.all():
+                    for s in r.layout.suiteoption_set.all():
+                        func(r, d, s)
+        return run
+
+    with django.test.utils.override_settings(USE_TZ=True), contextlib.closing(mini_buildd.misc.TmpDir()) as home:
+        _create_configuration(home.tmpdir, codenames, repositories, architectures)
+        mini_buildd.models.repository.Repository.objects.all().update(status=mini_buildd.models.repository.Repository.STATUS_ACTIVE)
+
+        count("distribution strings", lambda: [r.mbd_distribution_strings(uploadable=True) for r in mini_buildd.models.repository.Repository.mbd_get_active()])
+        count("distribution strings (unprefetched)", lambda: [r.mbd_distribution_strings(uploadable=True) for r in mini_buildd.models.repository.Repository.objects.all()])
+        count("reprepro config", lambda: [r._mbd_reprepro_config() for r in mini_buildd.models.repository.Repository.mbd_get_active()])  # pylint: disable=protected-access
+        count("find dist", for_all(lambda r, d, s: r._mbd_find_dist(mini_buildd.misc.Distribution(s.mbd_get_distribution_string(r, d)))))  # pylint: disable=protected-access
+        count("apt sources.list", for_all(lambda r, d, s: d.mbd_get_apt_sources_list(r, s)))
+        count("apt preferences", for_all(lambda r, d, s: d.mbd_get_apt_preferences(r, s)))
+        mini_buildd.models.snapshot.CONFIGURATION.invalidate()
+        count("configuration snapshot (build)", mini_buildd.models.snapshot.get)
+        count("configuration snapshot (cached)", lambda: [(d.architectures, d.distribution.base_source.codename) for d in mini_buildd.models.snapshot.get().distributions.values()])
+        count("status", lambda: [(r.identity, [d.base_source.codename for d in r.distributions.all()]) for r in mini_buildd.models.repository.Repository.mbd_get_active()])
+
+    return result
+
+
+# Startup time budgets (milliseconds)
+IMPORT_BUDGETS = {"mini-buildd-tool --help": 100}
+
+# Modules client entry points must not load
+IMPORT_HEAVY = ["django", "twisted", "pyftpdlib", "debian.deb822"]
+
+
+def imports(runs=5):
+    """Measure startup times (best of runs, in milliseconds) of client entry points; returns a dict: entry point -> time."""
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    tool = os.path.join(src_dir, "mini-buildd-tool")
+    if not os.path.exists(tool):
+        tool = shutil.which("mini-buildd-tool")
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([src_dir] + [p for p in [os.environ.get("PYTHONPATH")] if p]))
+
+    def measure(args):
+        best = None
+        for _ in range(runs):
+            start = time.monotonic()
+            if subprocess.run(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+                return None
+            elapsed = (time.monotonic() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    entry_points = [("python3 (interpreter only)", [sys.executable, "-c", "pass"]),
+                    ("import mini_buildd.api", [sys.executable, "-c", "import mini_buildd.api"]),
+                    ("import mini_buildd.api.client_1_0", [sys.executable, "-c", "import mini_buildd.api.client_1_0"])]
+    if tool:
+        entry_points.append(("mini-buildd-tool --help", [sys.executable, tool, "--help"]))
+
+    result = {}
+    for name, args in entry_points:
+        elapsed = measure(args)
+        budget = IMPORT_BUDGETS.get(name)
+        result[name] = "failed" if elapsed is None else "{e:.1f} ms{b}".format(e=elapsed, b="" if budget is None else " ({o} budget of {b} ms)".format(o="OVER" if elapsed > budget else "within", b=budget))
+
+    loaded = subprocess.run([sys.executable, "-c", "import sys, mini_buildd.api.client_1_0; print(' '.join(sys.modules))"], env=env, stdout=subprocess.PIPE, check=True).stdout.decode("UTF-8").split()
+    result["heavy modules loaded by client_1_0"] = " ".join(m for m in IMPORT_HEAVY if m in loaded) or "none"
+    return result
+
+
+def httpd(requests=1000, deb_size=16):
+    """Measure static repository serving (via the HTTP server's repository route, keep-alive connection); returns a dict: case -> throughput."""
+    import socket
+    import threading
+    import http.client
+
+    import twisted.internet.reactor
+
+    import mini_buildd.misc
+    import mini_buildd.config
+    import mini_buildd.net
+    import mini_buildd.httpd_twisted
+
+    mib = 1024 * 1024
+    result = {}
+
+    with contextlib.closing(mini_buildd.misc.TmpDir()) as home:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        mini_buildd.config.HTTPD_ENDPOINTS = [mini_buildd.net.ServerEndpoint("tcp:port={p}:interface=127.0.0.1".format(p=port), mini_buildd.net.Protocol.HTTP)]
+        mini_buildd.config.REPOSITORIES_DIR = os.path.join(home.tmpdir, "repositories")
+        mini_buildd.config.LOG_DIR = os.path.join(home.tmpdir, "log")
+        mini_buildd.config.ACCESS_LOG_FILE = os.path.join(mini_buildd.config.LOG_DIR, "access.log")
+        mini_buildd.config.MANUAL_DIR = os.path.join(home.tmpdir, "manual")
+
+        files = {"InRelease": ("dists/buster-test-unstable/InRelease", 4096),
+                 "Packages": ("dists/buster-test-unstable/main/binary-amd64/Packages", mib),
+                 "deb": ("pool/main/m/mbd-test/mbd-test_1.0_amd64.deb", deb_size * mib)}
+        for path, size in files.values():
+            full_path = os.path.join(mini_buildd.config.REPOSITORIES_DIR, "test", path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, "wb") as f:
+                f.write(os.urandom(size))
+        os.makedirs(mini_buildd.config.LOG_DIR)
+
+        server = threading.Thread(target=mini_buildd.httpd_twisted.HttpD(wsgi_app=None).run, daemon=True)
+        server.start()
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+        def get(name, headers=None):
+            connection.request("GET", "/repositories/test/{p}".format(p=files[name][0]), headers=headers or {})
+            response = connection.getresponse()
+            return response, response.read()
+
+        def measure(case, name, runs, headers=lambda n: None, status=200):
+            size = 0
+            start = time.monotonic()
+            for n in range(runs):
+                response, body = get(name, headers(n))
+                if response.status != status:
+                    result[case] = "failed (HTTP {s}, expected {e})".format(s=response.status, e=status)
+                    return
+                size += len(body)
+            elapsed = time.monotonic() - start
+            result[case] = "{r:.0f} requests/s, {m:.1f} MiB/s".format(r=runs / elapsed, m=size / mib / elapsed)
+
+        try:
+            for _ in range(50):
+                try:
+                    response, _body = get("InRelease")
+                    break
+                except OSError:
+                    time.sleep(0.1)
+                    connection.close()
+
+            measure("InRelease", "InRelease", requests)
+            measure("InRelease (If-Modified-Since)", "InRelease", requests, headers=lambda n: {"If-Modified-Since": response.getheader("Last-Modified")}, status=304)
+            if response.getheader("ETag"):
+                measure("InRelease (If-None-Match)", "InRelease", requests, headers=lambda n: {"If-None-Match": response.getheader("ETag")}, status=304)
+            else:
+                result["InRelease (If-None-Match)"] = "no ETag"
+            measure("Packages", "Packages", requests // 10)
+            measure("deb", "deb", 20)
+            measure("deb (range requests, 1MiB)", "deb", requests // 10, headers=lambda n: {"Range": "bytes={f}-{l}".format(f=n % deb_size * mib, l=(n % deb_size + 1) * mib - 1)}, status=206)
+        finally:
+            connection.close()
+            twisted.internet.reactor.callFromThread(twisted.internet.reactor.stop)
+            server.join()
+
+    return result
+
+
+BENCHMARKS = [queries, imports, httpd]
+
+
+def main(names):
+    for benchmark in [b for b in BENCHMARKS if not names or b.__name__ in names]:
+        start = time.monotonic()
+        result = benchmark()
+        print("{b} ({s:.2f} seconds):".format(b=benchmark.__name__, s=time.monotonic() - start))
+        for key, value in result.items():
+            print("  {k:<40}: {v}".format(k=key, v=value))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,7 +1,6 @@
 import os
 import datetime
 import shutil
-import glob
 import re
 import subprocess
 import logging
@@ -10,35 +9,52 @@ import django.utils.timezone
 
 import mini_buildd.config
 import mini_buildd.misc
+import mini_buildd.events
 import mini_buildd.net
 import mini_buildd.call
 import mini_buildd.changes
 
+import mini_buildd.models.history
+
 
 LOG = logging.getLogger(__name__)
 
 
+def predict(breq):
+    """Predict the time (in seconds) the build request will take: Tuple (seconds, from_package_history), see ``BuildHistory.mbd_predict()``."""
+    try:
+        return mini_buildd.models.history.BuildHistory.mbd_predict(breq["Source"], breq["Architecture"], breq["Base-Distribution"])
+    except BaseException as e:
+        mini_buildd.config.log_exception(LOG, "Can't predict build time for {b} (ignoring)".format(b=breq.get_pkg_id(with_arch=True)), e, logging.WARNING)
+        return None, False
+
+
 class Build(mini_buildd.misc.Status):
+    # A build taking longer than HUNG_FACTOR times its prediction (but at least HUNG_MIN_SECONDS more) is considered hung (only if predicted from the package's history)
+    HUNG_FACTOR = 3
+    HUNG_MIN_SECONDS = 1800
+
     FAILED = -1
     CHECKING = 0
     BUILDING = 1
     UPLOADING = 2
     UPLOADED = 10
 
-    def __init__(self, breq, gnupg, sbuild_jobs):
+    def __init__(self, breq, gnupg, sbuild_jobs, generation=None):
         super().__init__(
             stati={self.FAILED: "FAILED",
                    self.CHECKING: "CHECKING",
                    self.BUILDING: "BUILDING",
                    self.UPLOADING: "UPLOADING",
-                   self.UPLOADED: "UPLOADED"})
+                   self.UPLOADED: "UPLOADED"},
+            generation=generation)
 
         self._breq = breq
         self._gnupg = gnupg
         self._sbuild_jobs = sbuild_jobs
 
         self._build_dir = self._breq.get_spool_dir()
-        self._chroot = "mini-buildd-{d}-{a}".format(d=self._breq["Base-Distribution"], a=self.architecture)
+        self._chroot = mini_buildd.misc.schroot_name(self._breq["Base-Distribution"], self.architecture)
         # Always generate the now out-of-chroot 'libdir' (needed for ccache, ...).
         os.makedirs(mini_buildd.misc.chroot_libdir_path(self._breq["Base-Distribution"], self.architecture), exist_ok=True)
 
@@ -56,15 +72,34 @@ class Build(mini_buildd.misc.Status):
 
         self.live_buildlog_url = breq.get_live_buildlog_loc()
 
+        self.predicted, self.predicted_from_package = predict(breq)
+        self.hung_notified = False
+
+    def set_status(self, status, desc=""):
+        super().set_status(status, desc)
+        mini_buildd.events.publish(mini_buildd.events.BUILD,
+                                   self.status,
+                                   package=self.package,
+                                   version=self.version,
+                                   distribution=self.distribution,
+                                   architecture=self.architecture,
+                                   desc=desc)
+
+    @property
+    def build_dir(self):
+        return self._build_dir
+
     def __str__(self):
         date_format = "%Y-%b-%d %H:%M:%S"
-        return "{s}: [{h}] {k} ({c}): Started {start} ({took} seconds), uploaded {uploaded}: {desc}".format(
+        return "{s}: [{h}] {k} ({c}): Started {start} ({took} seconds, ETA {eta}{hung}), uploaded {uploaded}: {desc}".format(
             s=self.status,
             h=self.upload_result_to,
             k=self.key,
             c=self._chroot,
             start=self.started.strftime(date_format) if self.started else "n/a",
             took=self.took,
+            eta=self.eta.strftime(date_format) if self.eta else "n/a",
+            hung=", HUNG?" if self.hung else "",
             uploaded=self.uploaded.strftime(date_format) if self.uploaded else "n/a",
             desc=self.status_desc)
 
@@ -92,6 +127,11 @@ class Build(mini_buildd.misc.Status):
     def upload_result_to(self):
         return self._breq["Upload-Result-To"]
 
+    @property
+    def sbuild_status(self):
+        """Sbuild status from the build result (like 'successful' or 'failed'; empty if not built)."""
+        return self._bres.get("Sbuild-Status", "")
+
     @property
     def sbuildrc_path(self):
         return os.path.join(self._build_dir, ".sbuildrc")
@@ -108,6 +148,21 @@ class Build(mini_buildd.misc.Status):
     def took(self):
         return round((self.built - self.started).total_seconds(), 1) if self.built else "n/a"
 
+    @property
+    def elapsed(self):
+        """Seconds building so far (None if not building)."""
+        return (django.utils.timezone.now() - self.started).total_seconds() if self.started and not self.built else None
+
+    @property
+    def eta(self):
+        """Predicted end of build (None if not building, or unknown)."""
+        return self.started + datetime.timedelta(seconds=self.predicted) if self.started and not self.built and self.predicted is not None else None
+
+    @property
+    def hung(self):
+        """Whether the build exceeds its prediction (from the package's history) by far (and thus is probably hung)."""
+        return self.elapsed is not None and self.predicted_from_package and self.elapsed > max(self.predicted * self.HUNG_FACTOR, self.predicted + self.HUNG_MIN_SECONDS)
+
     def _generate_sbuildrc(self):
         """Generate .sbuildrc for a build request (not all is configurable via switches, unfortunately)."""
         tpl = """\
@@ -149,6 +204,17 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
                     s = line.split(":")
                     self._bres["Sbuild-" + s[0]] = s[1].strip()
 
+    @classmethod
+    def _buildlog_has_no_space_left(cls, buildlog):
+        with open(buildlog, encoding=mini_buildd.config.CHAR_ENCODING, errors="replace") as f:
+            return any("No space left on device" in line for line in f)
+
+    def _get_disk_fallback_chroot(self, buildlog):  # pylint: disable=inconsistent-return-statements
+        """Get the disk fallback chroot if the build ran out of space on a build tmpfs (see chroot extra option 'Build-Tmpfs-Size')."""
+        fallback = mini_buildd.misc.schroot_name(self._breq["Base-Distribution"], self.architecture, disk_fallback=True)
+        if self._buildlog_has_no_space_left(buildlog) and mini_buildd.call.Call(["/usr/bin/schroot", "--info", "--chroot", "chroot:" + fallback]).result.returncode == 0:
+            return fallback
+
     def build(self):
         self._breq.untar(path=self._build_dir)
         self._generate_sbuildrc()
@@ -222,13 +288,24 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
             if os.path.exists(live_buildlog):
                 os.remove(live_buildlog)
             os.link(buildlog, live_buildlog)
-            sbuild_call = mini_buildd.call.Call(sbuild_cmd,
-                                                cwd=self._build_dir,
-                                                env=mini_buildd.call.taint_env({"HOME": self._build_dir,
-                                                                                "GNUPGHOME": os.path.join(mini_buildd.config.HOME_DIR, ".gnupg"),
-                                                                                "DEB_BUILD_OPTIONS": self._breq.get("Deb-Build-Options", "")}),
-                                                stdout=buildlog_file, stderr=subprocess.STDOUT)
-            retval = sbuild_call.result.returncode
+
+            def sbuild():
+                return mini_buildd.call.Call(sbuild_cmd,
+                                             cwd=self._build_dir,
+                                             env=mini_buildd.call.taint_env({"HOME": self._build_dir,
+                                                                             "GNUPGHOME": os.path.join(mini_buildd.config.HOME_DIR, ".gnupg"),
+                                                                             "DEB_BUILD_OPTIONS": self._breq.get("Deb-Build-Options", "")}),
+                                             stdout=buildlog_file, stderr=subprocess.STDOUT).result.returncode
+
+            retval = sbuild()
+            fallback = self._get_disk_fallback_chroot(buildlog) if retval != 0 else None
+            if fallback:
+                LOG.warning("{p}: Build ran out of space on tmpfs, retrying on disk: {c}".format(p=self.key, c=fallback))
+                buildlog_file.seek(0, os.SEEK_END)
+                buildlog_file.write("\n*** mini-buildd: Build ran out of space on tmpfs, retrying on disk ({c}) ***\n\n".format(c=fallback))
+                buildlog_file.flush()
+                sbuild_cmd[sbuild_cmd.index("--chroot") + 1] = fallback
+                retval = sbuild()
 
         # Add build results to build request object
         self._bres["Sbuildretval"] = str(retval)
@@ -258,47 +335,11 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
         self._breq.remove()
 
 
-class LastBuild(mini_buildd.misc.API):
-    """Subset of 'Build' for pickled statistics."""
-
-    __API__ = -99
-
-    def __init__(self, build):
-        super().__init__()
-        self.identity = build.__str__()
-        self.status = build.status
-        self.status_desc = build.status_desc
-
-        self.started = build.started
-        self.took = build.took
-        self.package = build.package
-        self.version = build.version
-        self.distribution = build.distribution
-        self.architecture = build.architecture
-        self.uploaded = build.uploaded
-        self.upload_result_to = build.upload_result_to
-        self.live_buildlog_url = build.live_buildlog_url
-
-    def __str__(self):
-        return self.identity
-
-
-def _expire_live_buildlogs(**kwargs):
-    """Expire live buildlogs older than timedelta. Arguments are given as-is to the datetime.timedelta constructor."""
-    valid_until = django.utils.timezone.now() - datetime.timedelta(**kwargs)
-    for buildlog in glob.glob(os.path.join(mini_buildd.config.SPOOL_DIR, "*.buildlog")):
-        LOG.debug("Checking if live build log is older than {d}: {logfile}".format(d=valid_until, logfile=buildlog))
-        if datetime.datetime.fromtimestamp(os.path.getmtime(buildlog), tz=datetime.timezone.utc) < valid_until:
-            LOG.info("Expiring live build log: {logfile}".format(logfile=buildlog))
-            os.unlink(buildlog)
-
-
 def build_close(daemon, build):
     """Close build. Just continue on errors, but log them; guarantee to remove it from the builds dict."""
     try:
         build.clean()
-        daemon.last_builds.appendleft(LastBuild(build))
-        _expire_live_buildlogs(days=5)
+        mini_buildd.models.history.BuildHistory.mbd_add(build)
     except BaseException as e:
         mini_buildd.config.log_exception(LOG, "Error closing build '{p}'".format(p=build.key), e, level=logging.CRITICAL)
     finally:
@@ -310,7 +351,7 @@ def run_build(daemon_, breq):
     build = None
     try:
         # First, get build object. This will automagically set the status right.
-        build = Build(breq, daemon_.model.mbd_gnupg, daemon_.model.sbuild_jobs)
+        build = Build(breq, daemon_.model.mbd_gnupg, daemon_.model.sbuild_jobs, generation=daemon_.state_generation)
         daemon_.builds[build.key] = build
 
         # Authorization
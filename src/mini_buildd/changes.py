@@ -1,4 +1,5 @@
 import os
+import copy
 import stat
 import glob
 import fnmatch
@@ -17,7 +18,7 @@ import mini_buildd.misc
 import mini_buildd.net
 import mini_buildd.gnupg
 
-import mini_buildd.models.repository
+import mini_buildd.models.snapshot
 import mini_buildd.models.gnupg
 
 LOG = logging.getLogger(__name__)
@@ -278,7 +279,7 @@ class Changes(debian.deb822.Changes):  # pylint: disable=too-many-ancestors
         returned.
         """
         try:
-            return mini_buildd.misc.PkgLog.get_path(mini_buildd.misc.Distribution(mini_buildd.models.repository.map_incoming_distribution(self["Distribution"])).repository,
+            return mini_buildd.misc.PkgLog.get_path(mini_buildd.misc.Distribution(mini_buildd.models.snapshot.get().map_meta(self["Distribution"])).repository,
                                                     installed,
                                                     self["Source"],
                                                     self["Version"],
@@ -384,8 +385,9 @@ class Changes(debian.deb822.Changes):  # pylint: disable=too-many-ancestors
         add_remote(mini_buildd.models.gnupg.Remote(http="{proto}:{hopo}".format(proto=mini_buildd.config.HTTPD_ENDPOINTS[0].url_scheme, hopo=local_endpoint.hopo())), True)
 
         # Check all active or auto-deactivated remotes
-        for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate():
-            check_remote(r)
+        for r in mini_buildd.models.snapshot.get().remotes:
+            # Checking saves the remote: Don't modify the shared snapshot object
+            check_remote(copy.copy(r.model))
 
         if not remotes:
             raise Exception("No builder found for {c}/{a}".format(c=codename, a=arch))
@@ -435,22 +437,22 @@ class Changes(debian.deb822.Changes):  # pylint: disable=too-many-ancestors
     def move_to_pkglog(self, installed, rejected=False):
         logdir = None if rejected else self.get_pkglog_dir(installed, relative=False)
 
-        if logdir and not os.path.exists(logdir):
-            os.makedirs(logdir)
-
         LOG.info("Moving changes to package log: '{f}'->'{d}'".format(f=self._file_path, d=logdir))
+        archive = []
         for fd in [{"name": self._file_name}] + self.get_files():
             f = fd["name"]
             f_abs = os.path.join(os.path.dirname(self._file_path), f)
             # If not installed, just move all files to log dir.
             # If installed, only save buildlogs and changes.
             if logdir and (not installed or re.match(r"(.*\.buildlog$|.*changes$)", f)):
-                LOG.info("Moving '{f}' to '{d}'". format(f=f, d=logdir))
-                os.rename(f_abs, os.path.join(logdir, f))
+                archive.append(f_abs)
             else:
                 LOG.info("Removing '{f}'". format(f=f))
                 mini_buildd.misc.skip_if_keep_in_debug(os.remove, f_abs)
 
+        if archive:
+            mini_buildd.misc.PkgLog.archive(logdir, archive)
+
     def remove(self):
         LOG.info("Removing changes: '{f}'".format(f=self._file_path))
         for fd in [{"name": self._file_name}] + self.get_files():
@@ -489,16 +491,17 @@ class Changes(debian.deb822.Changes):  # pylint: disable=too-many-ancestors
             if not in_changes and not from_pool:
                 raise Exception("Missing file '{f}' neither in upload, nor in pool (use '-sa' for uploads with new upstream)".format(f=f["name"]))
 
+        distribution, _rollback_no = mini_buildd.models.snapshot.get().get_distribution(self["Distribution"])
+
         breq_dict = {}
-        for ao in dist.architectureoption_set.all():
-            path = os.path.join(self.get_spool_dir(), ao.architecture.name)
+        for ao in distribution.architectures:
+            path = os.path.join(self.get_spool_dir(), ao.name)
 
             breq = Changes(os.path.join(path,
-                                        self.gen_file_name(ao.architecture.name, self.TYPE_BREQ)))
+                                        self.gen_file_name(ao.name, self.TYPE_BREQ)))
 
             if breq.is_new():
-                distribution = mini_buildd.misc.Distribution(mini_buildd.models.repository.map_incoming_distribution(self["Distribution"]))
-                breq["Distribution"] = distribution.get()
+                breq["Distribution"] = distribution.string
                 for v in ["Source", "Version"]:
                     breq[v] = self[v]
 
@@ -516,7 +519,7 @@ class Changes(debian.deb822.Changes):  # pylint: disable=too-many-ancestors
                     ssl_cert.write(mini_buildd.config.HTTPD_ENDPOINTS[0].get_certificate())
                     css.write(mini_buildd.misc.fromdos(dist.chroot_setup_script))  # Note: For some reason (python, django sqlite, browser?) the text field may be in DOS mode.
                     os.chmod(chroot_setup_script, stat.S_IRWXU)
-                    src.write(dist.mbd_get_sbuildrc_snippet(ao.architecture.name))
+                    src.write(dist.mbd_get_sbuildrc_snippet(ao.name))
 
                 # Generate tar from original changes
                 self.tar(tar_path=breq.file_path + ".tar",
@@ -531,12 +534,12 @@ class Changes(debian.deb822.Changes):  # pylint: disable=too-many-ancestors
 
                 breq["Upload-Result-To"] = daemon.mbd_get_ftp_endpoint().hopo()
                 breq["Base-Distribution"] = dist.base_source.codename
-                breq["Architecture"] = ao.architecture.name
+                breq["Architecture"] = ao.name
                 if ao.build_architecture_all:
                     breq["Arch-All"] = "Yes"
                 breq["Build-Dep-Resolver"] = dist.get_build_dep_resolver_display()
                 breq["Apt-Allow-Unauthenticated"] = "1" if dist.apt_allow_unauthenticated else "0"
-                if dist.lintian_mode != dist.LINTIAN_DISABLED and self.options.get("run-lintian", alt=ao.architecture.name, default=True):
+                if dist.lintian_mode != dist.LINTIAN_DISABLED and self.options.get("run-lintian", alt=ao.name, default=True):
                     # Generate lintian options
                     modeargs = {
                         dist.LINTIAN_DISABLED: "",
@@ -549,7 +552,7 @@ class Changes(debian.deb822.Changes):  # pylint: disable=too-many-ancestors
                 breq.save(daemon.mbd_gnupg)
             else:
                 LOG.info("Re-using existing buildrequest: {b}".format(b=breq.file_name))
-            breq_dict[ao.architecture.name] = breq
+            breq_dict[ao.name] = breq
 
         return breq_dict
 
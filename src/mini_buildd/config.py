@@ -5,6 +5,7 @@ DEBUG = []
 FOREGROUND = False
 
 HTTPD_ENDPOINTS = []
+HTTPD_WSGI_THREADS = 10
 
 #: Global directory paths
 HOME_DIR = None
@@ -26,12 +26,16 @@ import mini_buildd.api
 import mini_buildd.ftpd
 import mini_buildd.packager
 import mini_buildd.builder
+import mini_buildd.maintenance
+import mini_buildd.mailer
 
 import mini_buildd.models.daemon
 import mini_buildd.models.repository
 import mini_buildd.models.chroot
 import mini_buildd.models.gnupg
 import mini_buildd.models.subscription
+import mini_buildd.models.history
+import mini_buildd.models.snapshot
 
 LOG = logging.getLogger(__name__)
 
@@ -311,16 +315,17 @@ class Keyrings():
         # Always add our own key
         if self._our_pub_key:
             remotes.add_pub_key(self._our_pub_key)
-        for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate():
+        for r in mini_buildd.models.snapshot.get().remotes:
             remotes.add_pub_key(r.key)
-            LOG.info("Remote key added for '{r}': {k}: {n}".format(r=r, k=r.key_long_id, n=r.key_name))
+            LOG.info("Remote key added for '{r}': {k}: {n}".format(r=r.model, k=r.model.key_long_id, n=r.model.key_name))
         return remotes
 
     def _gen_uploaders(self):
         """All uploader keyrings for each repository."""
         uploaders = {}
-        for r in mini_buildd.models.repository.Repository.mbd_get_active():
-            uploaders[r.identity] = r.mbd_get_uploader_keyring()
+        snapshot = mini_buildd.models.snapshot.get()
+        for r in snapshot.repositories:
+            uploaders[r.identity] = r.mbd_get_uploader_keyring(snapshot.uploaders)
             # Always add our key too for internal builds
             if self._our_pub_key:
                 uploaders[r.identity].add_pub_key(self._our_pub_key)
@@ -340,6 +345,16 @@ def run():
         name="builder",
         daemon_=get())
 
+    maintenance_thread = mini_buildd.misc.run_as_thread(
+        mini_buildd.maintenance.run,
+        name="maintenance",
+        daemon_=get())
+
+    mailer_thread = mini_buildd.misc.run_as_thread(
+        mini_buildd.mailer.run,
+        name="mailer",
+        daemon_=get())
+
     while True:
         event = get().incoming_queue.get()
         if event == "SHUTDOWN":
@@ -355,10 +370,16 @@ def run():
             if changes.type == changes.TYPE_BREQ:
                 # Build request: builder
 
-                def queue_buildrequest(event):
-                    """Queue in extra thread so we don't block here in case builder is busy."""
-                    get().build_queue.put(event)
-                mini_buildd.misc.run_as_thread(queue_buildrequest, name="build queuer", daemon=True, event=event)
+                def queue_buildrequest(event, breq):
+                    """
+                    Queue in extra thread so we don't block here in case builder is busy.
+
+                    Build requests are admitted in order of their expected
+                    end (queue time plus predicted build time): Shorter
+                    builds first, but long builds don't starve.
+                    """
+                    get().build_queue.put(event, priority=time.time() + (mini_buildd.builder.predict(breq)[0] or 0))
+                mini_buildd.misc.run_as_thread(queue_buildrequest, name="build queuer", daemon=True, event=event, breq=changes)
 
             else:
                 # User upload or build result: packager
@@ -391,8 +412,13 @@ def run():
 
     get().build_queue.put("SHUTDOWN")
     mini_buildd.ftpd.shutdown()
+    mini_buildd.maintenance.shutdown()
     builder_thread.join()
     ftpd_thread.join()
+    maintenance_thread.join()
+    # Last, so notifications of the above are still sent
+    mini_buildd.mailer.shutdown()
+    mailer_thread.join()
 
     # keyrings.close() is not called implicitly; this leaves tmp files around.
     # There should be a nicer way, really...
@@ -420,8 +446,9 @@ class Daemon():
         self.build_queue = None
         self.packages = None
         self.builds = None
-        self.last_packages = None
-        self.last_builds = None
+
+        # Bumped on any change of packages or builds (see get_status_version())
+        self.state_generation = mini_buildd.misc.Generation()
 
     def __str__(self):
         return "{r}: {d}".format(r="UP" if self.is_running() else "DOWN", d=self.model)
@@ -449,31 +476,15 @@ class Daemon():
             self.keyrings.set_needs_update()
         self.incoming_queue = queue.Queue()
         self.build_queue = mini_buildd.misc.BlockQueue(maxsize=self.model.build_queue_size)
-        self.packages = {}
-        self.builds = {}
-        self.last_packages = collections.deque(maxlen=self.model.show_last_packages)
-        self.last_builds = collections.deque(maxlen=self.model.show_last_builds)
+        self.packages = mini_buildd.misc.TrackedDict(self.state_generation)
+        self.builds = mini_buildd.misc.TrackedDict(self.state_generation)
+        self.state_generation.bump()
 
-        # Try to unpickle last_* from persistent storage.
-        # Objects must match API, and we don't care if it fails.
-        try:
-            last_packages, last_builds = self.model.mbd_get_pickled_data()
-            for p in last_packages:
-                if p.api_check():
-                    self.last_packages.append(p)
-                else:
-                    LOG.warning("Removing (new API) from last package info: {p}".format(p=p))
-            for b in last_builds:
-                if b.api_check():
-                    self.last_builds.append(b)
-                else:
-                    LOG.warning("Removing (new API) from last builds info: {b}".format(b=b))
-        except BaseException as e:
-            mini_buildd.config.log_exception(LOG, "Error adding persisted last builds/packages (ignoring)", e, logging.WARN)
-
-    def update_to_model(self):
-        # Save pickled persistent state
-        self.model.mbd_set_pickled_data((self.last_packages, self.last_builds))
+        # Drop pickled last packages/builds from older versions (now in PackageHistory/BuildHistory).
+        if self.model.pickled_data:
+            LOG.info("Dropping obsolete pickled last packages/builds data (superseded by history database).")
+            self.model.pickled_data = ""
+            self.model.save(update_fields=["pickled_data"])
 
     def start(self, force_check=False, msglog=LOG):
         with self.lock:
@@ -482,6 +493,8 @@ class Daemon():
                 msglog.info("Checking daemon (force={f}).".format(f=force_check))
                 mini_buildd.models.daemon.Daemon.Admin.mbd_action(None, (self.model,), "check", force=force_check)
                 if self.model.mbd_is_active():
+                    # Build configuration snapshot now, rather than on first upload
+                    self.get_config()
                     self.thread = mini_buildd.misc.run_as_thread(run, name="packager")
                     msglog.info("Daemon started.")
                 else:
@@ -494,10 +507,6 @@ class Daemon():
     def stop(self, msglog=LOG):
         with self.lock:
             if self.thread:
-                # Save pickled persistend state
-                self.update_to_model()
-                self.model.save(update_fields=["pickled_data"])
-
                 self.incoming_queue.put("SHUTDOWN")
                 self.thread.join()
                 self.thread = None
@@ -515,6 +524,13 @@ class Daemon():
     def is_busy(self):
         return self.lock.locked()
 
+    def get_status_version(self):
+        """Get status version: Changes whenever anything shown in the status changes (cheap, used as ETag)."""
+        return "{s}.{c}.{r:d}.{l}".format(s=self.state_generation.value,
+                                          c=mini_buildd.models.snapshot.CONFIGURATION.version,
+                                          r=self.is_running(),
+                                          l=self.build_queue.load)
+
     def is_running(self):
         return not self.is_busy() and bool(self.thread)
 
@@ -537,15 +553,23 @@ class Daemon():
         with mini_buildd.misc.open_utf8(mini_buildd.config.LOG_FILE) as lf:
             return "".join(collections.deque(lf, lines))
 
+    @property
+    def last_packages(self):
+        return mini_buildd.models.history.PackageHistory.objects.all()[:self.model.show_last_packages]
+
+    @property
+    def last_builds(self):
+        return mini_buildd.models.history.BuildHistory.objects.all()[:self.model.show_last_builds]
+
     def get_last_packages(self):
-        return sorted({p.changes["source"] for p in self.last_packages})
+        return sorted(set(mini_buildd.models.history.PackageHistory.objects.values_list("package", flat=True)[:self.model.show_last_packages]))
 
     def get_last_versions(self, package):
-        return sorted({p.changes["version"] for p in self.last_packages if p.changes["source"] == package})
+        return sorted(set(mini_buildd.models.history.PackageHistory.objects.filter(package=package).values_list("version", flat=True)[:self.model.show_last_packages]))
 
     @classmethod
     def get_active_chroots(cls):
-        return mini_buildd.models.chroot.Chroot.mbd_get_active()
+        return mini_buildd.models.chroot.Chroot.mbd_get_active().select_related("source", "architecture")
 
     @classmethod
     def get_active_repositories(cls):
@@ -557,12 +581,7 @@ class Daemon():
 
     @classmethod
     def get_active_codenames(cls):
-        codenames = []
-        for r in cls.get_active_repositories():
-            for d in r.distributions.all():
-                if d.base_source.codename not in codenames:
-                    codenames.append(d.base_source.codename)
-        return codenames
+        return cls.get_config().codenames
 
     @classmethod
     def get_active_remotes(cls):
@@ -577,17 +596,19 @@ class Daemon():
         return mini_buildd.models.subscription.Subscription.objects
 
     @classmethod
-    def parse_distribution(cls, dist):
-        """Get repository, distribution and suite model objects (plus rollback no) from distribution string."""
-        # Check and parse changes distribution string
-        dist_parsed = mini_buildd.misc.Distribution(mini_buildd.models.repository.map_incoming_distribution(dist))
+    def get_history(cls, typ):
+        return {"packages": mini_buildd.models.history.PackageHistory,
+                "builds": mini_buildd.models.history.BuildHistory}[typ]
 
-        # Get repository for identity; django exceptions will suite quite well as-is
-        repository = mini_buildd.models.repository.Repository.objects.get(identity=dist_parsed.repository)
-        distribution = repository.distributions.all().get(base_source__codename__exact=dist_parsed.codename)
-        suite = repository.layout.suiteoption_set.all().get(suite__name=dist_parsed.suite)
+    @classmethod
+    def get_config(cls):
+        """Get the current configuration snapshot (see ``mini_buildd.models.snapshot``)."""
+        return mini_buildd.models.snapshot.get()
 
-        return repository, distribution, suite, dist_parsed.rollback_no
+    @classmethod
+    def parse_distribution(cls, dist):
+        """Get repository, distribution and suite model objects (plus rollback no) from distribution string."""
+        return cls.get_config().parse(dist)
 
     _DEFAULT_PORT_OPTIONS = ["ignore-lintian=true"]
 
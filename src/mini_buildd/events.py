@@ -0,0 +1,164 @@
+"""
+Event stream: Package, build and repository state changes.
+
+Events are published by the packager (package status changes, like
+BUILDING, INSTALLED or FAILED), the builder (build status changes)
+and repositories (MIGRATED, REMOVED). The HTTP server pushes them to
+clients as server-sent events (see ``/events``), optionally filtered
+by repository, package and distribution (regex).
+
+The latest events are kept, so clients may resume a broken stream
+(via the ``Last-Event-ID`` header, or ``since`` argument).
+"""
+
+import re
+import collections
+import json
+import threading
+import time
+import logging
+
+import mini_buildd.misc
+
+LOG = logging.getLogger(__name__)
+
+# Event types
+PACKAGE = "PACKAGE"
+BUILD = "BUILD"
+REPOSITORY = "REPOSITORY"
+
+
+class Event():
+    """
+    State change event.
+
+    >>> e = Event(1, PACKAGE, "INSTALLED", repository="test", package="mbd-test-cpp", version="1.0", distribution="buster-test-unstable", timestamp=0.0)
+    >>> e.encode()
+    b'id: 1\\nevent: PACKAGE\\ndata: {"id":1,"type":"PACKAGE","status":"INSTALLED","repository":"test","package":"mbd-test-cpp","version":"1.0","distribution":"buster-test-unstable","architecture":"","desc":"","timestamp":0.0}\\n\\n'
+    >>> Event.decode(e.encode().decode("UTF-8").splitlines()[2][6:]) == e.data
+    True
+    """
+
+    def __init__(self, event_id, typ, status, repository="", package="", version="", distribution="", architecture="", desc="", timestamp=None):
+        self.data = collections.OrderedDict([("id", event_id),
+                                             ("type", typ),
+                                             ("status", status),
+                                             ("repository", repository),
+                                             ("package", package),
+                                             ("version", version),
+                                             ("distribution", distribution),
+                                             ("architecture", architecture),
+                                             ("desc", desc),
+                                             ("timestamp", time.time() if timestamp is None else timestamp)])
+
+    def __str__(self):
+        return "{t} {s}: {p}_{v} ({d}{a})".format(t=self.data["type"],
+                                                  s=self.data["status"],
+                                                  p=self.data["package"],
+                                                  v=self.data["version"],
+                                                  d=self.data["distribution"],
+                                                  a="/" + self.data["architecture"] if self.data["architecture"] else "")
+
+    @property
+    def id(self):  # pylint: disable=invalid-name
+        return self.data["id"]
+
+    def encode(self):
+        """Encode as server-sent event."""
+        return "id: {i}\nevent: {t}\ndata: {d}\n\n".format(i=self.id, t=self.data["type"], d=json.dumps(self.data, separators=(",", ":"))).encode("UTF-8")
+
+    @classmethod
+    def decode(cls, data):
+        """Decode data (of a server-sent event) to dict."""
+        return json.loads(data)
+
+
+class Filter():
+    """
+    Event filter (empty values match all).
+
+    >>> e = Event(1, BUILD, "BUILDING", repository="test", package="mbd-test-cpp", distribution="buster-test-unstable", architecture="amd64")
+    >>> Filter().match(e), Filter(package="mbd-test-cpp", distribution="buster-.*").match(e), Filter(repository="other").match(e)
+    (True, True, False)
+    """
+
+    def __init__(self, repository="", package="", distribution=""):
+        self.repository = repository
+        self.package = package
+        self.distribution = re.compile(distribution) if distribution else None
+
+    def match(self, event):
+        return (not self.repository or self.repository == event.data["repository"]) and \
+            (not self.package or self.package == event.data["package"]) and \
+            (not self.distribution or self.distribution.fullmatch(event.data["distribution"]) is not None)
+
+
+class Queue():
+    """
+    Events published, with the latest kept for replay.
+
+    >>> q = Queue(maxlen=2)
+    >>> received = []
+    >>> q.subscribe(received.append)
+    >>> for s in ["CHECKING", "BUILDING", "INSTALLED"]:
+    ...     _e = q.publish(PACKAGE, s, package="p")
+    >>> [e.data["status"] for e in received]
+    ['CHECKING', 'BUILDING', 'INSTALLED']
+    >>> [e.data["status"] for e in q.since(1)]
+    ['BUILDING', 'INSTALLED']
+    >>> [e.data["status"] for e in q.since(2, Filter(package="other"))]
+    []
+    >>> q.unsubscribe(received.append)
+    """
+
+    def __init__(self, maxlen=1000):
+        self._lock = threading.Lock()
+        self._events = collections.deque(maxlen=maxlen)
+        self._last_id = 0
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """Subscribe callback (called with the event in the publisher's thread)."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def publish(self, typ, status, **kwargs):
+        with self._lock:
+            self._last_id += 1
+            event = Event(self._last_id, typ, status, **kwargs)
+            self._events.append(event)
+            subscribers = list(self._subscribers)
+
+        LOG.debug("Event: {e}".format(e=event))
+        for callback in subscribers:
+            try:
+                callback(event)
+            except BaseException as e:
+                LOG.warning("Event subscriber failed (ignoring): {e}".format(e=e))
+        return event
+
+    def since(self, event_id, event_filter=None):
+        """Get kept events after event id."""
+        with self._lock:
+            return [e for e in self._events if e.id > event_id and (event_filter is None or event_filter.match(e))]
+
+
+QUEUE = Queue()
+
+
+def publish(typ, status, **kwargs):
+    """Publish event (never fails, so it's safe to call anywhere). Repository defaults to the distribution's."""
+    try:
+        if not kwargs.get("repository") and kwargs.get("distribution"):
+            try:
+                kwargs["repository"] = mini_buildd.misc.Distribution(kwargs["distribution"]).repository
+            except BaseException:
+                pass
+        return QUEUE.publish(typ, status, **kwargs)
+    except BaseException as e:
+        LOG.warning("Event publishing failed (ignoring): {e}".format(e=e))
+        return None
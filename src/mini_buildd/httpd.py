@@ -1,4 +1,7 @@
+import os
+import re
 import abc
+import time
 import logging
 
 import mini_buildd.misc
@@ -6,6 +9,143 @@ import mini_buildd.config
 
 LOG = logging.getLogger(__name__)
 
+LIVE_BUILDLOGS_404 = """\
+This live buildlog is not yet (or no longer) available.
+
+Please just retry later if this build is currently pending.
+"""
+
+# Live buildlogs: Read chunk size, poll interval and maximum duration (seconds) of one follow request
+LIVE_BUILDLOGS_CHUNK = 64 * 1024
+LIVE_BUILDLOGS_POLL = 1.0
+LIVE_BUILDLOGS_FOLLOW_MAX = 300
+
+
+def parse_range(value, size):
+    """
+    Parse a (single) HTTP byte range to (first, last) byte positions, or None if there is no valid range.
+
+    >>> parse_range("bytes=0-99", 1000)
+    (0, 99)
+    >>> parse_range("bytes=900-", 1000)
+    (900, 999)
+    >>> parse_range("bytes=900-2000", 1000)
+    (900, 999)
+    >>> parse_range("bytes=-100", 1000)
+    (900, 999)
+    >>> parse_range("bytes=0-1,5-6", 1000)
+    >>> parse_range("bytes=99-0", 1000)
+    >>> parse_range("", 1000)
+    >>> parse_range("bytes=1000-", 1000)
+    Traceback (most recent call last):
+    ...
+    ValueError: Range not satisfiable: bytes=1000-
+    """
+    match = re.match(r"^bytes=(\d*)-(\d*)$", value.strip())
+    if match is None or not (match.group(1) or match.group(2)):
+        return None
+
+    if match.group(1):
+        first = int(match.group(1))
+        last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        if match.group(2) and int(match.group(2)) < first:
+            return None
+    else:
+        first, last = max(0, size - int(match.group(2))), size - 1
+
+    if first >= size:
+        raise ValueError("Range not satisfiable: {v}".format(v=value))
+    return first, last
+
+
+def sse_event(data, event_id, event=None):
+    """
+    Server-sent event.
+
+    >>> sse_event(b"line 1\\nline 2\\n", 14)
+    b'id: 14\\ndata: line 1\\ndata: line 2\\n\\n'
+    >>> sse_event(b"", 14, event="eof")
+    b'id: 14\\nevent: eof\\ndata: \\n\\n'
+    """
+    lines = ["id: {i}".format(i=event_id)]
+    if event:
+        lines.append("event: {e}".format(e=event))
+    lines += ["data: {d}".format(d=d) for d in data.decode(mini_buildd.config.CHAR_ENCODING, errors="replace").rstrip("\n").split("\n")]
+    return ("\n".join(lines) + "\n\n").encode(mini_buildd.config.CHAR_ENCODING)
+
+
+def live_buildlog_path(logfile):
+    """Get path of a live buildlog (like 'mbd-test-cpp_1.0_amd64.buildlog'), or None if it does not exist."""
+    buildlog = os.path.join(mini_buildd.config.SPOOL_DIR, logfile)
+    return buildlog if os.path.basename(logfile) == logfile and os.path.exists(buildlog) else None
+
+
+def live_buildlog_is_open(logfile):
+    """Check if the build writing to this live buildlog is still running."""
+    import mini_buildd.daemon  # Note: Import here: We cannot import anything 'django' prior to django's configuration.
+    return any(b.live_buildlog_url.endswith("/" + logfile) for b in list((mini_buildd.daemon.get().builds or {}).values()))
+
+
+class LiveBuildlogFollower():
+    """
+    Non-blocking reader of a growing live buildlog (from offset), until the build is finished (or LIVE_BUILDLOGS_FOLLOW_MAX is reached).
+
+    In sse mode, only complete lines are returned, with the byte offset as event id; an 'eof' event marks the end of the build.
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> _ = f.write(b"line 1\\nline"), f.flush()
+    >>> follower = LiveBuildlogFollower(f.name, "mbd-test.buildlog", 0, True, is_open=lambda logfile: True)
+    >>> follower.read(), follower.read(), follower.finished
+    (b'id: 7\\ndata: line 1\\n\\n', None, False)
+    >>> _ = f.write(b" 2"), f.flush()
+    >>> follower.is_open = lambda logfile: False
+    >>> follower.read(), follower.read(), follower.finished
+    (b'', b'id: 13\\ndata: line 2\\n\\nid: 13\\nevent: eof\\ndata: \\n\\n', True)
+    """
+
+    def __init__(self, buildlog, logfile, offset, sse, is_open=live_buildlog_is_open):
+        self.logfile = logfile
+        self.offset = offset
+        self.sse = sse
+        self.is_open = is_open
+        self.finished = False
+        self._deadline = time.monotonic() + LIVE_BUILDLOGS_FOLLOW_MAX
+        self._pending = b""
+        self._file = open(buildlog, "rb")
+        self._file.seek(offset)
+
+    def close(self):
+        self._file.close()
+
+    def read(self):
+        """Read next chunk: Returns bytes (may be empty; call again right away), or None if there is no new data yet (poll later). Check 'finished' after each call."""
+        # Check for running build before reading, so we won't miss any data written after the check
+        running = self.is_open(self.logfile)
+        data = self._file.read(LIVE_BUILDLOGS_CHUNK)
+        if data:
+            if self.sse:
+                complete, newline, self._pending = (self._pending + data).rpartition(b"\n")
+                if newline:
+                    self.offset += len(complete) + 1
+                    return sse_event(complete, self.offset)
+                return b""
+            self.offset += len(data)
+            return data
+
+        if running and time.monotonic() <= self._deadline:
+            return None
+
+        self.finished = True
+        self.close()
+        data = b""
+        if self.sse and not running:
+            if self._pending:
+                self.offset += len(self._pending)
+                data += sse_event(self._pending, self.offset)
+            data += sse_event(b"", self.offset, event="eof")
+        return data
+
 
 class HttpD(metaclass=abc.ABCMeta):
     DOC_MISSING_HTML = """\
@@ -20,6 +160,10 @@ Package <b><tt>mini-buildd-doc</tt></b> is not installed on this site (might be
     def _add_route(self, route, directory, with_index=False, uri_regex=r".*", with_doc_missing_error=False):
         """Serve static files from a directory."""
 
+    @abc.abstractmethod
+    def _add_events_route(self, route):
+        """Serve the event stream (see ``mini_buildd.events``)."""
+
     def __init__(self):
         self._debug = "http" in mini_buildd.config.DEBUG
         self._foreground = mini_buildd.config.FOREGROUND
@@ -37,6 +181,7 @@ Package <b><tt>mini-buildd-doc</tt></b> is not installed on this site (might be
         self._add_route("doc", mini_buildd.config.MANUAL_DIR, with_doc_missing_error=True)                                                     # HTML manual
         self._add_route("repositories", mini_buildd.config.REPOSITORIES_DIR, with_index=True, uri_regex=r"^/repositories/.+/(pool|dists)/.*")  # Repositories
         self._add_route("log", mini_buildd.config.LOG_DIR, with_index=True, uri_regex=r"^/log/.+/.*")                                          # Logs
+        self._add_events_route("events")                                                                                                      # Event stream
 
     @abc.abstractmethod
     def run(self):
@@ -1,16 +1,26 @@
 import re
 import os.path
+import time
+import urllib.parse
+import threading
 import logging
 
 import twisted.internet.reactor
 import twisted.internet.endpoints
+import twisted.internet.task
+import twisted.web.server
+import twisted.web.http
 import twisted.web.wsgi
 import twisted.web.static
 import twisted.web.resource
 import twisted.logger
 import twisted.python.logfile
+import twisted.python.threadpool
+import zope.interface
 
 import mini_buildd.misc
+import mini_buildd.events
+import mini_buildd.schema
 import mini_buildd.httpd
 
 LOG = logging.getLogger(__name__)
@@ -21,39 +31,331 @@ class Site(twisted.web.server.Site):
         return twisted.python.logfile.LogFile(os.path.basename(path), directory=os.path.dirname(path), rotateLength=5000000, maxRotatedFiles=9)
 
 
+class WsgiThreadPool(twisted.python.threadpool.ThreadPool):
+    """
+    Dedicated, instrumented thread pool for the WSGI app (size configurable via ``--httpd-threads``).
+
+    Counts calls, and calls that had to wait for a free thread; a
+    summary is logged every ``REPORT_SECONDS`` (as warning if calls
+    had to wait, i.e., the pool is saturated).
+    """
+
+    REPORT_SECONDS = 300
+
+    def __init__(self, threads):
+        super().__init__(minthreads=0, maxthreads=threads, name="wsgi")
+        self._stats_lock = threading.Lock()
+        self._stats = self._new_stats()
+
+    @classmethod
+    def _new_stats(cls):
+        return {"calls": 0, "waited": 0, "max_wait": 0.0, "max_backlog": 0}
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):  # noqa (pep8 N802,N803)
+        queued = time.monotonic()
+        backlog = self.q.qsize()
+        saturated = len(self.working) + backlog >= self.max
+
+        def timed(*args, **kw):
+            wait = time.monotonic() - queued
+            with self._stats_lock:
+                self._stats["max_wait"] = max(self._stats["max_wait"], wait)
+            return func(*args, **kw)
+
+        with self._stats_lock:
+            self._stats["calls"] += 1
+            if saturated:
+                self._stats["waited"] += 1
+                self._stats["max_backlog"] = max(self._stats["max_backlog"], backlog + 1)
+        super().callInThreadWithCallback(onResult, timed, *args, **kw)
+
+    def statistics(self):
+        """Get current and accumulated (since the last report) statistics."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({"threads": self.max, "busy": len(self.working), "backlog": self.q.qsize()})
+        return stats
+
+    def report(self):
+        with self._stats_lock:
+            stats, self._stats = self._stats, self._new_stats()
+        msg = "WSGI thread pool: {c} calls, {w} had to wait (max wait {m:.2f}s, max backlog {b}); {busy}/{t} threads busy.".format(
+            c=stats["calls"], w=stats["waited"], m=stats["max_wait"], b=stats["max_backlog"], busy=len(self.working), t=self.max)
+        if stats["waited"]:
+            LOG.warning("{m} Consider raising '--httpd-threads'.".format(m=msg))
+        else:
+            LOG.debug(msg)
+
+
 class RootResource(twisted.web.resource.Resource):
-    """Twisted root resource needed to mix static and wsgi resources."""
+    """Twisted root resource needed to mix native (static) and wsgi resources."""
 
     def __init__(self, wsgi_resource):
         super().__init__()
         self._wsgi_resource = wsgi_resource
 
-    def getChild(self, path, request):  # noqa (pep8 N802)
-        request.prepath.pop()
-        request.postpath.insert(0, path)
+    def _wsgi(self, request):
+        """Hand over the full path to the WSGI app."""
+        request.postpath = request.prepath + request.postpath
+        request.prepath = []
         return self._wsgi_resource
 
+    def getChild(self, path, request):  # noqa (pep8 N802)
+        return self._wsgi(request)
+
+    def render(self, request):
+        return self._wsgi(request).render(request)
+
 
 class FileResource(twisted.web.static.File):
-    """Twisted static resource enhanced with switchable index and regex matching support."""
+    """
+    Twisted static resource enhanced with switchable index and regex matching support.
+
+    The (precompiled) URI regex is only checked once per request, when
+    leaving the route's resource (children don't check again).
+
+    Files are served with 'Last-Modified' and 'ETag' (conditional
+    requests via 'If-Modified-Since' or 'If-None-Match'), and support
+    (single or multiple) byte ranges.
+    """
+
+    # Read chunk size of file producers (twisted's default is 64KiB)
+    BUFFER_SIZE = 256 * 1024
 
     def __init__(self, *args, with_index=False, uri_regex=".*", **kwargs):
         super().__init__(*args, **kwargs)
         self.mbd_with_index = with_index
-        self.mbd_uri_regex = re.compile(uri_regex)
+        self.mbd_uri_regex = re.compile(uri_regex) if isinstance(uri_regex, str) else uri_regex
 
     def directoryListing(self):  # noqa (pep8 N802)
         if not self.mbd_with_index:
             return self.forbidden
         return super().directoryListing()
 
+    def createSimilarFile(self, path):  # noqa (pep8 N802)
+        child = self.__class__(path, self.defaultType, self.ignoredExts, self.registry, with_index=self.mbd_with_index, uri_regex=None)
+        child.processors = self.processors
+        child.indexNames = self.indexNames[:]
+        child.childNotFound = self.childNotFound
+        return child
+
     def getChild(self, path, request):  # noqa (pep8 N802)
-        if not self.mbd_uri_regex.match(request.uri.decode("utf-8")):
+        if self.mbd_uri_regex is not None and not self.mbd_uri_regex.match(request.uri.decode("utf-8")):
             return self.forbidden
-        child = super().getChild(path, request)
-        child.mbd_with_index = self.mbd_with_index
-        child.mbd_uri_regex = self.mbd_uri_regex
-        return child
+        return super().getChild(path, request)
+
+    def etag(self):
+        """Entity tag for a file (changes whenever the file is replaced or modified)."""
+        return '"{i:x}-{s:x}-{m:x}"'.format(i=self.getInodeNumber(), s=self.getsize(), m=int(self.getModificationTime() * 1000000)).encode("utf-8")
+
+    def render_GET(self, request):  # noqa (pep8 N802)
+        self.restat(False)
+        if self.isfile():
+            if request.setETag(self.etag()) is twisted.web.http.CACHED:
+                return b""
+            # RFC 7232, 3.3: 'If-Modified-Since' must be ignored if 'If-None-Match' is given (and it did not match)
+            if request.getHeader("If-None-Match"):
+                request.requestHeaders.removeHeader(b"If-Modified-Since")
+        return super().render_GET(request)
+
+    render_HEAD = render_GET
+
+    def makeProducer(self, request, fileForReading):  # noqa (pep8 N802,N803)
+        producer = super().makeProducer(request, fileForReading)
+        producer.bufferSize = self.BUFFER_SIZE
+        return producer
+
+
+class EventsResource(twisted.web.resource.Resource):
+    """
+    Server-sent events stream (see ``mini_buildd.events``).
+
+    Arguments ``repository``, ``package`` and ``distribution`` (regex) filter
+    events; ``since`` (or header ``Last-Event-ID``) replays kept events after that id.
+    """
+
+    isLeaf = True
+    KEEPALIVE_SECONDS = 30
+
+    def render_GET(self, request):  # noqa (pep8 N802)
+        def arg(name):
+            return request.args.get(name.encode("utf-8"), [b""])[0].decode("utf-8")
+
+        event_filter = mini_buildd.events.Filter(repository=arg("repository"), package=arg("package"), distribution=arg("distribution"))
+        since = (request.getHeader("Last-Event-ID") or arg("since")).strip()
+        state = {"open": True, "last_id": int(since) if since.isdigit() else 0}
+
+        def write(event):
+            # Events may have been queued (callFromThread) before the replay wrote them already
+            if state["open"] and event.id > state["last_id"] and event_filter.match(event):
+                state["last_id"] = event.id
+                request.write(event.encode())
+
+        def on_event(event):
+            # Called in the publisher's thread
+            twisted.internet.reactor.callFromThread(write, event)
+
+        def keepalive():
+            if state["open"]:
+                request.write(b": keepalive\n\n")
+
+        request.setHeader("Content-Type", "text/event-stream; charset=utf-8")
+        request.setHeader("Cache-Control", "no-cache")
+        request.write(b": mini-buildd events\n\n")
+
+        mini_buildd.events.QUEUE.subscribe(on_event)
+        if since.isdigit():
+            for event in mini_buildd.events.QUEUE.since(int(since), event_filter):
+                request.write(event.encode())
+                state["last_id"] = event.id
+
+        keepalive_call = twisted.internet.task.LoopingCall(keepalive)
+        keepalive_call.start(self.KEEPALIVE_SECONDS, now=False)
+
+        def finished(_result):
+            state["open"] = False
+            mini_buildd.events.QUEUE.unsubscribe(on_event)
+            keepalive_call.stop()
+
+        request.notifyFinish().addBoth(finished)
+        return twisted.web.server.NOT_DONE_YET
+
+
+@zope.interface.implementer(twisted.web.resource._IEncodingResource)  # pylint: disable=protected-access
+class LiveBuildlogsResource(twisted.web.resource.Resource):
+    """
+    Live buildlogs, served natively (no WSGI thread is occupied; see ``mini_buildd.views.live_buildlogs`` for the API).
+
+    Plain requests are served as static file (with 'Range' support, and
+    gzip transfer for non-range requests); follow requests poll the
+    growing buildlog via the reactor.
+    """
+
+    isLeaf = True
+    # Maximum chunks written per reactor call (so catching up on a large buildlog won't block the reactor)
+    FOLLOW_CHUNKS_PER_CALL = 16
+
+    def __init__(self, mime_text_plain):
+        super().__init__()
+        self._mime_text_plain = mime_text_plain
+        self._gzip = twisted.web.server.GzipEncoderFactory()
+
+    @classmethod
+    def _args(cls, request):
+        # Note: twisted's request.args drops args without value (like '?follow')
+        return {k: v[-1] for k, v in urllib.parse.parse_qs(urllib.parse.urlsplit(request.uri.decode("utf-8")).query, keep_blank_values=True).items()}
+
+    @classmethod
+    def _is_follow(cls, request):
+        """Return None (no follow request), or if it's sse."""
+        args = cls._args(request)
+        sse = args.get("follow") == "sse" or "text/event-stream" in (request.getHeader("Accept") or "")
+        return sse if sse or "follow" in args else None
+
+    def getEncoder(self, request):  # noqa (pep8 N802)
+        """Gzip transfer for plain (non-range) requests (called by twisted prior to rendering)."""
+        if request.getHeader("Range") or self._is_follow(request) is not None:
+            return None
+        return self._gzip.encoderForRequest(request)
+
+    def render_GET(self, request):  # noqa (pep8 N802)
+        logfile = b"/".join(request.postpath).decode("utf-8")
+        buildlog = mini_buildd.httpd.live_buildlog_path(logfile) if logfile.endswith(".buildlog") else None
+        if buildlog is None:
+            request.setHeader("Content-Type", self._mime_text_plain)
+            return mini_buildd.httpd.LIVE_BUILDLOGS_404.encode("utf-8")
+
+        request.setHeader("Vary", "Accept-Encoding")
+        sse = self._is_follow(request)
+        if sse is None:
+            return twisted.web.static.File(buildlog, defaultType=self._mime_text_plain).render(request)
+
+        try:
+            follower = mini_buildd.httpd.LiveBuildlogFollower(buildlog, logfile, int(self._args(request).get("offset", request.getHeader("Last-Event-ID") or "0")), sse)
+        except ValueError:
+            request.setResponseCode(400)
+            request.setHeader("Content-Type", self._mime_text_plain)
+            return b"Invalid offset"
+
+        request.setHeader("Content-Type", "text/event-stream; charset=utf-8" if sse else self._mime_text_plain)
+        request.setHeader("Cache-Control", "no-cache")
+        state = {"call": None}
+
+        def pump():
+            state["call"] = None
+            for _ in range(self.FOLLOW_CHUNKS_PER_CALL):
+                data = follower.read()
+                if data:
+                    request.write(data)
+                if follower.finished:
+                    request.finish()
+                    return
+                if data is None:
+                    state["call"] = twisted.internet.reactor.callLater(mini_buildd.httpd.LIVE_BUILDLOGS_POLL, pump)
+                    return
+            state["call"] = twisted.internet.reactor.callLater(0, pump)
+
+        def finished(_result):
+            if state["call"] is not None:
+                state["call"].cancel()
+                state["call"] = None
+            follower.close()
+
+        request.notifyFinish().addBoth(finished)
+        pump()
+        return twisted.web.server.NOT_DONE_YET
+
+
+class ApiResource(RootResource):
+    """
+    API calls: Status calls (non-html output) are answered natively if possible, all else is handed over to the WSGI app.
+
+    The status is served from the cache of the last computed
+    status (see ``mini_buildd.api.Status.get_cached()``), and 'not
+    modified' answers (conditional GET via ETag) don't need that
+    either; only if the status changed, the WSGI app computes it.
+    """
+
+    isLeaf = True
+    NATIVE_STATUS_OUTPUTS = ["plain", "json", "msgpack"]
+
+    def __init__(self, wsgi_resource, mime_text_plain):
+        super().__init__(wsgi_resource)
+        self._mime_text_plain = mime_text_plain
+
+    def _render_status(self, request):
+        """Render status natively; returns None if we can't."""
+        args = {k.decode("utf-8"): v[-1].decode("utf-8") for k, v in request.args.items()}
+        if request.method != b"GET" or args.get("command") != "status" or args.get("output") not in self.NATIVE_STATUS_OUTPUTS:
+            return None
+
+        import mini_buildd.daemon  # Note: Import here: We cannot import anything 'django' prior to django's configuration.
+        import mini_buildd.api
+        version = mini_buildd.daemon.get().get_status_version()
+        etag = '"{e}-{o}"'.format(e=version, o=args["output"])
+        not_modified = etag in (request.getHeader("If-None-Match") or "")
+        status = None if not_modified else mini_buildd.api.Status.get_cached(version)
+        if not not_modified and status is None:
+            return None
+
+        request.setHeader("ETag", etag)
+        request.setHeader(mini_buildd.schema.SCHEMA_HEADER, mini_buildd.api.get_schema()["fingerprint"])
+        if not_modified:
+            request.setResponseCode(304)
+            return b""
+        if args["output"] == "plain":
+            request.setHeader("Content-Type", self._mime_text_plain)
+            return status.__str__().encode(mini_buildd.config.CHAR_ENCODING)
+        request.setHeader("Content-Type", mini_buildd.api.STRUCTURED_OUTPUTS[args["output"]])
+        return mini_buildd.api.encode(status, args["output"])
+
+    def render(self, request):
+        try:
+            result = self._render_status(request)
+        except BaseException as e:
+            LOG.debug("Native status not available (handing over to WSGI): {e}".format(e=e))
+            result = None
+        return super().render(request) if result is None else result
 
 
 class HttpD(mini_buildd.httpd.HttpD):
@@ -67,14 +369,25 @@ class HttpD(mini_buildd.httpd.HttpD):
             static.contentTypes[".{}".format(k)] = v
         self.resource.putChild(bytes(route, encoding=self._char_encoding), static)
 
+    def _add_events_route(self, route):
+        self.resource.putChild(bytes(route, encoding=self._char_encoding), EventsResource())
+
     def __init__(self, wsgi_app):
         super().__init__()
 
         # Bend twisted (not access.log) logging to ours
         twisted.logger.globalLogPublisher.addObserver(twisted.logger.STDLibLogObserver(name=__name__))
 
-        # HTTP setup
-        self.resource = RootResource(twisted.web.wsgi.WSGIResource(twisted.internet.reactor, twisted.internet.reactor.getThreadPool(), wsgi_app))
+        # WSGI app on a dedicated thread pool
+        self.wsgi_pool = WsgiThreadPool(mini_buildd.config.HTTPD_WSGI_THREADS)
+        wsgi_resource = twisted.web.wsgi.WSGIResource(twisted.internet.reactor, self.wsgi_pool, wsgi_app)
+
+        # HTTP setup: Hot read-only resources are served natively (not via the WSGI thread pool)
+        self.resource = RootResource(wsgi_resource)
+        mini_buildd_resource = RootResource(wsgi_resource)
+        mini_buildd_resource.putChild(b"live-buildlogs", LiveBuildlogsResource(self._mime_text_plain))
+        mini_buildd_resource.putChild(b"api", ApiResource(wsgi_resource, self._mime_text_plain))
+        self.resource.putChild(b"mini_buildd", mini_buildd_resource)
         self.site = Site(self.resource, logPath=mini_buildd.config.ACCESS_LOG_FILE)
 
         for ep in self._endpoints:
@@ -84,4 +397,7 @@ class HttpD(mini_buildd.httpd.HttpD):
         self._add_routes()
 
     def run(self):
+        self.wsgi_pool.start()
+        twisted.internet.reactor.addSystemEventTrigger("during", "shutdown", self.wsgi_pool.stop)
+        twisted.internet.task.LoopingCall(self.wsgi_pool.report).start(self.wsgi_pool.REPORT_SECONDS, now=False)
         twisted.internet.reactor.run(installSignalHandlers=0)
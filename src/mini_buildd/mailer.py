@@ -0,0 +1,220 @@
+"""
+Background notification mailer, run by the daemon.
+
+Notifications are queued via ``send()``, so a slow or dead SMTP
+server does not stall package processing. Queued mails are:
+
+* Coalesced: Mails to the same recipient within
+  ``Mail-Digest-Interval`` (daemon extra option, in minutes; default 1,
+  0 to send immediately) are sent as one digest mail.
+* Batched: All due mails are sent via one SMTP connection.
+* Retried: Failed mails are retried with exponential backoff (30
+  seconds doubling up to one hour), at most ``Mail-Retry-Max`` (default
+  8) times.
+
+When the mailer is not running (i.e., daemon is stopped), mails are
+sent synchronously.
+"""
+
+import time
+import email.utils
+import threading
+import logging
+
+import django.core.mail
+
+import mini_buildd.config
+
+LOG = logging.getLogger(__name__)
+
+_SHUTDOWN = threading.Event()
+
+RETRY_BACKOFF_MIN = 30
+RETRY_BACKOFF_MAX = 3600
+
+
+def retry_backoff(attempts):
+    """
+    Get seconds to wait before the next retry.
+
+    >>> [retry_backoff(a) for a in range(1, 10)]
+    [30, 60, 120, 240, 480, 960, 1920, 3600, 3600]
+    """
+    return min(RETRY_BACKOFF_MIN * 2 ** (attempts - 1), RETRY_BACKOFF_MAX)
+
+
+class Digest():
+    """
+    Pending mails to one recipient.
+
+    >>> d = Digest("me@example.com", "Ich <mbd@example.com>", due=0)
+    >>> d.add("[mbd] one", "Body one")
+    >>> d.message().subject
+    '[mbd] one'
+    >>> d.add("[mbd] two", "Body two")
+    >>> m = d.message()
+    >>> m.subject
+    '[mbd] Digest: 2 notifications'
+    >>> m.to
+    ['me@example.com']
+    >>> print(m.body)
+    * [mbd] one
+    * [mbd] two
+    <BLANKLINE>
+    ================================================================================
+    [mbd] one
+    ================================================================================
+    Body one
+    ================================================================================
+    [mbd] two
+    ================================================================================
+    Body two
+    """
+
+    def __init__(self, recipient, from_email, due):
+        self.recipient = recipient
+        self.from_email = from_email
+        self.due = due
+        self.attempts = 0
+        self.mails = []
+
+    def __str__(self):
+        return "{r} ({n} mails, {a} attempts)".format(r=self.recipient, n=len(self.mails), a=self.attempts)
+
+    def add(self, subject, body):
+        self.mails.append((subject, body))
+
+    def message(self):
+        if len(self.mails) == 1:
+            subject, body = self.mails[0]
+        else:
+            prefix, _sep, _subject = self.mails[0][0].partition("] ")
+            subject = "{p}] Digest: {n} notifications".format(p=prefix, n=len(self.mails))
+            sep = "=" * 80
+            body = "\n".join(["* {s}".format(s=s) for s, _b in self.mails]) + "\n\n" + "\n".join(["{sep}\n{s}\n{sep}\n{b}".format(sep=sep, s=s, b=b) for s, b in self.mails])
+        return django.core.mail.EmailMessage(subject, body, self.from_email, [self.recipient])
+
+
+class Mailer():
+    def __init__(self, digest_interval, retry_max):
+        self.digest_interval = digest_interval
+        self.retry_max = retry_max
+        self.running = False
+        # Pending: {raw recipient address: Digest}
+        self._pending = {}
+        self._changed = threading.Condition()
+
+    def __str__(self):
+        with self._changed:
+            return "Mailer: {n} pending digests".format(n=len(self._pending))
+
+    def queue(self, messages):
+        """Queue messages; returns False if not running (nothing queued)."""
+        with self._changed:
+            if not self.running:
+                return False
+            for subject, body, from_email, recipients in messages:
+                for recipient in recipients:
+                    key = email.utils.parseaddr(recipient)[1]
+                    if key not in self._pending:
+                        self._pending[key] = Digest(recipient, from_email, time.time() + self.digest_interval)
+                    self._pending[key].add(subject, body)
+            self._changed.notify_all()
+            return True
+
+    def wake(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def _pop_due(self, flush=False):
+        with self._changed:
+            now = time.time()
+            due = [d for d in self._pending.values() if flush or d.due <= now]
+            for d in due:
+                del self._pending[email.utils.parseaddr(d.recipient)[1]]
+            return due
+
+    def _requeue(self, digest):
+        """Requeue failed digest (merging with mails queued meanwhile). Returns False if retries are exhausted."""
+        digest.attempts += 1
+        if digest.attempts >= self.retry_max:
+            return False
+        with self._changed:
+            key = email.utils.parseaddr(digest.recipient)[1]
+            newer = self._pending.get(key)
+            if newer:
+                digest.mails += newer.mails
+            digest.due = time.time() + retry_backoff(digest.attempts)
+            self._pending[key] = digest
+        return True
+
+    def send_due(self, flush=False):
+        """Send due (all, if flush) digests via one SMTP connection."""
+        digests = self._pop_due(flush=flush)
+        if not digests:
+            return
+
+        try:
+            with django.core.mail.get_connection(fail_silently=False) as connection:
+                while digests:
+                    digest = digests.pop(0)
+                    try:
+                        connection.send_messages([digest.message()])
+                        LOG.info("Mailer: Sent to {d}.".format(d=digest))
+                    except BaseException as e:
+                        self._send_failed(digest, e, flush)
+        except BaseException as e:
+            # Connection failed: Retry all not yet tried
+            for digest in digests:
+                self._send_failed(digest, e, flush)
+
+    def _send_failed(self, digest, exception, flush):
+        if not flush and self._requeue(digest):
+            mini_buildd.config.log_exception(LOG, "Mailer: Sending to {d} failed (retry in {s} seconds)".format(d=digest, s=retry_backoff(digest.attempts)), exception, logging.WARNING)
+        else:
+            mini_buildd.config.log_exception(LOG, "Mailer: Sending to {d} failed (giving up): {s}".format(d=digest, s=[s for s, _b in digest.mails]), exception)
+
+    def next_due(self):
+        with self._changed:
+            return min([d.due for d in self._pending.values()], default=None)
+
+    def run(self):
+        with self._changed:
+            self.running = True
+        try:
+            while not _SHUTDOWN.is_set():
+                self.send_due()
+                with self._changed:
+                    due = self.next_due()
+                    if not _SHUTDOWN.is_set():
+                        self._changed.wait(timeout=None if due is None else max(0.0, due - time.time()))
+        finally:
+            with self._changed:
+                self.running = False
+            # Try to send all pending mails before exiting
+            self.send_due(flush=True)
+
+
+_MAILER = None
+
+
+def send(messages):
+    """Send messages (list of tuples like for ``django.core.mail.send_mass_mail``) via the mailer, or synchronously if the mailer is not running."""
+    mailer = _MAILER
+    if not (mailer and mailer.queue(messages)):
+        django.core.mail.send_mass_mail(messages)
+
+
+def run(daemon_):
+    global _MAILER  # pylint: disable=global-statement
+    _SHUTDOWN.clear()
+    _MAILER = Mailer(digest_interval=int(daemon_.model.mbd_get_extra_option("Mail-Digest-Interval", "1")) * 60,
+                     retry_max=int(daemon_.model.mbd_get_extra_option("Mail-Retry-Max", "8")))
+    _MAILER.run()
+
+
+def shutdown():
+    _SHUTDOWN.set()
+    mailer = _MAILER
+    if mailer:
+        mailer.wake()
@@ -0,0 +1,263 @@
+"""
+Background maintenance tasks, run periodically by the daemon.
+
+Each task has an interval configurable via the daemon's extra
+options (in minutes; 0 disables the task):
+
+``Chroot-Maintenance-Interval`` (default 30)
+  Refresh (i.e., run the check with apt upgrades on) source chroots:
+
+  * Only when the daemon is idle (no packages in progress, no builds).
+  * Staggered: At most one chroot is refreshed per run.
+  * Only chroots whose base source's Release has changed since their last refresh.
+
+``Archive-Probe-Interval`` (default 15)
+  Probe all archives for latency and throughput (see ``Archive.mbd_probe``),
+  so the fastest archive is used for debootstrap and builds.
+
+``Log-Purge-Interval`` (default 10)
+  Purge orphaned package logs of packages changed (installed,
+  migrated or removed) since the last purge.
+
+``Log-Purge-Full-Interval`` (default 1440)
+  Check all package logs for orphans (one bulk query per repository).
+
+``Hung-Build-Check-Interval`` (default 5)
+  Warn (log and notify) about builds exceeding their predicted build
+  time by far (see ``Build.hung``), as these are probably hung.
+
+``Janitor-Interval`` (default 60)
+  Remove cruft (see ``janitor()``), and log a report of what was removed.
+"""
+
+import os
+import glob
+import shutil
+import time
+import datetime
+import threading
+import logging
+
+import django.db
+import django.utils.timezone
+
+import mini_buildd.config
+import mini_buildd.misc
+
+import mini_buildd.models.base
+import mini_buildd.models.source
+import mini_buildd.models.chroot
+import mini_buildd.models.repository
+import mini_buildd.models.history
+
+LOG = logging.getLogger(__name__)
+
+_SHUTDOWN = threading.Event()
+
+
+def is_idle(daemon_):
+    return not daemon_.packages and not daemon_.builds and daemon_.build_queue.load == 0 and daemon_.incoming_queue.empty()
+
+
+def _get_due_chroots():
+    """Get active chroots whose Release has changed since the last refresh (least recently attempted first), with the new Release hash."""
+    due = []
+    for c in mini_buildd.models.chroot.Chroot.mbd_get_active():
+        try:
+            release_hash = c.mbd_get_release_hash()
+            maintenance = c.mbd_get_maintenance_data()
+            if release_hash == maintenance.get("release_hash"):
+                LOG.debug("Maintenance: {c}: Release unchanged (skipping).".format(c=c))
+            else:
+                due.append((maintenance.get("attempted", mini_buildd.models.base.StatusModel.CHECK_NONE), c, release_hash))
+        except BaseException as e:
+            mini_buildd.config.log_exception(LOG, "Maintenance: {c}: Can't get Release (skipping)".format(c=c), e, logging.WARNING)
+    return [(c, release_hash) for _attempted, c, release_hash in sorted(due, key=lambda d: d[0])]
+
+
+def refresh_chroot(chroot, release_hash):
+    """Refresh chroot (as admin job, so it's not run in parallel to admin actions), and record the time it took."""
+    backend = chroot.mbd_get_backend()
+    future = mini_buildd.models.base.JOBS.submit(backend.Admin, backend, [("check", {"force": True})])
+    if future is None:
+        LOG.info("Maintenance: {c}: Admin job running (skipping).".format(c=chroot))
+        return
+
+    started = django.utils.timezone.now()
+    try:
+        future.result()
+    except BaseException:
+        # Record the failed attempt too, so other chroots get their turn first
+        chroot.mbd_set_maintenance_data(attempted=started)
+        raise
+    took = round((django.utils.timezone.now() - started).total_seconds(), 1)
+
+    chroot.mbd_set_maintenance_data(release_hash=release_hash, attempted=started, refreshed=started, refresh_took=took)
+    LOG.info("Maintenance: {c}: Refreshed ({t} seconds).".format(c=chroot, t=took))
+
+
+def refresh_chroots(daemon_):
+    if not is_idle(daemon_):
+        LOG.debug("Maintenance: Daemon busy (skipping chroot refresh).")
+        return
+
+    for chroot, release_hash in _get_due_chroots():
+        # Might have become busy while we were getting the Release files
+        if is_idle(daemon_) and not _SHUTDOWN.is_set():
+            refresh_chroot(chroot, release_hash)
+        # Stagger: At most one refresh per run
+        break
+
+
+def probe_archives(_daemon):
+    for archive in mini_buildd.models.source.Archive.objects.all():
+        if _SHUTDOWN.is_set():
+            break
+        try:
+            archive.mbd_probe(None)
+        except BaseException as e:
+            mini_buildd.config.log_exception(LOG, "Maintenance: Archive probe failed", e, logging.WARNING)
+
+
+def _purge_logs(full):
+    for repository in mini_buildd.models.repository.Repository.mbd_get_active():
+        if _SHUTDOWN.is_set():
+            break
+        try:
+            repository.mbd_package_purge_orphaned_logs(full=full)
+        except BaseException as e:
+            mini_buildd.config.log_exception(LOG, "Maintenance: {r}: Log purge failed".format(r=repository), e, logging.WARNING)
+
+
+def purge_logs(_daemon):
+    _purge_logs(full=False)
+
+
+def purge_logs_full(_daemon):
+    _purge_logs(full=True)
+
+
+def check_hung_builds(daemon_):
+    for build in list(daemon_.builds.values()):
+        if build.hung and not build.hung_notified:
+            build.hung_notified = True
+            daemon_.state_generation.bump()
+            message = "Build probably hung: {b}: Building for {e} seconds, predicted {p} seconds.".format(b=build.key, e=round(build.elapsed), p=build.predicted)
+            LOG.warning("Maintenance: {m}".format(m=message))
+            daemon_.model.mbd_notify(message, "{b}\n\nSee live buildlog: {u}\n".format(b=build, u=build.live_buildlog_url))
+
+
+def _janitor_expired(path, max_age, now):
+    try:
+        return now - os.path.getmtime(path) > max_age.total_seconds()
+    except FileNotFoundError:
+        return False
+
+
+def _janitor_remove(path):
+    LOG.info("Janitor: Removing: {p}".format(p=path))
+    if os.path.isdir(path):
+        mini_buildd.misc.skip_if_keep_in_debug(shutil.rmtree, path, ignore_errors=True)
+    else:
+        os.remove(path)
+
+
+def janitor(daemon_):
+    """
+    Remove cruft.
+
+    * Live buildlogs older than ``Janitor-Live-Buildlog-Days`` (default 5).
+    * Spool dirs not used by any current package or build, and older than ``Janitor-Spool-Days`` (default 7).
+    * Temporary dirs not in use (like the daemon's keyrings), and older than ``Janitor-Spool-Days``.
+    * Upload markers ('*.upload') whose changes file is gone.
+    * Package and build history entries older than ``History-Days`` (default 365; 0 keeps all).
+    """
+    now = time.time()
+    live_buildlog_max_age = datetime.timedelta(days=int(daemon_.model.mbd_get_extra_option("Janitor-Live-Buildlog-Days", "5")))
+    spool_max_age = datetime.timedelta(days=int(daemon_.model.mbd_get_extra_option("Janitor-Spool-Days", "7")))
+
+    active = set([p.changes.get_spool_dir() for p in list(daemon_.packages.values())] + [b.build_dir for b in list(daemon_.builds.values())])
+
+    history_days = int(daemon_.model.mbd_get_extra_option("History-Days", "365"))
+
+    report = {"live buildlogs": 0, "spool dirs": 0, "tmp dirs": 0, "upload markers": 0, "history entries": 0}
+
+    def remove(path, what):
+        try:
+            _janitor_remove(path)
+            report[what] += 1
+        except BaseException as e:
+            mini_buildd.config.log_exception(LOG, "Janitor: Can't remove {p}".format(p=path), e, logging.WARNING)
+
+    for path in glob.glob(os.path.join(mini_buildd.config.SPOOL_DIR, "*.buildlog")):
+        if _janitor_expired(path, live_buildlog_max_age, now):
+            remove(path, "live buildlogs")
+
+    for path in glob.glob(os.path.join(mini_buildd.config.SPOOL_DIR, "*", "")):
+        path = os.path.normpath(path)
+        if path not in active and _janitor_expired(path, spool_max_age, now):
+            remove(path, "spool dirs")
+
+    for path in glob.glob(os.path.join(mini_buildd.config.TMP_DIR, "*", "")):
+        if not mini_buildd.misc.TmpDir.in_use(path) and _janitor_expired(path, spool_max_age, now):
+            remove(os.path.normpath(path), "tmp dirs")
+
+    for path in glob.glob(os.path.join(mini_buildd.config.SPOOL_DIR, "**", "*.upload"), recursive=True) + glob.glob(os.path.join(mini_buildd.config.TMP_DIR, "**", "*.upload"), recursive=True):
+        if not os.path.exists(os.path.splitext(path)[0] + ".changes"):
+            remove(path, "upload markers")
+
+    if history_days > 0:
+        for history in [mini_buildd.models.history.PackageHistory, mini_buildd.models.history.BuildHistory]:
+            report["history entries"] += history.mbd_expire(history_days)
+
+    LOG.info("Janitor: Removed {r}.".format(r=", ".join("{n} {w}".format(n=n, w=w) for w, n in report.items())))
+    return report
+
+
+# Tasks: (extra option, default interval in minutes, function)
+TASKS = [("Chroot-Maintenance-Interval", 30, refresh_chroots),
+         ("Archive-Probe-Interval", 15, probe_archives),
+         ("Log-Purge-Interval", 10, purge_logs),
+         ("Log-Purge-Full-Interval", 1440, purge_logs_full),
+         ("Hung-Build-Check-Interval", 5, check_hung_builds),
+         ("Janitor-Interval", 60, janitor)]
+
+
+def minutes2timedelta(minutes):
+    """
+    Get timedelta for positive minutes, else None.
+
+    >>> minutes2timedelta(5)
+    datetime.timedelta(seconds=300)
+    >>> minutes2timedelta(0)
+    """
+    return datetime.timedelta(minutes=minutes) if minutes > 0 else None
+
+
+def run(daemon_):
+    _SHUTDOWN.clear()
+
+    # Schedule: List of [due, interval, func]
+    schedule = []
+    for option, default, func in TASKS:
+        interval = minutes2timedelta(int(daemon_.model.mbd_get_extra_option(option, str(default))))
+        if interval:
+            schedule.append([django.utils.timezone.now() + interval, interval, func])
+            LOG.info("Maintenance: Running {f} every {i}.".format(f=func.__name__, i=interval))
+        else:
+            LOG.info("Maintenance: Disabled {f}.".format(f=func.__name__))
+
+    while schedule and not _SHUTDOWN.wait(max(0.0, (min(s[0] for s in schedule) - django.utils.timezone.now()).total_seconds())):
+        for s in schedule:
+            if s[0] <= django.utils.timezone.now() and not _SHUTDOWN.is_set():
+                try:
+                    s[2](daemon_)
+                except BaseException as e:
+                    mini_buildd.config.log_exception(LOG, "Maintenance: {f} failed".format(f=s[2].__name__), e)
+                finally:
+                    django.db.connection.close()
+                s[0] = django.utils.timezone.now() + s[1]
+
+
+def shutdown():
+    _SHUTDOWN.set()
@@ -2,10 +2,14 @@ import os
 import datetime
 import shutil
 import glob
+import gzip
+import json
 import threading
 import queue
-import multiprocessing
+import heapq
+import itertools
 import tempfile
+import weakref
 import hashlib
 import base64
 import re
@@ -13,8 +17,6 @@ import getpass
 import logging
 import logging.handlers
 
-import debian.debian_support
-
 import mini_buildd.config
 
 LOG = logging.getLogger(__name__)
@@ -26,6 +28,7 @@ def open_utf8(path, mode="r", **kwargs):
 
 def check_multiprocessing():
     """Multiprocessing needs shared memory. This may be use to check for misconfigured shm early for better error handling."""
+    import multiprocessing  # Note: Import here: Keep client tools' startup fast
     try:
         multiprocessing.Lock()
     except Exception as e:
@@ -50,15 +53,63 @@ class API():
         return self.__api__ == self.__API__
 
 
+class Generation():
+    """
+    Change counter (thread-safe).
+
+    >>> g = Generation()
+    >>> g.value
+    0
+    >>> g.bump()
+    1
+    >>> d = TrackedDict(g)
+    >>> d["a"] = 1
+    >>> del d["a"]
+    >>> g.value
+    3
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    @property
+    def value(self):
+        return self._value
+
+    def bump(self):
+        with self._lock:
+            self._value += 1
+            return self._value
+
+
+class TrackedDict(dict):
+    """Dict bumping a generation on item changes."""
+
+    def __init__(self, generation, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.generation = generation
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.generation.bump()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.generation.bump()
+
+
 class Status():
     """
     Helper class to implement an internal status.
 
-    Inheriting classes must give a stati dict to init.
+    Inheriting classes must give a stati dict to init, and
+    optionally a generation to bump on status changes.
     """
 
-    def __init__(self, stati):
+    def __init__(self, stati, generation=None):
         self.__status__, self.__status_desc__, self.__stati__ = 0, "", stati
+        self.__generation__ = generation
 
     @property
     def status(self):
@@ -71,6 +122,8 @@ class Status():
     def set_status(self, status, desc=""):
         """Set status with optional description."""
         self.__status__, self.__status_desc__ = status, desc
+        if self.__generation__ is not None:
+            self.__generation__.bump()
 
     def get_status(self):
         """Get raw (integer) status."""
@@ -89,16 +142,42 @@ def skip_if_keep_in_debug(func, *args, **kwargs):
 
 
 class TmpDir():
-    """Use with contextlib.closing() to guarantee tmpdir is purged afterwards."""
+    """
+    Use with contextlib.closing() to guarantee tmpdir is purged afterwards.
+
+    Tmpdirs are registered while in use (until closed, or garbage
+    collected), so cleanups may skip them (see ``in_use()``):
+
+    >>> t = TmpDir()
+    >>> TmpDir.in_use(t.tmpdir), TmpDir.in_use(t.tmpdir + "/")
+    (True, True)
+    >>> t.close()
+    >>> TmpDir.in_use(t.tmpdir)
+    False
+    """
+
+    # Tmpdirs in use: Path -> TmpDir
+    _IN_USE = weakref.WeakValueDictionary()
+    _IN_USE_LOCK = threading.Lock()
 
     def __init__(self, tmpdir=None):
         self._tmpdir = tmpdir if tmpdir else tempfile.mkdtemp(dir=mini_buildd.config.TMP_DIR)
+        with self._IN_USE_LOCK:
+            self._IN_USE[os.path.normpath(self._tmpdir)] = self
         LOG.debug("TmpDir {t}".format(t=self._tmpdir))
 
     def close(self):
         LOG.debug("Purging tmpdir: {t}".format(t=self._tmpdir))
+        with self._IN_USE_LOCK:
+            self._IN_USE.pop(os.path.normpath(self._tmpdir), None)
         skip_if_keep_in_debug(shutil.rmtree, self._tmpdir, ignore_errors=True)
 
+    @classmethod
+    def in_use(cls, path):
+        """Check if path is a tmpdir currently in use (like the daemon's keyrings)."""
+        with cls._IN_USE_LOCK:
+            return os.path.normpath(path) in cls._IN_USE
+
     @property
     def tmpdir(self):
         return self._tmpdir
@@ -148,35 +227,75 @@ class BlockQueue(queue.Queue):
 
     This way can use the Queue directly to limit the number of
     actually worked-on items for incoming and builds.
+
+    Blocked put()s are admitted by priority (lowest first; FIFO
+    for equal priorities):
+
+    >>> import time
+    >>> q = BlockQueue(maxsize=1)
+    >>> q.put("first")
+    >>> putters = [threading.Thread(target=q.put, args=(i,), kwargs={"priority": p}) for i, p in [("slow", 10), ("fast", 1)]]
+    >>> for t in putters:
+    ...     t.start()
+    ...     while q.pending < putters.index(t) + 1:
+    ...         time.sleep(0.01)
+    >>> q.load
+    3.0
+    >>> q.get()
+    'first'
+    >>> q.task_done()
+    >>> q.get()
+    'fast'
+    >>> q.task_done()
+    >>> q.get()
+    'slow'
+    >>> q.task_done()
+    >>> for t in putters:
+    ...     t.join()
+    >>> q.load
+    0.0
     """
 
     def __init__(self, maxsize):
         self._maxsize = maxsize
-        self._pending = 0
-        self._active = queue.Queue(maxsize=maxsize)
-        queue.Queue.__init__(self, maxsize=maxsize)
+        self._active = 0
+        # Pending (blocked) puts: Heap of (priority, sequence number)
+        self._pending = []
+        self._sequence = itertools.count()
+        self._admission = threading.Condition()
+        queue.Queue.__init__(self)
 
     def __str__(self):
         return "{load}: {n}/{m} ({p} pending)".format(
             load=self.load,
-            n=self._active.qsize(),
+            n=self._active,
             m=self._maxsize,
-            p=self._pending)
+            p=self.pending)
+
+    @property
+    def pending(self):
+        return len(self._pending)
 
     @property
     def load(self):
-        return round(float(self._active.qsize() + self._pending) / self._maxsize, 2)
+        return round(float(self._active + self.pending) / self._maxsize, 2)
 
     # Note: pylint false-positive: https://github.com/PyCQA/pylint/issues/1553
-    def put(self, item, **kwargs):  # pylint: disable=arguments-differ
-        self._pending += 1
-        self._active.put(item)
+    def put(self, item, priority=0, **kwargs):  # pylint: disable=arguments-differ
+        with self._admission:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._pending, ticket)
+            self._admission.wait_for(lambda: self._active < self._maxsize and self._pending[0] == ticket)
+            heapq.heappop(self._pending)
+            self._active += 1
+            # Next in line might be admitted as well
+            self._admission.notify_all()
         queue.Queue.put(self, item, **kwargs)
-        self._pending -= 1
 
     def task_done(self):
-        self._active.get()
-        self._active.task_done()
+        with self._admission:
+            self._active -= 1
+            self._admission.notify_all()
         return queue.Queue.task_done(self)
 
 
@@ -363,6 +482,7 @@ def guess_codeversion(release):
 
 
 def guess_default_dirchroot_backend(overlay, aufs):
+    import debian.debian_support  # Note: Import here: Keep client tools' startup fast
     try:
         release = os.uname()[2]
         # linux 3.18-1~exp1 in Debian removed aufs in favor of overlay
@@ -378,6 +498,16 @@ def chroot_libdir_path(codename, architecture):
     return os.path.join(mini_buildd.config.CHROOTS_LIBDIR, codename, architecture)
 
 
+def schroot_name(codename, architecture, disk_fallback=False):
+    """
+    Get name of a chroot's schroot (or of its disk fallback schroot, only configured when builds run on tmpfs).
+
+    >>> schroot_name("buster", "amd64"), schroot_name("buster", "amd64", disk_fallback=True)
+    ('mini-buildd-buster-amd64', 'mini-buildd-buster-amd64-disk')
+    """
+    return "mini-buildd-{c}-{a}{d}".format(c=codename, a=architecture, d="-disk" if disk_fallback else "")
+
+
 def pkg_fmt(status, distribution, package, version, extra=None, message=None):
     """Generate a package status line."""
     fmt = "{status} ({distribution}): {package} {version}".format(status=status,
@@ -392,6 +522,17 @@ def pkg_fmt(status, distribution, package, version, extra=None, message=None):
 
 
 class PkgLog():
+    """
+    Package log: "LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/".
+
+    Buildlogs are archived gzip-compressed (served with 'Content-Encoding: gzip' by
+    the static log route). Each package dir has an index file (version -> buildlogs
+    and changes), so log lookups don't need to scan the file system.
+    """
+
+    INDEX = ".index.json"
+    _INDEX_LOCK = threading.Lock()
+
     @classmethod
     def get_path(cls, repository, installed, package, version=None, architecture=None, relative=False):
         return os.path.join("" if relative else mini_buildd.config.LOG_DIR,
@@ -405,21 +546,107 @@ class PkgLog():
     def make_relative(cls, path):
         return path.replace(mini_buildd.config.LOG_DIR, "")
 
+    @classmethod
+    def archived_name(cls, file_name):
+        """
+        Get file name as archived.
+
+        >>> PkgLog.archived_name("foo_1.0_amd64.buildlog")
+        'foo_1.0_amd64.buildlog.gz'
+        >>> PkgLog.archived_name("foo_1.0_amd64.changes")
+        'foo_1.0_amd64.changes'
+        """
+        return file_name + ".gz" if file_name.endswith(".buildlog") else file_name
+
+    @classmethod
+    def _load_index(cls, package_path):
+        try:
+            with open_utf8(os.path.join(package_path, cls.INDEX)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except BaseException as e:
+            mini_buildd.config.log_exception(LOG, "Broken package log index (ignoring): {p}".format(p=package_path), e, logging.WARNING)
+            return {}
+
+    @classmethod
+    def _update_index(cls, package_path, version, update):
+        """Update index entry for version via ``update(entry)``; the entry is removed if update returns None."""
+        with cls._INDEX_LOCK:
+            index = cls._load_index(package_path)
+            entry = update(index.get(version, {"buildlogs": {}, "changes": None}))
+            if entry is None:
+                index.pop(version, None)
+            else:
+                index[version] = entry
+
+            index_file = os.path.join(package_path, cls.INDEX)
+            if index:
+                with open_utf8(index_file + ".new", "w") as f:
+                    json.dump(index, f, indent=1, sort_keys=True)
+                os.replace(index_file + ".new", index_file)
+            elif os.path.exists(index_file):
+                os.remove(index_file)
+
+    @classmethod
+    def _index_add(cls, entry, package_path, path):
+        """Add file to index entry (paths are relative to the package dir)."""
+        relpath = os.path.relpath(path, package_path)
+        if path.endswith(".buildlog") or path.endswith(".buildlog.gz"):
+            entry["buildlogs"][os.path.basename(os.path.dirname(path))] = relpath
+        elif path.endswith(".changes") and not ("mini-buildd-buildrequest" in path or "mini-buildd-buildresult" in path) and not entry["changes"]:
+            entry["changes"] = relpath
+        return entry
+
+    @classmethod
+    def archive(cls, logdir, files):
+        """Move files to logdir ("LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/"), compressing buildlogs, and update the package's index."""
+        os.makedirs(logdir, exist_ok=True)
+        archived = []
+        for f in files:
+            dst = os.path.join(logdir, cls.archived_name(os.path.basename(f)))
+            LOG.info("Archiving '{f}' to '{d}'". format(f=f, d=dst))
+            if dst.endswith(".gz"):
+                with open(f, "rb") as src, gzip.open(dst, "wb") as gz:
+                    shutil.copyfileobj(src, gz)
+                os.remove(f)
+            else:
+                os.rename(f, dst)
+            archived.append(dst)
+
+        version_path = os.path.dirname(os.path.normpath(logdir))
+
+        def update(entry):
+            for a in archived:
+                cls._index_add(entry, os.path.dirname(version_path), a)
+            return entry
+        cls._update_index(os.path.dirname(version_path), os.path.basename(version_path), update)
+
+    @classmethod
+    def purge(cls, version_path):
+        """Purge package log of one version ("LOG_DIR/REPO/[_failed/]PACKAGE/VERSION")."""
+        version_path = os.path.normpath(version_path)
+        shutil.rmtree(version_path, ignore_errors=True)
+        cls._update_index(os.path.dirname(version_path), os.path.basename(version_path), lambda _entry: None)
+
     def __init__(self, repository, installed, package, version):
         self.path = self.get_path(repository, installed, package, version)
+        package_path = self.get_path(repository, installed, package)
 
-        # Find build logs: "LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/PACKAGE_VERSION_ARCH.buildlog"
-        self.buildlogs = {}
-        for buildlog in glob.glob("{p}/*/*.buildlog".format(p=self.path)):
-            arch = os.path.basename(os.path.dirname(buildlog))
-            self.buildlogs[arch] = buildlog
-
-        # Find changes: "LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/PACKAGE_VERSION_ARCH.changes"
-        self.changes = None
-        for c in glob.glob("{p}/*/*.changes".format(p=self.path)):
-            if not ("mini-buildd-buildrequest" in c or "mini-buildd-buildresult" in c):
-                self.changes = c
-                break
+        entry = self._load_index(package_path).get(version)
+        if entry is None:
+            # Not yet indexed (logs archived by older versions): Scan once, and add to index
+            entry = {"buildlogs": {}, "changes": None}
+            for path in sorted(glob.glob("{p}/*/*.buildlog".format(p=self.path)) + glob.glob("{p}/*/*.buildlog.gz".format(p=self.path)) + glob.glob("{p}/*/*.changes".format(p=self.path))):
+                self._index_add(entry, package_path, path)
+            if entry["buildlogs"] or entry["changes"]:
+                self._update_index(package_path, version, lambda _entry: entry)
+
+        # Build logs: "LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/PACKAGE_VERSION_ARCH.buildlog[.gz]"
+        self.buildlogs = {arch: os.path.join(package_path, path) for arch, path in entry["buildlogs"].items()}
+
+        # Changes: "LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/PACKAGE_VERSION_ARCH.changes"
+        self.changes = os.path.join(package_path, entry["changes"]) if entry["changes"] else None
 
 
 def subst_placeholders(template, placeholders):
@@ -500,6 +727,7 @@ def b642u(base64_bytestream):
 
 
 def get_cpus():
+    import multiprocessing  # Note: Import here: Keep client tools' startup fast
     try:
         return multiprocessing.cpu_count()
     except BaseException:
@@ -15,6 +15,7 @@ def import_all():
     from mini_buildd.models import chroot
     from mini_buildd.models import daemon
     from mini_buildd.models import subscription
+    from mini_buildd.models import history
 
     models = [
         gnupg.AptKey,
@@ -37,7 +38,9 @@ def import_all():
         chroot.LoopLVMChroot,
         chroot.BtrfsSnapshotChroot,
         daemon.Daemon,
-        subscription.Subscription]
+        subscription.Subscription,
+        history.PackageHistory,
+        history.BuildHistory]
 
     for m in models:
         m_admin = getattr(m, "Admin")
@@ -39,6 +39,8 @@ import datetime
 import re
 import pickle
 import base64
+import threading
+import concurrent.futures
 import logging
 
 import django.db.models
@@ -69,6 +71,83 @@ except BaseException as e:
     LOG.warning("Error disabling delete action (ignoring): {e}".format(e=e))
 
 
+class Jobs():
+    """
+    Background jobs for long-running admin actions.
+
+    A job runs a sequence of (StatusModel.Admin) actions on one
+    object; jobs for different objects run in parallel, on a
+    bounded pool of worker threads. The progress of the last job is
+    kept per object, so it can be shown in the admin's change list.
+
+    Number of workers is taken from the daemon's extra option
+    ``Admin-Job-Workers`` (default 4) on first use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._progress = {}
+
+    @classmethod
+    def _key(cls, obj):
+        return "{m}:{pk}".format(m=obj.__class__.__name__, pk=obj.pk)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                workers = int(Model.mbd_get_daemon().model.mbd_get_extra_option("Admin-Job-Workers", "4"))
+                LOG.info("Starting admin job pool with {w} workers.".format(w=workers))
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mbd-admin-job")
+            return self._executor
+
+    def _set_progress(self, key, progress):
+        with self._lock:
+            self._progress[key] = (progress, django.utils.timezone.now())
+
+    def get_progress(self, obj):
+        """Get progress string of the last job for this object (empty string if none)."""
+        with self._lock:
+            progress = self._progress.get(self._key(obj))
+        return "{p} ({t})".format(p=progress[0], t=progress[1].strftime("%H:%M:%S")) if progress else ""
+
+    def is_busy(self, obj):
+        with self._lock:
+            progress = self._progress.get(self._key(obj))
+        return progress is not None and not progress[0].startswith(("Done", "Failed"))
+
+    def _run(self, admin, model, pk, actions):
+        key = "{m}:{pk}".format(m=model.__name__, pk=pk)
+        action = None
+        try:
+            # Always work on a fresh object (the request's object might be outdated when the job finally runs)
+            obj = model.objects.get(pk=pk)
+            for action, kwargs in actions:
+                self._set_progress(key, "Running {a}".format(a=action))
+                getattr(admin, "mbd_" + action)(None, obj, **kwargs)
+            result = "Done: {a}".format(a=",".join(a for a, _kwargs in actions))
+            self._set_progress(key, result)
+            return result
+        except BaseException as e:
+            mini_buildd.config.log_exception(LOG, "Admin job {a} failed: {k}".format(a=action, k=key), e)
+            result = "Failed: {a}: {e}".format(a=action, e=e)
+            self._set_progress(key, result)
+            raise Exception(result)
+        finally:
+            # Worker threads get their own db connection: Don't leave it open
+            django.db.connection.close()
+
+    def submit(self, admin, obj, actions):
+        """Schedule actions (list of (ACTION, KWARGS) tuples) for object; returns future, or None when a job for this object is already running."""
+        if self.is_busy(obj):
+            return None
+        self._set_progress(self._key(obj), "Queued: {a}".format(a=",".join(a for a, _kwargs in actions)))
+        return self._get_executor().submit(self._run, admin, obj.__class__, obj.pk, actions)
+
+
+JOBS = Jobs()
+
+
 class Model(django.db.models.Model):
     """
     Abstract father model for all mini-buildd models.
@@ -346,6 +425,9 @@ class StatusModel(Model):
             else:
                 MsgLog(LOG, request).info("Already removed: {o}".format(o=obj))
 
+        # Run prepare and check actions as background jobs (see Jobs); models with long-running actions may enable this
+        mbd_background_actions = False
+
         @classmethod
         def mbd_action(cls, request, queryset, action, **kwargs):
             """
@@ -359,12 +441,43 @@ class StatusModel(Model):
                 except BaseException as e:
                     mini_buildd.config.log_exception(MsgLog(LOG, request), "{a} failed: {o}".format(a=action, o=o), e)
 
+        @classmethod
+        def mbd_action_background(cls, request, queryset, actions, wait=False):
+            """
+            Run actions (list of (ACTION, KWARGS) tuples) on each object in queryset as background jobs.
+
+            With ``wait``, block until all jobs are finished, and log the results.
+            """
+            futures = {}
+            for o in queryset:
+                future = JOBS.submit(cls, o, actions)
+                if future:
+                    futures[future] = o
+                    MsgLog(LOG, request).info("Scheduled {a}: {o}".format(a=",".join(a for a, _kwargs in actions), o=o))
+                else:
+                    MsgLog(LOG, request).warning("Skipped (job already running): {o}".format(o=o))
+
+            if wait:
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        MsgLog(LOG, request).info("{r}: {o}".format(r=future.result(), o=futures[future]))
+                    except BaseException as e:
+                        mini_buildd.config.log_exception(MsgLog(LOG, request), "{o}".format(o=futures[future]), e)
+            else:
+                MsgLog(LOG, request).info("See column 'Job' for progress (reload page).")
+
         def mbd_action_prepare(self, request, queryset):
-            self.mbd_action(request, queryset, "prepare")
+            if self.mbd_background_actions:
+                self.mbd_action_background(request, queryset, [("prepare", {})])
+            else:
+                self.mbd_action(request, queryset, "prepare")
         mbd_action_prepare.short_description = "Prepare"
 
         def mbd_action_check(self, request, queryset):
-            self.mbd_action(request, queryset, "check", force=True)
+            if self.mbd_background_actions:
+                self.mbd_action_background(request, queryset, [("check", {"force": True})])
+            else:
+                self.mbd_action(request, queryset, "check", force=True)
         mbd_action_check.short_description = "Check"
 
         def mbd_action_activate(self, request, queryset):
@@ -395,21 +508,34 @@ this would mean losing all packages!
         mbd_action_remove.short_description = "Remove"
 
         def mbd_action_pc(self, request, queryset):
-            self.mbd_action(request, queryset, "prepare")
-            self.mbd_action(request, queryset, "check")
+            if self.mbd_background_actions:
+                self.mbd_action_background(request, queryset, [("prepare", {}), ("check", {})])
+            else:
+                self.mbd_action(request, queryset, "prepare")
+                self.mbd_action(request, queryset, "check")
         mbd_action_pc.short_description = "PC"
 
         def mbd_action_pca(self, request, queryset):
-            self.mbd_action_pc(request, queryset)
-            self.mbd_action(request, queryset, "activate")
+            if self.mbd_background_actions:
+                self.mbd_action_background(request, queryset, [("prepare", {}), ("check", {}), ("activate", {})])
+            else:
+                self.mbd_action_pc(request, queryset)
+                self.mbd_action(request, queryset, "activate")
         mbd_action_pca.short_description = "PCA"
 
         @classmethod
         def mbd_meta_pca_all(cls, msglog):
             """Run prepare, check, and activate for all objects of this model."""
-            cls.mbd_action(msglog.request, cls.mbd_model.objects.all(), "prepare")
-            cls.mbd_action(msglog.request, cls.mbd_model.objects.all(), "check")
-            cls.mbd_action(msglog.request, cls.mbd_model.objects.all(), "activate")
+            if cls.mbd_background_actions:
+                cls.mbd_action_background(msglog.request, cls.mbd_model.objects.all(), [("prepare", {}), ("check", {}), ("activate", {})], wait=True)
+            else:
+                cls.mbd_action(msglog.request, cls.mbd_model.objects.all(), "prepare")
+                cls.mbd_action(msglog.request, cls.mbd_model.objects.all(), "check")
+                cls.mbd_action(msglog.request, cls.mbd_model.objects.all(), "activate")
+
+        def mbd_job_progress(self, obj):  # pylint: disable=no-self-use
+            return JOBS.get_progress(obj)
+        mbd_job_progress.short_description = "Job"
 
         def colored_status(self, obj):  # pylint: disable=no-self-use
             return django.utils.html.format_html(
@@ -2,6 +2,7 @@ import copy
 import os
 import contextlib
 import glob
+import hashlib
 import logging
 
 import django.db.models
@@ -10,6 +11,7 @@ import django.contrib.messages
 
 import mini_buildd.config
 import mini_buildd.misc
+import mini_buildd.net
 import mini_buildd.call
 
 import mini_buildd.models.base
@@ -58,6 +60,10 @@ go to the default mapping.
     class Admin(mini_buildd.models.base.StatusModel.Admin):
         search_fields = ["source__codename", "architecture__name"]
         readonly_fields = ["personality"]
+        list_display = mini_buildd.models.base.StatusModel.Admin.list_display + ["mbd_job_progress", "mbd_last_refresh"]
+
+        # Prepare (debootstrap) and check (apt upgrade) may take a long time
+        mbd_background_actions = True
         fieldsets = [
             ("Chroot identity", {"fields": (("source", "architecture"), "personality", "personality_override")}),
             ("Extra options",
@@ -69,6 +75,18 @@ go to the default mapping.
 For example, <kbd>Debootstrap-Command: /usr/sbin/qemu-debootstrap</kbd> may be used to produce <em>armel</em>
 chroots (with <kbd>qemu-user-static</kbd> installed).
 </p>
+<p><kbd>Build-Tmpfs-Size: SIZE</kbd>: Run build sessions on a tmpfs of at most SIZE (Dir and File chroots only).</p>
+<p>
+SIZE is given as for tmpfs' <kbd>size</kbd> mount option (f.e., <kbd>Build-Tmpfs-Size: 8G</kbd>). All
+writes of a build session (union overlay for Dir chroots, unpacked tarball for File chroots) then go to
+memory instead of the disk. If there is not enough memory available when the tmpfs is needed, sessions
+just run on disk; builds that fail running out of space on the tmpfs are retried on disk.
+Run <em>prepare</em> again after changing this option.
+</p>
+<p><kbd>Unpacked-Cache: true</kbd>: Keep the unpacked tarball of File chroots, and use union mounts on it.</p>
+<p>
+Avoids to unpack the tarball for every session (File chroots only). Needs <em>remove</em>+<em>PCA</em> when changed.
+</p>
 """,
               "fields": ("extra_options",)})]
 
@@ -80,6 +98,13 @@ chroots (with <kbd>qemu-user-static</kbd> installed).
                 fields.append("architecture")
             return fields
 
+        def mbd_last_refresh(self, obj):  # pylint: disable=no-self-use
+            maintenance = obj.mbd_get_maintenance_data()
+            if "refresh_took" in maintenance:
+                return "{r} ({t} seconds)".format(r=maintenance["refreshed"].strftime("%Y-%m-%d %H:%M"), t=maintenance["refresh_took"])
+            return ""
+        mbd_last_refresh.short_description = "Last refresh"
+
         @classmethod
         def mbd_host_architecture(cls):
             return mini_buildd.models.source.Architecture.mbd_host_architecture()
@@ -120,7 +145,7 @@ chroots (with <kbd>qemu-user-static</kbd> installed).
         return os.path.join(mini_buildd.config.CHROOTS_DIR, self.source.codename, self.architecture.name)
 
     def mbd_get_name(self):
-        return "mini-buildd-{d}-{a}".format(d=self.source.codename, a=self.architecture.name)
+        return mini_buildd.misc.schroot_name(self.source.codename, self.architecture.name)
 
     def mbd_get_tmp_dir(self):
         return os.path.join(self.mbd_get_path(), "tmp")
@@ -135,6 +160,43 @@ chroots (with <kbd>qemu-user-static</kbd> installed).
     def mbd_get_system_schroot_conf_file(self):
         return os.path.join("/etc/schroot/chroot.d", self.mbd_get_name() + ".conf")
 
+    def mbd_get_disk_fallback_name(self):
+        """Get name of the disk fallback schroot (only configured when builds run on tmpfs)."""
+        return mini_buildd.misc.schroot_name(self.source.codename, self.architecture.name, disk_fallback=True)
+
+    def mbd_get_build_tmpfs_dir(self):
+        return os.path.join(self.mbd_get_path(), "tmpfs")
+
+    def mbd_get_build_tmpfs_size(self):
+        """Get size of the tmpfs to run build sessions on (empty string if not configured or not supported by the backend)."""
+        size = self.mbd_get_extra_option("Build-Tmpfs-Size", "")
+        if size and not self.mbd_get_backend().mbd_get_schroot_session_dir_key():
+            LOG.warning("{c}: Backend does not support 'Build-Tmpfs-Size' (ignoring).".format(c=self))
+            return ""
+        return size
+
+    def mbd_get_schroot_session_dir_key(self):
+        """Get schroot config key for the directory holding session data. Subclasses may implement this to support builds on tmpfs."""
+        LOG.debug("{c}: No session dir key defined.".format(c=self))
+        return None
+
+    def mbd_get_release_hash(self):
+        """Get hash of the base source's current Release file (changes when there are upgrades for the chroot)."""
+        url = "{u}/dists/{d}/Release".format(u=self.source.mbd_get_archive().url, d=self.source.codename)
+        return hashlib.sha256(mini_buildd.net.urlopen_ca_certificates(url, timeout=30).read()).hexdigest()
+
+    def mbd_get_maintenance_data(self):
+        """Get data of the last background refresh (see ``mini_buildd.maintenance``): Dict with 'release_hash', 'attempted', 'refreshed' and 'refresh_took'."""
+        return self.mbd_get_pickled_data(default={}) if self.pickled_data else {}
+
+    def mbd_set_maintenance_data(self, **kwargs):
+        # Only update pickled data: The object's status might have been changed meanwhile (by the refresh itself)
+        chroot = Chroot.objects.get(pk=self.pk)
+        data = chroot.mbd_get_maintenance_data()
+        data.update(kwargs)
+        chroot.mbd_set_pickled_data(data)
+        chroot.save(update_fields=["pickled_data"])
+
     def mbd_get_pre_sequence(self):
         """Get preliminary sequence. Subclasses may implement this to do define an extra preliminary sequence."""
         LOG.debug("{c}: No pre-sequence defined.".format(c=self))
@@ -149,7 +211,14 @@ chroots (with <kbd>qemu-user-static</kbd> installed).
             LOG.warning("{c}: Can't get archive URL from source (source removed?): {e}".format(c=self, e=e))
             debootstrap_url = "no_archive_url_found_maybe_source_is_removed"
 
-        return [
+        # The build tmpfs is mounted on demand from schroot's setup.d; just be sure to umount it on removal.
+        tmpfs_sequence = []
+        if self.mbd_get_build_tmpfs_size():
+            tmpfs_sequence = [
+                (["/bin/mkdir", "--verbose", "--parents", self.mbd_get_build_tmpfs_dir()],
+                 ["/bin/umount", "--verbose", self.mbd_get_build_tmpfs_dir()])]
+
+        return tmpfs_sequence + [
             (["/bin/mkdir", "--verbose", self.mbd_get_tmp_dir()],
              ["/bin/rm", "--recursive", "--one-file-system", "--force", self.mbd_get_tmp_dir()])] + self.mbd_get_backend().mbd_get_pre_sequence() + [
                  ([self.mbd_get_extra_option("Debootstrap-Command", "/usr/sbin/debootstrap"),
@@ -163,15 +232,17 @@ chroots (with <kbd>qemu-user-static</kbd> installed).
                       (["/bin/cp", "--verbose", self.mbd_get_schroot_conf_file(), self.mbd_get_system_schroot_conf_file()],
                        ["/bin/rm", "--verbose", self.mbd_get_system_schroot_conf_file()])]
 
-    def mbd_prepare(self, request):
-        os.makedirs(self.mbd_get_path(), exist_ok=True)
-
-        # Set personality
-        self.personality = self.personality_override if self.personality_override else self.PERSONALITIES.get(self.architecture.name, "linux")
+    def _mbd_get_schroot_conf_section(self, name, tmpfs_size=""):
+        tmpfs_conf = ""
+        if tmpfs_size:
+            # See '/etc/schroot/setup.d/04mini-buildd-tmpfs'
+            tmpfs_conf = """
+# Build sessions on tmpfs
+{k}={d}
+custom.mini-buildd-tmpfs-size={s}
+""".format(k=self.mbd_get_backend().mbd_get_schroot_session_dir_key(), d=self.mbd_get_build_tmpfs_dir(), s=tmpfs_size)
 
-        mini_buildd.misc.ConfFile(
-            self.mbd_get_schroot_conf_file(),
-            """\
+        return """\
 [{n}]
 description=Mini-Buildd chroot {n}
 setup.fstab=mini-buildd/fstab
@@ -183,8 +254,21 @@ source-root-users=mini-buildd
 personality={p}
 
 # Backend specific config
-{b}
-""".format(n=self.mbd_get_name(), p=self.personality, b=self.mbd_get_backend().mbd_get_schroot_conf())).save()
+{b}{t}
+""".format(n=name, p=self.personality, b=self.mbd_get_backend().mbd_get_schroot_conf(), t=tmpfs_conf)
+
+    def mbd_prepare(self, request):
+        os.makedirs(self.mbd_get_path(), exist_ok=True)
+
+        # Set personality
+        self.personality = self.personality_override if self.personality_override else self.PERSONALITIES.get(self.architecture.name, "linux")
+
+        tmpfs_size = self.mbd_get_build_tmpfs_size()
+        schroot_conf = self._mbd_get_schroot_conf_section(self.mbd_get_name(), tmpfs_size)
+        if tmpfs_size:
+            # Same chroot on disk: The builder retries here when a build runs out of space on the tmpfs
+            schroot_conf += "\n" + self._mbd_get_schroot_conf_section(self.mbd_get_disk_fallback_name())
+        mini_buildd.misc.ConfFile(self.mbd_get_schroot_conf_file(), schroot_conf).save()
 
         # Gen keyring file to use with debootstrap
         with contextlib.closing(mini_buildd.gnupg.TmpGnuPG()) as gpg:
@@ -233,6 +317,10 @@ personality={p}
         """Run backend check. Subclasses may implement this to do extra backend-specific checks."""
         MsgLog(LOG, request).info("{c}: No backend check implemented.".format(c=self))
 
+    def mbd_backend_refresh(self, request):
+        """Run after the source chroot has been updated. Subclasses may implement this to sync backend-specific data."""
+        LOG.debug("{c}: No backend refresh implemented.".format(c=self))
+
     def mbd_check(self, request):
         # Check for the old sudo workaround (chroots created by mini-buildd <= 1.0.4)
         self.mbd_check_sudo_workaround(request)
@@ -272,6 +360,8 @@ personality={p}
                 if fatal:
                     raise
 
+        self.mbd_get_backend().mbd_backend_refresh(request)
+
     def mbd_get_dependencies(self):
         return [self.source]
 
@@ -317,6 +407,10 @@ directory={d}
 union-type={u}
 """.format(d=self.mbd_get_chroot_dir(), u=self.get_union_type_display())
 
+    @classmethod
+    def mbd_get_schroot_session_dir_key(cls):
+        return "union-overlay-directory"
+
     def mbd_get_post_sequence(self):
         return [
             (["/bin/mv",
@@ -363,27 +457,59 @@ class FileChroot(Chroot):
             cls._mbd_meta_add_base_sources(FileChroot, msglog)
 
     def mbd_backend_flavor(self):
-        return self.TAR_SUFFIX[self.compression]
+        return "{s}{c}".format(s=self.TAR_SUFFIX[self.compression], c=" (cached)" if self.mbd_has_unpacked_cache() else "")
+
+    def mbd_has_unpacked_cache(self):
+        return self.mbd_get_extra_option("Unpacked-Cache", "false").lower() in ["true", "1"]
 
     def mbd_get_tar_file(self):
         return os.path.join(self.mbd_get_path(), "source." + self.TAR_SUFFIX[self.compression])
 
+    def mbd_get_unpacked_dir(self):
+        return os.path.join(self.mbd_get_path(), "unpacked")
+
     def mbd_get_schroot_conf(self):
+        if self.mbd_has_unpacked_cache():
+            return """\
+type=directory
+directory={d}
+union-type={u}
+""".format(d=self.mbd_get_unpacked_dir(), u=mini_buildd.misc.guess_default_dirchroot_backend(overlay="overlay", aufs="aufs"))
+
         return """\
 type=file
 file={t}
 """.format(t=self.mbd_get_tar_file())
 
+    def mbd_get_schroot_session_dir_key(self):
+        return "union-overlay-directory" if self.mbd_has_unpacked_cache() else "file-unpack-directory"
+
+    def _mbd_get_tar_call(self, directory):
+        return ["/bin/tar",
+                "--create",
+                "--directory", directory,
+                "--file", self.mbd_get_tar_file()] + self.TAR_ARGS[self.compression] + ["."]
+
     def mbd_get_post_sequence(self):
+        if self.mbd_has_unpacked_cache():
+            return [
+                (self._mbd_get_tar_call(self.mbd_get_tmp_dir()),
+                 []),
+                (["/bin/mv", "--verbose", self.mbd_get_tmp_dir(), self.mbd_get_unpacked_dir()],
+                 ["/bin/rm", "--recursive", "--one-file-system", "--force", self.mbd_get_unpacked_dir()])]
+
         return [
-            (["/bin/tar",
-              "--create",
-              "--directory", self.mbd_get_tmp_dir(),
-              "--file", self.mbd_get_tar_file()] + self.TAR_ARGS[self.compression] + ["."],
+            (self._mbd_get_tar_call(self.mbd_get_tmp_dir()),
              []),
             (["/bin/rm", "--recursive", "--one-file-system", "--force", self.mbd_get_tmp_dir()],
              [])]
 
+    def mbd_backend_refresh(self, request):
+        """With unpacked cache, source sessions update the cache only: Re-create the tarball from it."""
+        if self.mbd_has_unpacked_cache():
+            MsgLog(LOG, request).info("{c}: Updating tarball from unpacked cache...".format(c=self))
+            mini_buildd.call.Call(self._mbd_get_tar_call(self.mbd_get_unpacked_dir()), run_as_root=True).log().check()
+
 
 class LVMChroot(Chroot):
     """LVM chroot backend."""
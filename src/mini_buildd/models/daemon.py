@@ -5,7 +5,6 @@ import logging
 
 import django.db
 import django.core.exceptions
-import django.core.mail
 import django.contrib.auth.models
 
 import mini_buildd.misc
@@ -13,11 +12,14 @@ import mini_buildd.net
 import mini_buildd.changes
 import mini_buildd.gnupg
 import mini_buildd.builder
+import mini_buildd.mailer
 
 import mini_buildd.models.base
 import mini_buildd.models.repository
 import mini_buildd.models.chroot
 import mini_buildd.models.gnupg
+import mini_buildd.models.subscription
+import mini_buildd.models.snapshot
 
 from mini_buildd.models.msglog import MsgLog
 LOG = logging.getLogger(__name__)
@@ -112,10 +114,10 @@ maintainers to be accidentally spammed.
 
     show_last_packages = django.db.models.IntegerField(
         default=100,
-        help_text="How many 'last packages data' to keep for the status display.")
+        help_text="How many last packages to show on the status display (see package history for all).")
     show_last_builds = django.db.models.IntegerField(
         default=100,
-        help_text="How many 'last builds data' to keep for the status display.")
+        help_text="How many last builds to show on the status display (see build history for all).")
 
     wait_for_build_results = django.db.models.IntegerField(
         default=5,
@@ -140,18 +142,41 @@ prepare/remove actions will generate/remove the GnuPG key.
             ("FTP (incoming) Options", {"fields": ("ftpd_bind", "ftpd_options")}),
             ("Load Options", {"fields": ("build_queue_size", "sbuild_jobs")}),
             ("E-Mail Options", {"fields": ("smtp_server", "notify", "allow_emails_to")}),
-            ("Other Options", {"fields": ("gnupg_keyserver", "custom_hooks_directory", "show_last_packages", "show_last_builds")}))
+            ("Other Options", {"fields": ("gnupg_keyserver", "custom_hooks_directory", "show_last_packages", "show_last_builds")}),
+            ("Extra Options", {"classes": ("collapse",),
+                               "description": """
+<b>Supported extra options</b>
+<p><kbd>Admin-Job-Workers: N</kbd>: Maximum number of admin actions (like chroot prepare or check) to run in parallel (default: 4).</p>
+<p><kbd>Chroot-Maintenance-Interval: MINUTES</kbd>: How often to look for chroots to refresh while idle (default: 30, 0 disables).</p>
+<p>
+When the daemon is idle, source chroots are refreshed (check with apt upgrades) in the background; one chroot at a time,
+and only when the Release file of its base source has changed since the last refresh.
+</p>
+<p><kbd>Archive-Probe-Interval: MINUTES</kbd>: How often to probe archives for latency and throughput (default: 15, 0 disables).</p>
+<p>
+Archives are ranked by these (moving average) values (estimated time to download 1 MiB), so debootstrap and builds use the currently fastest archive of a source.
+Throughput is sampled from the transfer of a served source's Release file (probes and source checks; response headers excluded).
+</p>
+<p><kbd>Log-Purge-Interval: MINUTES</kbd>: How often to purge orphaned package logs of packages changed since the last purge (default: 10, 0 disables).</p>
+<p><kbd>Log-Purge-Full-Interval: MINUTES</kbd>: How often to check all package logs for orphans (default: 1440, 0 disables).</p>
+<p><kbd>Hung-Build-Check-Interval: MINUTES</kbd>: How often to check for builds taking far longer than predicted (from the build history), which are probably hung (default: 5, 0 disables).</p>
+<p><kbd>Mail-Digest-Interval: MINUTES</kbd>: Collect notifications to the same recipient for that long, and send them as one digest mail (default: 1, 0 sends immediately).</p>
+<p><kbd>Mail-Retry-Max: N</kbd>: How often to try to send a notification mail, with exponential backoff (default: 8).</p>
+<p><kbd>Janitor-Interval: MINUTES</kbd>: How often to remove cruft (default: 60, 0 disables):</p>
+<ul>
+<li>Live buildlogs older than <kbd>Janitor-Live-Buildlog-Days: DAYS</kbd> (default: 5).</li>
+<li>Unused spool dirs and temporary dirs older than <kbd>Janitor-Spool-Days: DAYS</kbd> (default: 7).</li>
+<li>Stale upload markers.</li>
+<li>Package and build history entries older than <kbd>History-Days: DAYS</kbd> (default: 365, 0 keeps all).</li>
+</ul>
+""",
+                               "fields": ("extra_options",)}))
 
         filter_horizontal = ("notify",)
 
         # These are depcrecated or not used yet
         readonly_fields = ["smtp_server", "ftpd_options", "custom_hooks_directory"]
 
-        def save_model(self, request, obj, form, change):
-            """Save model -- always update from daemon object first."""
-            obj.mbd_get_daemon().update_to_model()
-            super().save_model(request, obj, form, change)
-
     def __str__(self):
         return "{i}: Serving {r} repositories, {c} chroots, using {R} remotes".format(
             i=self.identity,
@@ -290,14 +315,14 @@ Manage your account : {url}accounts/login/
             else:
                 msglog.warning("Notify: Skipping {t} address: {a}: Not allowed (only '{r}')".format(t=typ, a=address, r=self.allow_emails_to))
 
-        def get_subscriptions():
+        def get_subscribers():
             package = changes.get("Source", None)
             real_distribution = distribution
             if real_distribution is None:
                 # If distribution was not given explicitly, try from changes, resolving meta dists if needed.
                 changes_dist = changes.get("Distribution", "")
-                real_distribution = mini_buildd.models.repository.map_incoming_distribution(changes_dist)
-            return self.mbd_get_daemon().get_subscription_objects().filter(package__in=[package, ""], distribution__in=[real_distribution, ""])
+                real_distribution = mini_buildd.models.snapshot.get().map_meta(changes_dist)
+            return mini_buildd.models.subscription.Subscription.mbd_get_subscribers(package, real_distribution)
 
         # Add hardcoded addresses from daemon
         for m in self.notify.all():
@@ -320,15 +345,15 @@ Manage your account : {url}accounts/login/
                 add_to(maintainer, "maintainer", is_automatic=True)
 
             # Add user subscriptions
-            for s in get_subscriptions():
-                address = "{n} <{a}>".format(n=s.subscriber.get_full_name(), a=s.subscriber.email)
-                if s.subscriber.is_active:
+            for full_name, address, is_active in get_subscribers():
+                address = "{n} <{a}>".format(n=full_name, a=address)
+                if is_active:
                     add_to(address, "subscriber", is_automatic=False)
                 else:
                     msglog.debug("Notify: Skipping subscription address: {a}: Account disabled".format(a=address))
 
         try:
-            django.core.mail.send_mass_mail(m_to)
-            msglog.info("Notify: Sent '{s}'".format(s=subject))
+            mini_buildd.mailer.send(m_to)
+            msglog.info("Notify: Queued '{s}'".format(s=subject))
         except BaseException as e:
             mini_buildd.config.log_exception(msglog, "Notify: Mail '{s}' failed to '{r}'".format(s=subject, r=m_to), e)
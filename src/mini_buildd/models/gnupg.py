@@ -1,4 +1,6 @@
 import contextlib
+import urllib.request
+import urllib.error
 import logging
 
 import django.db.models
@@ -8,6 +10,7 @@ import django.contrib.messages
 import mini_buildd.misc
 import mini_buildd.net
 import mini_buildd.gnupg
+import mini_buildd.api
 
 import mini_buildd.models.base
 
@@ -188,11 +191,34 @@ class Remote(KeyringKey):
         except BaseException as e:
             raise Exception("Error parsing {}: {} (syntax is '[proto:]hostname:port')".format(self.http, e))
 
+    # Latest status per status URL: {url: (etag, pickled status)}
+    _mbd_status_cache = {}
+
+    def _mbd_update_status(self, url):
+        """Update status from remote, using a conditional request (so an unchanged status is cheap on both sides)."""
+        etag, pickled = self._mbd_status_cache.get(url, (None, None))
+        request = urllib.request.Request(url, headers={"If-None-Match": etag} if etag else {})
+        try:
+            response = mini_buildd.net.urlopen_ca_certificates(request, timeout=10)
+            self.mbd_set_pickled_data(mini_buildd.api.decode(response.read(), "json"))
+            self._mbd_status_cache[url] = (response.headers.get("ETag"), self.pickled_data)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            self.pickled_data = pickled
+
     def mbd_get_status(self, update=False):
         if update:
             try:
-                url = self.mbd_http2url() + "/mini_buildd/api?command=status&output=python"
-                self.mbd_set_pickled_data_pickled(mini_buildd.net.urlopen_ca_certificates(url, timeout=10).read())
+                url = self.mbd_http2url() + "/mini_buildd/api?command=status&output=json"
+                try:
+                    self._mbd_update_status(url)
+                except urllib.error.HTTPError as e:
+                    # Remotes with older versions only understand 'python' output
+                    if e.code != 400:
+                        raise
+                    url = self.mbd_http2url() + "/mini_buildd/api?command=status&output=python"
+                    self.mbd_set_pickled_data_pickled(mini_buildd.net.urlopen_ca_certificates(url, timeout=10).read())
             except Exception as e:
                 raise Exception("Failed to update status for remote via URL '{u}': {e}".format(u=url, e=e))
         return self.mbd_get_pickled_data(default=mini_buildd.api.Status({}))
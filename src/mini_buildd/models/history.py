@@ -0,0 +1,205 @@
+"""
+Package and build history.
+
+Packages and builds are added (append-only) when they are
+closed. The history is kept for ``History-Days`` days (daemon
+extra option, default 365; expired by the janitor), and may be
+queried via the ``history`` API call.
+"""
+
+import os
+import json
+import datetime
+import logging
+
+import django.db.models
+import django.contrib.admin
+import django.core.paginator
+import django.utils.timezone
+
+import mini_buildd.misc
+
+LOG = logging.getLogger(__name__)
+
+
+class History(django.db.models.Model):
+    package = django.db.models.CharField(max_length=100, db_index=True)
+    version = django.db.models.CharField(max_length=100, db_index=True)
+    distribution = django.db.models.CharField(max_length=100, db_index=True)
+    status = django.db.models.CharField(max_length=20, db_index=True)
+    status_desc = django.db.models.TextField(blank=True)
+    started = django.db.models.DateTimeField(null=True, db_index=True)
+    took = django.db.models.FloatField(null=True)
+    closed = django.db.models.DateTimeField(default=django.utils.timezone.now, db_index=True)
+
+    # Query filters: (argument, field lookup)
+    FILTERS = [("package", "package"),
+               ("version", "version"),
+               ("distribution", "distribution__regex"),
+               ("status", "status")]
+
+    class Meta():
+        abstract = True
+        app_label = "mini_buildd"
+        ordering = ["-closed"]
+
+    class Admin(django.contrib.admin.ModelAdmin):
+        list_display = ["closed", "package", "version", "distribution", "status", "took"]
+        list_filter = ["status"]
+        search_fields = ["package", "version", "distribution"]
+
+        def has_add_permission(self, _request):
+            return False
+
+        def has_change_permission(self, _request, _obj=None):
+            return False
+
+    @classmethod
+    def _mbd_took(cls, took):
+        """Packages and builds give 'n/a' if not finished."""
+        return took if isinstance(took, (int, float)) else None
+
+    @classmethod
+    def mbd_filter(cls, days=0, **filters):
+        """Filter by (non-empty) FILTERS values, and closed within the last days (if positive)."""
+        kwargs = {lookup: filters[key] for key, lookup in cls.FILTERS if filters.get(key)}
+        if days > 0:
+            kwargs["closed__gte"] = django.utils.timezone.now() - datetime.timedelta(days=days)
+        return cls.objects.filter(**kwargs)
+
+    @classmethod
+    def mbd_query(cls, page=1, page_size=50, **filters):
+        """Get page (a django paginator page) of filtered history entries (latest first)."""
+        return django.core.paginator.Paginator(cls.mbd_filter(**filters), page_size).get_page(page)
+
+    @classmethod
+    def mbd_stats(cls, **filters):
+        """Get number, and average, minimum and maximum time it took of filtered history entries."""
+        return cls.mbd_filter(**filters).aggregate(count=django.db.models.Count("id"),
+                                                   took_avg=django.db.models.Avg("took"),
+                                                   took_min=django.db.models.Min("took"),
+                                                   took_max=django.db.models.Max("took"))
+
+    @classmethod
+    def mbd_expire(cls, days):
+        """Remove entries older than days."""
+        expired, _details = cls.objects.filter(closed__lt=django.utils.timezone.now() - datetime.timedelta(days=days)).delete()
+        return expired
+
+
+class PackageHistory(History):
+    log = django.db.models.CharField(max_length=512, blank=True)
+    # JSON: Per-architecture build requests and results
+    data = django.db.models.TextField(blank=True, default="{}")
+
+    class Meta(History.Meta):
+        verbose_name_plural = "Package history"
+
+    def __str__(self):
+        return mini_buildd.misc.pkg_fmt(self.status, self.distribution, self.package, self.version, message=self.status_desc)
+
+    @classmethod
+    def mbd_add(cls, package):
+        """Add closed package (packager.Package)."""
+        def bres(results):
+            return {a: {"bres_stat": r.bres_stat,
+                        "log": os.path.join("/log", r.get_pkglog_dir(package.get_status() == package.INSTALLED), mini_buildd.misc.PkgLog.archived_name(r.buildlog_name))}
+                    for a, r in list(results.items())}
+
+        return cls.objects.create(package=package.changes["source"],
+                                  version=package.changes["version"],
+                                  distribution=package.changes["distribution"],
+                                  status=package.status,
+                                  status_desc=package.status_desc,
+                                  started=package.started,
+                                  took=cls._mbd_took(package.took),
+                                  log=os.path.join("/mini_buildd/log", os.path.dirname(package.changes.get_pkglog_dir(installed=True))),
+                                  data=json.dumps({"requests": {a: {} for a in package.requests},
+                                                   "success": bres(package.success),
+                                                   "failed": bres(package.failed)}))
+
+    # Compatibility with packager.Package (status display)
+    @property
+    def changes(self):
+        return {"source": self.package, "version": self.version, "distribution": self.distribution}
+
+    def _mbd_data(self):
+        return json.loads(self.data) if self.data else {}
+
+    @property
+    def requests(self):
+        return self._mbd_data().get("requests", {})
+
+    @property
+    def success(self):
+        return self._mbd_data().get("success", {})
+
+    @property
+    def failed(self):
+        return self._mbd_data().get("failed", {})
+
+
+class BuildHistory(History):
+    architecture = django.db.models.CharField(max_length=50, db_index=True)
+    uploaded = django.db.models.DateTimeField(null=True)
+    upload_result_to = django.db.models.CharField(max_length=255, blank=True)
+    live_buildlog_url = django.db.models.CharField(max_length=512, blank=True)
+    sbuild_status = django.db.models.CharField(max_length=50, blank=True)
+
+    FILTERS = History.FILTERS + [("architecture", "architecture")]
+
+    # Number of latest builds to average for predictions
+    PREDICT_SAMPLES = 5
+    # Status of builds with an uploaded build result (see builder.Build), and sbuild status of successful builds
+    STATUS_UPLOADED = "UPLOADED"
+    SBUILD_STATUS_SUCCESSFUL = "successful"
+
+    class Meta(History.Meta):
+        verbose_name_plural = "Build history"
+        index_together = [("package", "architecture")]
+
+    class Admin(History.Admin):
+        list_display = ["closed", "package", "version", "distribution", "architecture", "status", "sbuild_status", "took"]
+        list_filter = ["status", "sbuild_status", "architecture"]
+
+    def __str__(self):
+        return mini_buildd.misc.pkg_fmt(self.status, self.distribution, self.package, self.version, extra=self.architecture, message=self.status_desc)
+
+    @classmethod
+    def mbd_predict(cls, package, architecture, codename):
+        """
+        Predict the time (in seconds) a build will take: Tuple (seconds, from_package_history), or (None, False) if there is no history.
+
+        Averages the latest successful builds of the package in the same
+        chroot (codename and architecture), falling back to the latest
+        successful builds of the package on the same architecture, then
+        to the latest successful builds on the same architecture. Successful
+        means sbuild succeeded, and the build result was uploaded.
+
+        The latter (from_package_history False) is only a rough guess
+        for queue ordering and ETA, and must not be used to judge a
+        running build.
+        """
+        for filters, from_package_history in [({"package": package, "architecture": architecture, "distribution__startswith": codename + "-"}, True),
+                                              ({"package": package, "architecture": architecture}, True),
+                                              ({"architecture": architecture}, False)]:
+            took = cls.objects.filter(took__isnull=False, status=cls.STATUS_UPLOADED, sbuild_status=cls.SBUILD_STATUS_SUCCESSFUL, **filters).values_list("took", flat=True)[:cls.PREDICT_SAMPLES]
+            if took:
+                return round(sum(took) / len(took), 1), from_package_history
+        return None, False
+
+    @classmethod
+    def mbd_add(cls, build):
+        """Add closed build (builder.Build)."""
+        return cls.objects.create(package=build.package,
+                                  version=build.version,
+                                  distribution=build.distribution,
+                                  architecture=build.architecture,
+                                  status=build.status,
+                                  status_desc=build.status_desc,
+                                  started=build.started,
+                                  took=cls._mbd_took(build.took),
+                                  uploaded=build.uploaded,
+                                  upload_result_to=build.upload_result_to,
+                                  live_buildlog_url=build.live_buildlog_url,
+                                  sbuild_status=build.sbuild_status)
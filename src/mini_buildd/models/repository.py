@@ -4,16 +4,17 @@ import contextlib
 import shutil
 import glob
 import re
+import threading
 import logging
 
 import django.db
 import django.core.exceptions
-import django.contrib.auth.models
 
 import debian.debian_support
 
 import mini_buildd.config
 import mini_buildd.misc
+import mini_buildd.events
 import mini_buildd.gnupg
 import mini_buildd.reprepro
 
@@ -23,6 +24,8 @@ import mini_buildd.models.base
 from mini_buildd.models.msglog import MsgLog
 LOG = logging.getLogger(__name__)
 
+_PURGE_JOURNAL_LOCK = threading.Lock()
+
 
 class EmailAddress(mini_buildd.models.base.Model):
     address = django.db.models.EmailField(primary_key=True, max_length=255)
@@ -704,6 +707,18 @@ Example:
 
     external_home_url = django.db.models.URLField(blank=True)
 
+    # Configuration to prefetch for the helpers below (see mbd_prefetch(), mbd_snapshot())
+    PREFETCH = ["distributions__base_source__components",
+                "distributions__base_source__archives",
+                "distributions__components",
+                "distributions__architectures",
+                "distributions__architectureoption_set__architecture",
+                "distributions__extra_sources__source__components",
+                "distributions__extra_sources__source__archives",
+                "distributions__extra_sources__source__apt_keys",
+                "layout__suiteoption_set__suite",
+                "layout__suiteoption_set__migrates_to__suite"]
+
     class Meta(mini_buildd.models.base.StatusModel.Meta):
         verbose_name_plural = "Repositories"
 
@@ -754,24 +769,56 @@ Example:
     def __str__(self):
         return "{i}: {d}".format(i=self.identity, d=" ".join([d.base_source.codename for d in self.distributions.all()]))
 
+    @classmethod
+    def mbd_prefetch(cls, queryset):
+        """Add prefetching of the whole repository configuration to a repository queryset."""
+        return queryset.select_related("layout").prefetch_related(*cls.PREFETCH)
+
+    @classmethod
+    def mbd_get_active(cls):
+        return cls.mbd_prefetch(super().mbd_get_active())
+
+    @classmethod
+    def mbd_get_active_or_auto_reactivate(cls):
+        return cls.mbd_prefetch(super().mbd_get_active_or_auto_reactivate())
+
+    @classmethod
+    def mbd_get_prepared(cls):
+        return cls.mbd_prefetch(super().mbd_get_prepared())
+
+    def mbd_snapshot(self):
+        """
+        Get repository with its configuration prefetched (self if already prefetched).
+
+        Helpers only use ``all()`` on relations of the snapshot, and filter in
+        python, so the configuration is loaded with a constant number of queries.
+        """
+        if "distributions" in getattr(self, "_prefetched_objects_cache", {}):
+            return self
+        return self.mbd_prefetch(Repository.objects.filter(pk=self.pk)).get()
+
+    @classmethod
+    def _mbd_suite_option_matches(cls, suite_option, **suiteoption_filter):
+        """Python version of a (simple) suite option queryset filter: Supports field values and '<fk>__isnull'."""
+        for key, value in suiteoption_filter.items():
+            if key.endswith("__isnull"):
+                if (getattr(suite_option, key[:-len("__isnull")] + "_id") is None) != value:
+                    return False
+            elif getattr(suite_option, key) != value:
+                return False
+        return True
+
     # Note: pylint false-positive: https://github.com/PyCQA/pylint/issues/1553
     def clean(self, *args, **kwargs):  # pylint: disable=arguments-differ
         self.mbd_validate_regex(r"^[a-z0-9]+$", self.identity, "Identity")
         super().clean(*args, **kwargs)
 
-    def mbd_get_uploader_keyring(self):
+    def mbd_get_uploader_keyring(self, uploaders):
+        """Get uploader keyring from active uploaders (see ``snapshot.Uploader``)."""
         gpg = mini_buildd.gnupg.TmpGnuPG()
         # Add keys from django users
-        for u in django.contrib.auth.models.User.objects.filter(is_active=True):
-            LOG.debug("Checking user: {u}".format(u=u))
-
-            uploader = None
-            try:
-                uploader = u.uploader
-            except BaseException as e:
-                LOG.warning("User '{u}' does not have an uploader profile (deliberately removed?): {e}".format(u=u, e=e))
-
-            if uploader and uploader.mbd_is_active() and uploader.may_upload_to.all().filter(identity=self.identity):
+        for uploader in uploaders:
+            if self.identity in uploader.repositories:
                 LOG.info("Adding uploader key for '{r}': {k}: {n}".format(r=self, k=uploader.key_long_id, n=uploader.key_name))
                 gpg.add_pub_key(uploader.key)
 
@@ -804,18 +851,21 @@ Example:
 
     def mbd_distribution_strings(self, **suiteoption_filter):
         """Return a list with all full distributions strings, optionally matching a suite options filter (unstable, experimental,...)."""
+        snapshot = self.mbd_snapshot()
+        suite_options = [s for s in snapshot.layout.suiteoption_set.all() if self._mbd_suite_option_matches(s, **suiteoption_filter)]
         result = []
-        for d in self.distributions.all():
-            result += [s.mbd_get_distribution_string(self, d) for s in self.layout.suiteoption_set.filter(**suiteoption_filter)]
+        for d in snapshot.distributions.all():
+            result += [s.mbd_get_distribution_string(snapshot, d) for s in suite_options]
         return result
 
     def _mbd_find_dist(self, distribution):
         LOG.debug("Finding dist for {d}".format(d=distribution.get()))
 
         if distribution.repository == self.identity:
-            for d in self.distributions.all():
+            snapshot = self.mbd_snapshot()
+            for d in snapshot.distributions.all():
                 if d.base_source.codename == distribution.codename:
-                    for s in self.layout.suiteoption_set.all():
+                    for s in snapshot.layout.suiteoption_set.all():
                         if s.suite.name == distribution.suite:
                             return d, s
         raise Exception("No such distribution in repository {i}: {d}".format(i=self.identity, d=distribution.get()))
@@ -828,6 +878,7 @@ Example:
         return result
 
     def mbd_get_internal_suite_dependencies(self, suite_option):
+        suite_options = {s.pk: s for s in self.mbd_snapshot().layout.suiteoption_set.all()}
         result = []
 
         # Add ourselves
@@ -835,14 +886,15 @@ Example:
 
         if suite_option.experimental:
             # Add all non-experimental suites
-            for s in self.layout.suiteoption_set.all().filter(experimental=False):
-                result.append(s)
+            for s in suite_options.values():
+                if not s.experimental:
+                    result.append(s)
         else:
             # Add all suites that we migrate to
-            s = suite_option.migrates_to
+            s = suite_options.get(suite_option.migrates_to_id)
             while s:
                 result.append(s)
-                s = s.migrates_to
+                s = suite_options.get(s.migrates_to_id)
 
         return result
 
@@ -864,12 +916,14 @@ DebIndices: Packages Release . .gz .bz2
 DscIndices: Sources Release . .gz .bz2
 """
         result = ""
-        for d in self.distributions.all():
-            for s in self.layout.suiteoption_set.all():
+        snapshot = self.mbd_snapshot()
+        origin = self.mbd_get_daemon().model.mbd_get_archive_origin()
+        for d in snapshot.distributions.all():
+            for s in snapshot.layout.suiteoption_set.all():
                 result += dist_template.format(
                     distribution=s.mbd_get_distribution_string(self, d),
-                    meta_distributions=" ".join(self.mbd_get_meta_distributions(d, s)),
-                    origin=self.mbd_get_daemon().model.mbd_get_archive_origin(),
+                    meta_distributions=" ".join(snapshot.mbd_get_meta_distributions(d, s)),
+                    origin=origin,
                     components=" ".join(d.mbd_get_components()),
                     architectures=" ".join([x.name for x in d.architectures.all()]),
                     desc=self.mbd_get_description(d, s),
@@ -880,7 +934,7 @@ DscIndices: Sources Release . .gz .bz2
                     result += dist_template.format(
                         distribution=s.mbd_get_distribution_string(self, d, r),
                         meta_distributions="",
-                        origin=self.mbd_get_daemon().model.mbd_get_archive_origin(),
+                        origin=origin,
                         components=" ".join(d.mbd_get_components()),
                         architectures=" ".join([x.name for x in d.architectures.all()]),
                         desc="{d}: Automatic rollback distribution #{r}".format(d=self.mbd_get_description(d, s), r=r),
@@ -892,10 +946,15 @@ DscIndices: Sources Release . .gz .bz2
     def _mbd_reprepro(self):
         return mini_buildd.reprepro.Reprepro(basedir=self.mbd_get_path())
 
+    def mbd_reprepro_deferred_export(self):
+        """Context for bulk operations: Package migrations and removals export changed indices only once (on exit)."""
+        return self._mbd_reprepro().deferred_export()
+
     def mbd_package_list(self, pattern, typ=None, with_rollbacks=False, dist_regex=""):
         result = []
-        for d in self.distributions.all():
-            for s in self.layout.suiteoption_set.all():
+        snapshot = self.mbd_snapshot()
+        for d in snapshot.distributions.all():
+            for s in snapshot.layout.suiteoption_set.all():
                 rollbacks = s.rollback if with_rollbacks else 0
                 for rollback in [None] + list(range(rollbacks)):
                     dist_str = s.mbd_get_distribution_string(self, d, rollback)
@@ -1012,6 +1071,7 @@ DscIndices: Sources Release . .gz .bz2
         return self._mbd_package_find(self._mbd_reprepro().show(package), distribution, version)
 
     def mbd_package_notify(self, status, distribution, pkg, body, extra=None, message=None, msglog=LOG):
+        mini_buildd.events.publish(mini_buildd.events.REPOSITORY, status, repository=self.identity, package=pkg["source"], version=pkg["sourceversion"], distribution=distribution)
         pkg_log = mini_buildd.misc.PkgLog(self.identity, True, pkg["source"], pkg["sourceversion"])
         self.mbd_get_daemon().model.mbd_notify(mini_buildd.misc.pkg_fmt(status,
                                                                         distribution,
@@ -1026,19 +1086,63 @@ DscIndices: Sources Release . .gz .bz2
                                                msglog=msglog)
 
     def _mbd_package_purge_orphaned_logs(self, package, msglog=LOG):
+        # Note: Glob logs prior to querying reprepro: Logs are written after installation, so logs of packages installed meanwhile are never considered orphaned
+        pkg_logs = glob.glob(mini_buildd.misc.PkgLog.get_path(self.identity, True, package, "*"))
         pkg_show = self._mbd_reprepro().show(package)
-        for pkg_log in glob.glob(mini_buildd.misc.PkgLog.get_path(self.identity, True, package, "*")):
+        for pkg_log in pkg_logs:
             msglog.debug("Checking package log: {p}".format(p=pkg_log))
             if not self._mbd_package_find(pkg_show, version=os.path.basename(os.path.realpath(pkg_log))):
-                shutil.rmtree(pkg_log, ignore_errors=True)
+                mini_buildd.misc.PkgLog.purge(pkg_log)
                 msglog.info("Purging orphaned package log: {p}".format(p=pkg_log))
 
-    def mbd_package_purge_orphaned_logs(self, package=None, msglog=LOG):
+    def _mbd_purge_journal_path(self):
+        return os.path.join(mini_buildd.misc.PkgLog.get_path(self.identity, True, ""), ".purge-journal")
+
+    def mbd_package_journal(self, package):
+        """Note package as changed in the purge journal (see ``mbd_package_purge_orphaned_logs``)."""
+        path = self._mbd_purge_journal_path()
+        with _PURGE_JOURNAL_LOCK:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with mini_buildd.misc.open_utf8(path, "a") as f:
+                f.write(package + "\n")
+
+    def _mbd_purge_journal_pop(self):
+        """Get (and reset) all packages noted in the purge journal."""
+        path = self._mbd_purge_journal_path()
+        with _PURGE_JOURNAL_LOCK:
+            try:
+                with mini_buildd.misc.open_utf8(path) as f:
+                    packages = set(f.read().split())
+            except FileNotFoundError:
+                return set()
+            os.remove(path)
+        return packages
+
+    def mbd_package_purge_orphaned_logs(self, package=None, full=False, msglog=LOG):
+        """
+        Purge orphaned package logs (i.e., logs of versions no longer in the repository).
+
+        Install, migrate and remove note changed packages in a
+        journal; per default, only these packages are checked
+        (one reprepro call each). With ``full``, all package logs
+        are checked against one bulk query.
+        """
         if package:
             self._mbd_package_purge_orphaned_logs(package, msglog=msglog)
+        elif full:
+            # Journal is covered by the full sweep
+            self._mbd_purge_journal_pop()
+            # Note: Glob logs prior to querying reprepro (see _mbd_package_purge_orphaned_logs())
+            pkg_logs = glob.glob(mini_buildd.misc.PkgLog.get_path(self.identity, True, "[!_]*", "*"))
+            source_versions = self._mbd_reprepro().source_versions()
+            for pkg_log in pkg_logs:
+                version_path = os.path.normpath(pkg_log)
+                if (os.path.basename(os.path.dirname(version_path)), mini_buildd.misc.strip_epoch(os.path.basename(version_path))) not in source_versions:
+                    mini_buildd.misc.PkgLog.purge(version_path)
+                    msglog.info("Purging orphaned package log: {p}".format(p=version_path))
         else:
-            for pkg_dir in glob.glob(mini_buildd.misc.PkgLog.get_path(self.identity, True, "[!_]*")):
-                self._mbd_package_purge_orphaned_logs(os.path.basename(os.path.realpath(pkg_dir)), msglog=msglog)
+            for p in sorted(self._mbd_purge_journal_pop()):
+                self._mbd_package_purge_orphaned_logs(p, msglog=msglog)
 
     def _mbd_package_shift_rollbacks(self, distribution, suite_option, package_name):
         reprepro_output = ""
@@ -1095,8 +1199,8 @@ DscIndices: Sources Release . .gz .bz2
             # Actually migrate package in reprepro
             reprepro_output += self._mbd_reprepro().migrate(package, src_dist, dst_dist, version)
 
-        # Finally, purge any now-maybe-orphaned package logs
-        self.mbd_package_purge_orphaned_logs(package, msglog=msglog)
+        # Finally, note package for purging of now-maybe-orphaned package logs
+        self.mbd_package_journal(package)
 
         # Notify
         self.mbd_package_notify("MIGRATED", dst_dist, src_pkg, reprepro_output, msglog=msglog)
@@ -1144,8 +1248,8 @@ DscIndices: Sources Release . .gz .bz2
                                                      e,
                                                      logging.WARN)
 
-        # Finally, purge any now-maybe-orphaned package logs
-        self.mbd_package_purge_orphaned_logs(package, msglog=msglog)
+        # Finally, note package for purging of now-maybe-orphaned package logs
+        self.mbd_package_journal(package)
 
         # Notify
         self.mbd_package_notify("REMOVED", dist_str, src_pkg, reprepro_output, msglog=msglog)
@@ -1213,8 +1317,8 @@ DscIndices: Sources Release . .gz .bz2
             else:
                 self._mbd_package_install(bres, dist_str)
 
-        # Finally, purge any now-maybe-orphaned package logs
-        self.mbd_package_purge_orphaned_logs(package)
+        # Finally, note package for purging of now-maybe-orphaned package logs
+        self.mbd_package_journal(package)
 
     def mbd_prepare(self, _request):
         """Idempotent repository preparation. This may be used as-is as mbd_sync."""
@@ -1262,15 +1366,11 @@ gnupghome {h}
         # Reprepro check
         MsgLog(LOG, request).log_text(self._mbd_reprepro().check())
 
-        # Purge orphaned logs.
-        # Note: This may take some time on bigger repos. We
-        # usually run this per package on install/remove/migrate
-        # anyway, so maybe this could eventually be moved to a
-        # better place.
+        # Purge orphaned logs of packages changed since the last purge (full sweeps are run by maintenance)
         self.mbd_package_purge_orphaned_logs(msglog=MsgLog(LOG, request))
 
         # Check for ambiguity with other repos in meta distribution maps
-        get_meta_distribution_map()
+        get_distribution_maps(self.mbd_prefetch(Repository.objects.all()))
 
     def mbd_get_dependencies(self):
         result = []
@@ -1280,25 +1380,26 @@ gnupghome {h}
         return result
 
 
-def get_meta_distribution_map():
-    """Get a dict of the meta distributions: meta -> actual."""
-    result = {}
-    for r in Repository.objects.all():
+def get_distribution_maps(repositories):
+    """
+    Get distribution maps of repositories (model objects, see ``Repository.mbd_prefetch()``).
+
+    * meta: Meta distribution -> actual distribution string.
+    * distributions: Distribution string -> (repository, distribution, suite option) model objects.
+    """
+    meta, distributions = {}, {}
+    for r in repositories:
         for d in r.distributions.all():
             for s in r.layout.suiteoption_set.all():
+                distribution = s.mbd_get_distribution_string(r, d)
+                distributions[distribution] = (r, d, s)
                 for m in r.mbd_get_meta_distributions(d, s):
-                    distribution = s.mbd_get_distribution_string(r, d)
-                    if m in result:
+                    if m in meta:
                         raise Exception("Ambiguous Meta-Distributions ({m0}={d0} or {d1}). "
                                         "Please check Repositories and Layouts (see Layouts/Meta-Distributions in Administrators Manual).".format(m0=m,
                                                                                                                                                   d0=distribution,
-                                                                                                                                                  d1=result[m]))
-                    result[m] = distribution
-
-    LOG.debug("Got meta distribution map: {m}".format(m=result))
-    return result
-
+                                                                                                                                                  d1=meta[m]))
+                    meta[m] = distribution
 
-def map_incoming_distribution(incoming_dist):
-    """Map incoming distribution to internal."""
-    return get_meta_distribution_map().get(incoming_dist, incoming_dist)
+    LOG.debug("Got meta distribution map: {m}".format(m=meta))
+    return meta, distributions
@@ -0,0 +1,272 @@
+"""
+Immutable configuration snapshot for the daemon's hot path.
+
+The snapshot holds everything packaging, building and status need
+from the configuration -- distributions (with repository, suite and
+architecture options), repositories, chroots, remotes and uploaders --
+as frozen records. It's built on first use, and rebuilt (then atomically
+swapped) on first use after any relevant model change. Workers just
+get the current snapshot (see ``get()``), and never touch the
+database for configuration.
+
+Model objects referenced from records are shared (with their
+configuration prefetched, see ``Repository.mbd_snapshot()``): Treat
+as read-only.
+"""
+
+import types
+import threading
+import logging
+
+import django.db.models.signals
+import django.contrib.auth.models
+
+import mini_buildd.misc
+
+import mini_buildd.models.source
+import mini_buildd.models.repository
+import mini_buildd.models.chroot
+import mini_buildd.models.gnupg
+
+LOG = logging.getLogger(__name__)
+
+
+class Frozen():
+    """
+    Immutable record (all slots must be given as keyword arguments).
+
+    >>> class Point(Frozen):
+    ...     __slots__ = ("x", "y")
+    >>> p = Point(x=1, y=2)
+    >>> p
+    Point(x=1, y=2)
+    >>> p == Point(x=1, y=2), p == Point(x=1, y=3), len({p, Point(x=1, y=2)})
+    (True, False, 1)
+    >>> p.x = 3
+    Traceback (most recent call last):
+    ...
+    AttributeError: Point is read-only
+    >>> p.z = 3
+    Traceback (most recent call last):
+    ...
+    AttributeError: Point is read-only
+    >>> Point(x=1)
+    Traceback (most recent call last):
+    ...
+    KeyError: 'y'
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{c} is read-only".format(c=self.__class__.__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{c} is read-only".format(c=self.__class__.__name__))
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self._values() == other._values()  # pylint: disable=protected-access
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return "{c}({v})".format(c=self.__class__.__name__, v=", ".join("{n}={v!r}".format(n=name, v=getattr(self, name)) for name in self.__slots__))
+
+
+class Architecture(Frozen):
+    """Architecture option of a distribution."""
+    __slots__ = ("name", "optional", "build_architecture_all")
+
+
+class Distribution(Frozen):
+    """Full distribution (like 'stretch-test-unstable'), with repository, distribution and suite option model objects."""
+    __slots__ = ("string", "codename", "architectures", "repository", "distribution", "suite")
+
+
+class Chroot(Frozen):
+    """Active chroot."""
+    __slots__ = ("pk", "codename", "architecture")
+
+    @classmethod
+    def from_model(cls, chroot):
+        return cls(pk=chroot.pk, codename=chroot.source.codename, architecture=chroot.architecture.name) if chroot.mbd_is_active() else None
+
+
+class Remote(Frozen):
+    """Active (or auto-reactivate) remote, with its model object."""
+    __slots__ = ("pk", "http", "key", "model")
+
+    @classmethod
+    def from_model(cls, remote):
+        return cls(pk=remote.pk, http=remote.http, key=remote.key, model=remote) if remote.mbd_is_active() or remote.last_checked == remote.CHECK_REACTIVATE else None
+
+
+class Uploader(Frozen):
+    """Active uploader key (of an active user), with the identities of the repositories it may upload to."""
+    __slots__ = ("pk", "key", "key_long_id", "key_name", "repositories")
+
+    @classmethod
+    def from_model(cls, uploader):
+        return cls(pk=uploader.pk,
+                   key=uploader.key,
+                   key_long_id=uploader.key_long_id,
+                   key_name=uploader.key_name,
+                   repositories=tuple(sorted(r.identity for r in uploader.may_upload_to.all()))) if uploader.user.is_active and uploader.mbd_is_active() else None
+
+
+class Snapshot(Frozen):
+    """
+    Configuration snapshot.
+
+    * meta: Meta distribution -> distribution string.
+    * distributions: Distribution string -> Distribution.
+    * repositories: Active repository model objects.
+    * chroots: Active Chroots.
+    * remotes: Active (or auto-reactivate) Remotes.
+    * uploaders: Active Uploaders.
+    """
+
+    __slots__ = ("version", "meta", "distributions", "repositories", "chroots", "remotes", "uploaders")
+
+    @property
+    def codenames(self):
+        """Codenames of all active repositories (in configuration order)."""
+        codenames = []
+        for r in self.repositories:
+            for d in r.distributions.all():
+                if d.base_source.codename not in codenames:
+                    codenames.append(d.base_source.codename)
+        return codenames
+
+    def map_meta(self, dist):
+        """Map meta distribution (other strings are returned as-is)."""
+        return self.meta.get(dist, dist)
+
+    def get_distribution(self, dist):
+        """Get Distribution and rollback number from distribution string (may be a meta distribution)."""
+        dist_parsed = mini_buildd.misc.Distribution(self.map_meta(dist))
+        try:
+            return self.distributions[dist_parsed.get(rollback=False)], dist_parsed.rollback_no
+        except KeyError:
+            raise Exception("No such distribution: '{d}' (repository '{r}', codename '{c}', suite '{s}').".format(d=dist_parsed.get(), r=dist_parsed.repository, c=dist_parsed.codename, s=dist_parsed.suite))
+
+    def parse(self, dist):
+        """Get repository, distribution and suite option model objects (plus rollback number) from distribution string."""
+        distribution, rollback_no = self.get_distribution(dist)
+        return distribution.repository, distribution.distribution, distribution.suite, rollback_no
+
+
+class Configuration():
+    """Holds the current snapshot."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = 0
+
+    @property
+    def version(self):
+        """Incremented on each change of relevant models."""
+        return self._version
+
+    def invalidate(self, **_kwargs):
+        with self._lock:
+            self._snapshot = None
+            self._version += 1
+
+    def record_changed(self, instance, **_kwargs):
+        """Chroots, remotes and uploaders are saved on each check (users on each login): Only invalidate if their record actually changes."""
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is not None:
+            try:
+                if isinstance(instance, mini_buildd.models.chroot.Chroot):
+                    record, records = Chroot, snapshot.chroots
+                elif isinstance(instance, mini_buildd.models.gnupg.Remote):
+                    record, records = Remote, snapshot.remotes
+                else:
+                    record, records = Uploader, snapshot.uploaders
+                    if isinstance(instance, django.contrib.auth.models.User):
+                        instance = instance.uploader
+                if next((r for r in records if r.pk == instance.pk), None) == record.from_model(instance):
+                    return
+            except BaseException as e:
+                LOG.debug("Can't compare record of {i} (invalidating): {e}".format(i=instance, e=e))
+        self.invalidate()
+
+    @classmethod
+    def _build(cls, version):
+        repositories = list(mini_buildd.models.repository.Repository.mbd_prefetch(mini_buildd.models.repository.Repository.objects.all()))
+        meta, distributions = mini_buildd.models.repository.get_distribution_maps(repositories)
+
+        snapshot = Snapshot(
+            version=version,
+            meta=types.MappingProxyType(meta),
+            distributions=types.MappingProxyType({string: Distribution(string=string,
+                                                                       codename=d.base_source.codename,
+                                                                       architectures=tuple(Architecture(name=ao.architecture.name,
+                                                                                                        optional=ao.optional,
+                                                                                                        build_architecture_all=ao.build_architecture_all)
+                                                                                           for ao in d.architectureoption_set.all()),
+                                                                       repository=r,
+                                                                       distribution=d,
+                                                                       suite=s)
+                                                  for string, (r, d, s) in distributions.items()}),
+            repositories=tuple(r for r in repositories if r.mbd_is_active()),
+            chroots=tuple(Chroot.from_model(c) for c in mini_buildd.models.chroot.Chroot.mbd_get_active().select_related("source", "architecture")),
+            remotes=tuple(Remote.from_model(r) for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate()),
+            uploaders=tuple(u for u in (Uploader.from_model(u) for u in mini_buildd.models.gnupg.Uploader.objects.filter(user__is_active=True).select_related("user").prefetch_related("may_upload_to"))
+                            if u is not None))
+
+        LOG.debug("Configuration snapshot {v}: {d} distributions, {c} chroots, {r} remotes, {u} uploaders.".format(v=version, d=len(snapshot.distributions), c=len(snapshot.chroots), r=len(snapshot.remotes), u=len(snapshot.uploaders)))
+        return snapshot
+
+    def get(self):
+        with self._lock:
+            if self._snapshot is not None:
+                return self._snapshot
+            version = self._version
+
+        snapshot = self._build(version)
+
+        with self._lock:
+            # Don't cache if invalidated meanwhile
+            if version == self._version:
+                self._snapshot = snapshot
+        return snapshot
+
+
+CONFIGURATION = Configuration()
+
+
+def get():
+    """Get the current configuration snapshot."""
+    return CONFIGURATION.get()
+
+
+for _signal in [django.db.models.signals.post_save, django.db.models.signals.post_delete]:
+    for _sender in [mini_buildd.models.repository.Repository, mini_buildd.models.repository.Distribution, mini_buildd.models.repository.ArchitectureOption,
+                    mini_buildd.models.repository.Layout, mini_buildd.models.repository.SuiteOption, mini_buildd.models.repository.Suite,
+                    mini_buildd.models.source.Source, mini_buildd.models.source.PrioritySource, mini_buildd.models.source.Archive,
+                    mini_buildd.models.source.Component, mini_buildd.models.source.Architecture]:
+        _signal.connect(CONFIGURATION.invalidate, sender=_sender, dispatch_uid="mini_buildd_configuration")
+
+for _m2m in [mini_buildd.models.repository.Repository.distributions, mini_buildd.models.repository.Distribution.components, mini_buildd.models.repository.Distribution.extra_sources,
+             mini_buildd.models.source.Source.archives, mini_buildd.models.source.Source.components, mini_buildd.models.source.Source.apt_keys,
+             mini_buildd.models.gnupg.Uploader.may_upload_to]:
+    django.db.models.signals.m2m_changed.connect(CONFIGURATION.invalidate, sender=_m2m.through, dispatch_uid="mini_buildd_configuration")
+
+# Signals are sent with the actual (derived) model class as sender
+for _sender in [mini_buildd.models.chroot.Chroot, mini_buildd.models.chroot.DirChroot, mini_buildd.models.chroot.FileChroot,
+                mini_buildd.models.chroot.LVMChroot, mini_buildd.models.chroot.LoopLVMChroot, mini_buildd.models.chroot.BtrfsSnapshotChroot,
+                mini_buildd.models.gnupg.Remote, mini_buildd.models.gnupg.Uploader, django.contrib.auth.models.User]:
+    django.db.models.signals.post_save.connect(CONFIGURATION.record_changed, sender=_sender, dispatch_uid="mini_buildd_configuration")
+    django.db.models.signals.post_delete.connect(CONFIGURATION.invalidate, sender=_sender, dispatch_uid="mini_buildd_configuration")
@@ -1,4 +1,5 @@
 import tempfile
+import time
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -7,6 +8,8 @@ import contextlib
 import copy
 import datetime
 import socket
+import threading
+import concurrent.futures
 
 import dateutil.parser
 
@@ -29,6 +32,66 @@ from mini_buildd.models.msglog import MsgLog
 LOG = logging.getLogger(__name__)
 
 
+class ArchiveCache():
+    """
+    Cache for archive queries (pings, downloads), shared by all source checks of a check run.
+
+    Each query is run only once per check run, even if requested
+    concurrently; exceptions are cached too. Outside a check run
+    (see ``run()``), nothing is cached.
+
+    >>> cache = ArchiveCache()
+    >>> calls = []
+    >>> def query():
+    ...     calls.append(None)
+    ...     return len(calls)
+    >>> cache.get("key", query), cache.get("key", query)
+    (1, 2)
+    >>> with cache.run():
+    ...     cache.get("key", query), cache.get("key", query)
+    (3, 3)
+    >>> cache.get("key", query)
+    4
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._entries = {}
+
+    @contextlib.contextmanager
+    def run(self):
+        """Check run (may be nested or concurrent); the cache is cleared when the last run ends."""
+        with self._lock:
+            self._runs += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._runs -= 1
+                if self._runs == 0:
+                    self._entries = {}
+
+    def get(self, key, func):
+        with self._lock:
+            entry = self._entries.setdefault(key, {"lock": threading.Lock()}) if self._runs else None
+        if entry is None:
+            return func()
+
+        with entry["lock"]:
+            if "result" not in entry:
+                try:
+                    entry["result"] = (func(), None)
+                except BaseException as e:
+                    entry["result"] = (None, e)
+        result, exception = entry["result"]
+        if exception is not None:
+            raise exception
+        return result
+
+
+ARCHIVE_CACHE = ArchiveCache()
+
+
 class Archive(mini_buildd.models.base.Model):
     url = django.db.models.URLField(primary_key=True, max_length=512,
                                     default="http://ftp.debian.org/debian/",
@@ -39,6 +102,15 @@ Use the 'directory' notation with exactly one trailing slash (like 'http://examp
 """)
     ping = django.db.models.FloatField(default=-1.0, editable=False)
 
+    # Probing: Weight of a new sample in the moving averages, and minimal download size (bytes) for a throughput sample
+    PROBE_ALPHA = 0.3
+    PROBE_MIN_SIZE = 32 * 1024
+    # Ranking: Estimated time to download this many bytes (a typical package or index), and throughput to assume if not yet measured
+    RANK_SIZE = 1024 * 1024
+    RANK_DEFAULT_THROUGHPUT = 1024 * 1024
+    # Network timeout in seconds
+    TIMEOUT = 30
+
     class Meta(mini_buildd.models.base.Model.Meta):
         ordering = ["url"]
 
@@ -104,7 +176,8 @@ Use the 'directory' notation with exactly one trailing slash (like 'http://examp
             msglog.info("Consider replacing these archives with you closest mirror(s); check netselect-apt.")
 
     def __str__(self):
-        return "{u} (ping {p} ms)".format(u=self.url, p=self.ping)
+        throughput = self.mbd_get_probe_data().get("throughput")
+        return "{u} (ping {p} ms{t})".format(u=self.url, p=round(self.ping, 1), t=", {k} kB/s".format(k=round(throughput / 1024)) if throughput else "")
 
     # Note: pylint false-positive: https://github.com/PyCQA/pylint/issues/1553
     def clean(self, *args, **kwargs):  # pylint: disable=arguments-differ
@@ -112,82 +185,188 @@ Use the 'directory' notation with exactly one trailing slash (like 'http://examp
             raise django.core.exceptions.ValidationError("The URL must have exactly one trailing slash (like 'http://example.org/path/').")
         super().clean(*args, **kwargs)
 
-    def mbd_get_matching_release(self, request, source, gnupg):
-        url = "{u}/dists/{d}/Release".format(u=self.url, d=source.codename)
-        with tempfile.NamedTemporaryFile() as release_file:
-            MsgLog(LOG, request).debug("Downloading '{u}' to '{t}'".format(u=url, t=release_file.name))
+    def _mbd_timed_download(self, url):
+        """Download URL (cached per check run, see ``ArchiveCache``): Tuple (data, seconds the transfer of the body took); data is None on '404 Not Found'."""
+        def download():
             try:
-                release_file.write(mini_buildd.net.urlopen_ca_certificates(url).read())
+                response = mini_buildd.net.urlopen_ca_certificates(url, timeout=self.TIMEOUT)
             except urllib.error.HTTPError as e:
                 if e.code == 404:
-                    MsgLog(LOG, request).debug("{a}: '404 Not Found' on '{u}'".format(a=self, u=url))
-                    # Not for us
-                    return None
+                    return None, 0.0
                 raise
+            # Response headers are in: Only time the transfer, not the request's latency
+            t0 = time.monotonic()
+            data = response.read()
+            return data, time.monotonic() - t0
+        return ARCHIVE_CACHE.get(("download", url), download)
+
+    def _mbd_download(self, url):
+        """Download URL (cached per check run, see ``ArchiveCache``); None on '404 Not Found'."""
+        return self._mbd_timed_download(url)[0]
+
+    def mbd_get_release(self, request, source):
+        """
+        Get release (as ``(release, raw release, raw signature)``) if this archive serves source, else None.
+
+        Network only (no database access, no signature verification), so this may run in parallel for many archives.
+        """
+        url = "{u}/dists/{d}/Release".format(u=self.url, d=source.codename)
+        MsgLog(LOG, request).debug("Downloading '{u}'".format(u=url))
+        raw_release = self._mbd_download(url)
+        if raw_release is None:
+            MsgLog(LOG, request).debug("{a}: '404 Not Found' on '{u}'".format(a=self.url, u=url))
+            # Not for us
+            return None
+        release = debian.deb822.Release(raw_release)
+
+        # Check release file fields
+        if not source.mbd_is_matching_release(request, release):
+            return None
+
+        # Pre-Check 'Valid-Until'
+        #
+        # Some Release files contain an expire date via the
+        # 'Valid-Until' tag. If such an expired archive is used,
+        # builds will fail. Furthermore, it could be only the
+        # selected archive not updating, while the source may be
+        # perfectly fine from another archive.
+        #
+        # This pre-check avoids such a situation, or at least it
+        # can be fixed by re-checking the source.
+        try:
+            valid_until = release["Valid-Until"]
+            if dateutil.parser.parse(valid_until) < datetime.datetime.now(datetime.timezone.utc):
+                if source.mbd_get_extra_option("X-Check-Valid-Until", "yes").lower() in ("no", "false", "0"):
+                    MsgLog(LOG, request).info("{u} expired, but source marked to ignore valid-until (Valid-Until='{v}').".format(u=url, v=valid_until))
+                else:
+                    MsgLog(LOG, request).warning("{u} expired, maybe the archive has problems? (Valid-Until='{v}').".format(u=url, v=valid_until))
+                    return None
+        except KeyError:
+            pass  # We can assume Release file has no "Valid-Until", and be quiet
+        except BaseException as e:
+            MsgLog(LOG, request).error("Ignoring error checking 'Valid-Until' on {u}: {e}".format(u=url, e=e))
+
+        MsgLog(LOG, request).debug("Downloading '{u}.gpg'".format(u=url))
+        raw_signature = self._mbd_download(url + ".gpg")
+        if raw_signature is None:
+            raise Exception("{u}.gpg: '404 Not Found'".format(u=url))
+        return release, raw_release, raw_signature
+
+    @classmethod
+    def mbd_verify_release(cls, gnupg, raw_release, raw_signature):
+        with tempfile.NamedTemporaryFile() as release_file, tempfile.NamedTemporaryFile() as signature_file:
+            release_file.write(raw_release)
             release_file.flush()
-            release_file.seek(0)
-            release = debian.deb822.Release(release_file)
-
-            # Check release file fields
-            if not source.mbd_is_matching_release(request, release):
-                return None
-
-            # Pre-Check 'Valid-Until'
-            #
-            # Some Release files contain an expire date via the
-            # 'Valid-Until' tag. If such an expired archive is used,
-            # builds will fail. Furthermore, it could be only the
-            # selected archive not updating, while the source may be
-            # perfectly fine from another archive.
-            #
-            # This pre-check avoids such a situation, or at least it
-            # can be fixed by re-checking the source.
-            try:
-                valid_until = release["Valid-Until"]
-                if dateutil.parser.parse(valid_until) < datetime.datetime.now(datetime.timezone.utc):
-                    if source.mbd_get_extra_option("X-Check-Valid-Until", "yes").lower() in ("no", "false", "0"):
-                        MsgLog(LOG, request).info("{u} expired, but source marked to ignore valid-until (Valid-Until='{v}').".format(u=url, v=valid_until))
-                    else:
-                        MsgLog(LOG, request).warning("{u} expired, maybe the archive has problems? (Valid-Until='{v}').".format(u=url, v=valid_until))
-                        return None
-            except KeyError:
-                pass  # We can assume Release file has no "Valid-Until", and be quiet
-            except BaseException as e:
-                MsgLog(LOG, request).error("Ignoring error checking 'Valid-Until' on {u}: {e}".format(u=url, e=e))
+            signature_file.write(raw_signature)
+            signature_file.flush()
+            gnupg.verify(signature_file.name, release_file.name)
+
+    def mbd_get_probe_data(self):
+        """Get probe data: Dict with moving averages of 'latency' (ms) and 'throughput' (bytes/s), and 'probed' (last probe time)."""
+        return self.mbd_get_pickled_data(default={}) if self.pickled_data else {}
 
-            # Check signature
-            with tempfile.NamedTemporaryFile() as signature:
-                MsgLog(LOG, request).debug("Downloading '{u}.gpg' to '{t}'".format(u=url, t=signature.name))
-                signature.write(mini_buildd.net.urlopen_ca_certificates(url + ".gpg").read())
-                signature.flush()
-                gnupg.verify(signature.name, release_file.name)
+    @classmethod
+    def _mbd_moving_average(cls, average, sample):
+        """
+        Exponential moving average.
 
-            # Ok, this is for this source
-            return release
+        >>> Archive._mbd_moving_average(None, 100.0)
+        100.0
+        >>> Archive._mbd_moving_average(100.0, 200.0)
+        130.0
+        """
+        return sample if average is None else round((1 - cls.PROBE_ALPHA) * average + cls.PROBE_ALPHA * sample, 3)
+
+    @classmethod
+    def _mbd_throughput(cls, size, seconds):
+        """
+        Throughput sample (bytes/s) from a transfer's size and time; None if the transfer is too small to tell.
+
+        >>> Archive._mbd_throughput(1024 * 1024, 1.0)
+        1048576.0
+        >>> Archive._mbd_throughput(1024, 1.0) is None, Archive._mbd_throughput(1024 * 1024, 0.0) is None
+        (True, True)
+        """
+        if size < cls.PROBE_MIN_SIZE or seconds <= 0.0:
+            return None
+        return round(size / seconds, 3)
+
+    def mbd_get_throughput(self, source):
+        """Throughput sample from downloading the Release file of source (cached per check run, see ``ArchiveCache``); None if not available."""
+        raw_release, seconds = self._mbd_timed_download("{u}/dists/{d}/Release".format(u=self.url, d=source.codename))
+        return None if raw_release is None else self._mbd_throughput(len(raw_release), seconds)
+
+    def _mbd_update_probe_data(self, latency, throughput=None):
+        """Update moving averages; ping is the latency's moving average, or -1.0 if latency is None (archive down)."""
+        data = self.mbd_get_probe_data()
+        if latency is None:
+            self.ping = -1.0
+        else:
+            data["latency"] = self._mbd_moving_average(data.get("latency"), latency)
+            if throughput:
+                data["throughput"] = self._mbd_moving_average(data.get("throughput"), throughput)
+            self.ping = data["latency"]
+        data["probed"] = django.utils.timezone.now()
+        self.mbd_set_pickled_data(data)
+        # Only save probe values: Probes may run in parallel to admin changes
+        self.save(update_fields=["ping", "pickled_data"])
+
+    def mbd_get_rank(self):
+        """Get rank value (lower is better): Estimated time in ms to download RANK_SIZE bytes from this archive (latency plus transfer time)."""
+        throughput = self.mbd_get_probe_data().get("throughput", self.RANK_DEFAULT_THROUGHPUT)
+        return self.ping + self.RANK_SIZE / throughput * 1000
+
+    def _mbd_ping(self):
+        """Ping, and return latency in ms."""
+        t0 = time.monotonic()
+        # Append dists to URL for ping check: Archive may be
+        # just fine, but not allow to access to base URL
+        # (like ourselves ;). Any archive _must_ have dists/ anyway.
+        try:
+            mini_buildd.net.urlopen_ca_certificates("{u}/dists/".format(u=self.url), timeout=self.TIMEOUT)
+        except urllib.error.HTTPError as e:
+            # Allow HTTP 4xx client errors through; these might be valid use cases like:
+            # 404 Usage Information: apt-cacher-ng
+            if not 400 <= e.code <= 499:
+                raise
+        return (time.monotonic() - t0) * (10 ** 3)
+
+    def mbd_get_latency(self):
+        """Ping (cached per check run, see ``ArchiveCache``), and return latency in ms."""
+        return ARCHIVE_CACHE.get(("ping", self.url), self._mbd_ping)
+
+    def mbd_update_ping(self, latency, throughput=None):
+        """Update the ping value from latency, and the throughput average if given (only once per check run; latency None means the archive is down)."""
+        ARCHIVE_CACHE.get(("update_ping", self.url), lambda: self._mbd_update_probe_data(latency, throughput))
 
     def mbd_ping(self, request):
         """Ping and update the ping value."""
         try:
-            t0 = django.utils.timezone.now()
-            # Append dists to URL for ping check: Archive may be
-            # just fine, but not allow to access to base URL
-            # (like ourselves ;). Any archive _must_ have dists/ anyway.
-            try:
-                mini_buildd.net.urlopen_ca_certificates("{u}/dists/".format(u=self.url))
-            except urllib.error.HTTPError as e:
-                # Allow HTTP 4xx client errors through; these might be valid use cases like:
-                # 404 Usage Information: apt-cacher-ng
-                if not 400 <= e.code <= 499:
-                    raise
-
-            delta = django.utils.timezone.now() - t0
-            self.ping = delta.total_seconds() * (10 ** 3)
-            self.save()
-            MsgLog(LOG, request).debug("{s}: Ping!".format(s=self))
+            latency = self.mbd_get_latency()
         except Exception as e:
-            self.ping = -1.0
-            self.save()
+            self.mbd_update_ping(None)
             raise Exception("{s}: Does not ping: {e}".format(s=self, e=e))
+        self.mbd_update_ping(latency)
+        MsgLog(LOG, request).debug("{s}: Ping!".format(s=self))
+
+    def mbd_probe(self, request):
+        """
+        Probe latency and throughput, and update the moving averages.
+
+        Throughput is sampled from the transfer of the Release file of a
+        source served by this archive (timed after the response headers,
+        so the request's latency is not included). There is no sample if
+        there is no such source yet, or if the Release file is too small
+        (``PROBE_MIN_SIZE``).
+        """
+        try:
+            latency = self._mbd_ping()
+            source = self.source_set.first()
+            self._mbd_update_probe_data(latency, self.mbd_get_throughput(source) if source else None)
+            MsgLog(LOG, request).debug("{s}: Probed (rank {r}).".format(s=self, r=round(self.mbd_get_rank(), 1)))
+        except Exception as e:
+            self._mbd_update_probe_data(None)
+            raise Exception("{s}: Probe failed: {e}".format(s=self, e=e))
 
     def mbd_get_reverse_dependencies(self):
         """Return all sources (and their deps) that use us."""
@@ -330,6 +509,9 @@ codeversion is only used for base sources.""")
     components = django.db.models.ManyToManyField(Component, blank=True)
     architectures = django.db.models.ManyToManyField(Architecture, blank=True)
 
+    # Number of archives to query in parallel on check
+    CHECK_WORKERS = 8
+
     class Meta(mini_buildd.models.base.StatusModel.Meta):
         unique_together = ("origin", "codename")
         ordering = ["origin", "-codeversion", "codename"]
@@ -502,6 +684,12 @@ codeversion is only used for base sources.""")
                                    [keys["archive_2012"], keys["archive_2018"]],
                                    "Codename: disco\nSuite: disco-backports")
 
+        @classmethod
+        def mbd_action(cls, request, queryset, action, **kwargs):
+            """Run action as one check run: Each archive is queried only once for all sources (see ``ArchiveCache``)."""
+            with ARCHIVE_CACHE.run():
+                super().mbd_action(request, queryset, action, **kwargs)
+
         @classmethod
         def mbd_filter_active_base_sources(cls):
             """Filter active base sources; needed in chroot and distribution wizards."""
@@ -538,8 +726,8 @@ codeversion is only used for base sources.""")
         return True
 
     def mbd_get_archive(self):
-        """Get fastest archive."""
-        oa_list = self.archives.all().filter(ping__gte=0.0).order_by("ping")
+        """Get fastest archive (by rank, see ``Archive.mbd_get_rank``)."""
+        oa_list = sorted([a for a in self.archives.all() if a.ping >= 0.0], key=lambda a: a.mbd_get_rank())
         if oa_list:
             return oa_list[0]
         raise Exception("{s}: No archive found. Please add appropriate archive and/or check network setup.".format(s=self))
@@ -585,23 +773,52 @@ codeversion is only used for base sources.""")
         self.description = ""
 
     def mbd_check(self, request):
-        """Rescan all archives, and check that there is at least one working."""
+        """
+        Rescan all archives, and check that there is at least one working.
+
+        Archives are queried in parallel (each network access with
+        ``Archive.TIMEOUT``); database updates and signature checks
+        are done in order afterwards.
+        """
         msglog = MsgLog(LOG, request)
 
+        def query(archive):
+            """Query archive (network only; run in parallel for all archives). Returns (latency, throughput, release); latency None when down, release may be an exception."""
+            try:
+                latency = archive.mbd_get_latency()
+            except BaseException as e:
+                return None, None, e
+            try:
+                release = archive.mbd_get_release(request, self)
+                # Throughput sample from the Release download above (cached)
+                return latency, archive.mbd_get_throughput(self) if release else None, release
+            except BaseException as e:
+                return latency, None, e
+
         self.archives.set([])
-        with contextlib.closing(mini_buildd.gnupg.TmpGnuPG()) as gpg:
+        with contextlib.closing(mini_buildd.gnupg.TmpGnuPG()) as gpg, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self.CHECK_WORKERS) as executor:
             for k in self.apt_keys.all():
                 gpg.add_pub_key(k.key)
 
-            for archive in Archive.objects.all():
+            archives = Archive.objects.all()
+            futures = {archive: executor.submit(query, archive) for archive in archives}
+            for archive in archives:
                 try:
-                    # Check and update the ping value
-                    archive.mbd_ping(request)
+                    latency, throughput, release = futures[archive].result()
 
-                    # Get release if this archive serves us, else exception
-                    release = archive.mbd_get_matching_release(request, self, gpg)
+                    # Update the ping value (and throughput)
+                    archive.mbd_update_ping(latency, throughput)
+                    if latency is None:
+                        raise Exception("{a}: Does not ping: {e}".format(a=archive.url, e=release))
+                    if isinstance(release, BaseException):
+                        raise release
+
+                    # Verify release if this archive serves us
                     if release:
-                        # Implicitly save ping value for this archive
+                        release, raw_release, raw_signature = release
+                        archive.mbd_verify_release(gpg, raw_release, raw_signature)
+
                         self.archives.add(archive)
                         self.description = release["Description"]
 
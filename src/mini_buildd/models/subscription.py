@@ -1,4 +1,7 @@
+import threading
+
 import django.db.models
+import django.db.models.signals
 import django.contrib.auth.models
 
 import mini_buildd.models.base
@@ -14,3 +17,46 @@ class Subscription(mini_buildd.models.base.Model):
         return "User '{u}' subscribes to '{p}' in '{d}'".format(u=self.subscriber,
                                                                 p=self.package if self.package else "any package",
                                                                 d=self.distribution if self.distribution else "any distribution")
+
+    @classmethod
+    def mbd_get_subscribers(cls, package, distribution):
+        """Get subscribers (tuples 'full name, email, is_active') for package in distribution (from cached index)."""
+        index = _INDEX.get()
+        return index.get((package, distribution), []) + index.get((package, ""), []) + index.get(("", distribution), []) + index.get(("", ""), [])
+
+
+class _Index():
+    """Subscribers by (package, distribution); rebuilt on first use after any subscription or user change."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._generation = 0
+
+    def get(self):
+        with self._lock:
+            if self._index is not None:
+                return self._index
+            generation = self._generation
+
+        index = {}
+        for s in Subscription.objects.select_related("subscriber"):
+            index.setdefault((s.package, s.distribution), []).append((s.subscriber.get_full_name(), s.subscriber.email, s.subscriber.is_active))
+
+        with self._lock:
+            # Don't cache if invalidated meanwhile
+            if generation == self._generation:
+                self._index = index
+        return index
+
+    def invalidate(self, **_kwargs):
+        with self._lock:
+            self._index = None
+            self._generation += 1
+
+
+_INDEX = _Index()
+
+for _signal in [django.db.models.signals.post_save, django.db.models.signals.post_delete]:
+    for _sender in [Subscription, django.contrib.auth.models.User]:
+        _signal.connect(_INDEX.invalidate, sender=_sender, dispatch_uid="mini_buildd_subscription_index")
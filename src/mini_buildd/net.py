@@ -1,17 +1,19 @@
 import copy
+import io
 import enum
 import ipaddress
 import socket
 import re
+import threading
+import http.client
 import urllib.request
+import urllib.response
 import urllib.parse
 import urllib.error
 import ssl
 import logging
 import logging.handlers
 
-import twisted.internet.endpoints
-
 import mini_buildd.config
 
 LOG = logging.getLogger(__name__)
@@ -129,6 +131,7 @@ class Endpoint():
 class ServerEndpoint(Endpoint):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        import twisted.internet.endpoints  # Note: Import here: twisted is slow to import, and not needed for client tools
         twisted.internet.endpoints.serverFromString(None, self.desc)  # Syntax check only for now
 
     def __repr__(self):
@@ -142,6 +145,7 @@ class ServerEndpoint(Endpoint):
 class ClientEndpoint(Endpoint):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        import twisted.internet.endpoints  # Note: Import here: twisted is slow to import, and not needed for client tools
         twisted.internet.endpoints.clientFromString(None, self.desc)  # Syntax check only for now
 
     def __repr__(self):
@@ -221,6 +225,136 @@ def urlopen_ca_certificates(url, **kwargs):
     return urllib.request.urlopen(url, context=context, **kwargs)
 
 
+class ConnectionPool():
+    """
+    Persistent (keep-alive) HTTP(S) connections, kept per host (thread-safe).
+
+    ``open()`` is a drop-in for (simple GET) ``urlopen()`` calls
+    (redirects are followed, at most ``MAX_REDIRECTS`` hops). Idle
+    connections are reused; stale ones (closed by the server meanwhile)
+    are transparently replaced.
+
+    >>> import http.server
+    >>> class Handler(http.server.BaseHTTPRequestHandler):
+    ...     protocol_version = "HTTP/1.1"
+    ...     def do_GET(self):
+    ...         body = self.path.encode("UTF-8")
+    ...         self.send_response({"/missing": 404, "/moved": 301, "/loop": 302}.get(self.path, 200))
+    ...         self.send_header("Location", {"/moved": "/api?command=status", "/loop": "/loop"}.get(self.path, ""))
+    ...         self.send_header("Content-Length", str(len(body)))
+    ...         self.end_headers()
+    ...         self.wfile.write(body)
+    ...     def log_message(self, *args):
+    ...         pass
+    >>> server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> url = "http://127.0.0.1:{p}".format(p=server.server_port)
+
+    >>> pool = ConnectionPool(timeout=10)
+    >>> [pool.open(url + "/api?command=status").read() for _ in range(3)]
+    [b'/api?command=status', b'/api?command=status', b'/api?command=status']
+    >>> pool.open(url + "/missing")
+    Traceback (most recent call last):
+    ...
+    urllib.error.HTTPError: HTTP Error 404: Not Found
+    >>> response = pool.open(url + "/moved")
+    >>> response.read(), response.geturl() == url + "/api?command=status"
+    (b'/api?command=status', True)
+    >>> pool.open(url + "/loop")
+    Traceback (most recent call last):
+    ...
+    urllib.error.HTTPError: HTTP Error 302: Too many redirects (10)
+    >>> pool.connections_created
+    1
+    >>> pool.close()
+    >>> server.shutdown()
+    """
+
+    REDIRECT_CODES = [301, 302, 303, 307, 308]
+    MAX_REDIRECTS = 10
+
+    def __init__(self, timeout=None, max_idle=4, cookiejar=None):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.cookiejar = cookiejar
+        self.connections_created = 0
+        self._lock = threading.Lock()
+        # Idle connections: {(scheme, netloc): [connection]}
+        self._idle = {}
+
+    def _get(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections_created += 1
+
+        scheme, netloc = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout, context=ssl.create_default_context()), False
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _put(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, key, selector, headers):
+        while True:
+            connection, reused = self._get(key)
+            try:
+                connection.request("GET", selector, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused:
+                    continue  # Stale keep-alive connection: Retry with a fresh one
+                raise
+            except BaseException:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._put(key, connection)
+            return response, body
+
+    def open(self, url):
+        """GET url; returns urlopen()-like response (with the body already read), or raises ``urllib.error.HTTPError``."""
+        for _hop in range(self.MAX_REDIRECTS + 1):
+            parsed = urllib.parse.urlsplit(url)
+            request = urllib.request.Request(url)
+            if self.cookiejar is not None:
+                self.cookiejar.add_cookie_header(request)
+
+            response, body = self._request((parsed.scheme, parsed.netloc),
+                                           urllib.parse.urlunsplit(("", "", parsed.path or "/", parsed.query, "")),
+                                           dict(request.header_items()))
+
+            if self.cookiejar is not None:
+                self.cookiejar.extract_cookies(response, request)
+            if response.status in self.REDIRECT_CODES and response.headers.get("Location"):
+                url = urllib.parse.urljoin(url, response.headers["Location"])
+                continue
+            if response.status >= 300:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+            return urllib.response.addinfourl(io.BytesIO(body), response.headers, url, response.status)
+
+        raise urllib.error.HTTPError(url, response.status, "Too many redirects ({m})".format(m=self.MAX_REDIRECTS), response.headers, io.BytesIO(body))
+
+
 def detect_apt_cacher_ng(url="http://localhost:3142"):
     """Little heuristic helper for the "local archives" wizard."""
     try:
@@ -1,10 +1,12 @@
 import os
-import shutil
 import logging
 
 import django.utils.timezone
 
 import mini_buildd.misc
+import mini_buildd.events
+
+import mini_buildd.models.history
 
 
 LOG = logging.getLogger(__name__)
@@ -25,7 +27,8 @@ class Package(mini_buildd.misc.Status):
                    self.CHECKING: "CHECKING",
                    self.BUILDING: "BUILDING",
                    self.INSTALLING: "INSTALLING",
-                   self.INSTALLED: "INSTALLED"})
+                   self.INSTALLED: "INSTALLED"},
+            generation=daemon.state_generation)
 
         self.started = django.utils.timezone.now()
         self.finished = None
@@ -56,6 +59,15 @@ class Package(mini_buildd.misc.Status):
                                         extra=" ".join(arch_status()),
                                         message=self.status_desc)
 
+    def set_status(self, status, desc=""):
+        super().set_status(status, desc)
+        mini_buildd.events.publish(mini_buildd.events.PACKAGE,
+                                   self.status,
+                                   package=self.changes["Source"],
+                                   version=self.changes["Version"],
+                                   distribution=self.distribution_string or self.changes["Distribution"],
+                                   desc=desc)
+
     @property
     def took(self):
         return round((self.finished - self.started).total_seconds(), 1) if self.finished else "n/a"
@@ -123,6 +135,8 @@ class Package(mini_buildd.misc.Status):
         else:
             self.failed[arch] = bres
 
+        self.daemon.state_generation.bump()
+
         missing = len(self.requests) - len(self.success) - len(self.failed)
         if missing <= 0:
             self.finished = django.utils.timezone.now()
@@ -169,7 +183,7 @@ class Package(mini_buildd.misc.Status):
             # The pkglog_dir must be non-None on INSTALLED status
             failed_logdir = os.path.dirname(self.changes.get_pkglog_dir(installed=False, relative=False))
             LOG.debug("Purging failed log dir: {f}".format(f=failed_logdir))
-            shutil.rmtree(failed_logdir, ignore_errors=True)
+            mini_buildd.misc.PkgLog.purge(failed_logdir)
 
     def notify(self):
         def header(title, underline="-"):
@@ -182,7 +196,7 @@ class Package(mini_buildd.misc.Status):
                 b=os.path.join(self.daemon.model.mbd_get_http_url(),
                                "log",
                                bres.get_pkglog_dir(self.get_status() == self.INSTALLED),
-                               bres.buildlog_name))
+                               mini_buildd.misc.PkgLog.archived_name(bres.buildlog_name)))
 
         results = header(self.__str__(), "=")
         results += "\n"
@@ -214,52 +228,12 @@ class Package(mini_buildd.misc.Status):
             self.changes)
 
 
-class LastPackage(mini_buildd.misc.API):
-    """Subset of 'Package' for pickled statistics."""
-
-    __API__ = -99
-
-    def __init__(self, package):
-        super().__init__()
-
-        self.identity = package.__str__()
-
-        self.started = package.started
-        self.took = package.took
-        self.log = os.path.join("/mini_buildd/log", os.path.dirname(package.changes.get_pkglog_dir(installed=True)))
-
-        self.changes = {}
-        for k in ["source", "distribution", "version"]:
-            self.changes[k] = package.changes[k]
-
-        self.status = package.status
-        self.status_desc = package.status_desc
-
-        self.requests = {}
-        for a, _r in list(package.requests.items()):
-            self.requests[a] = {}
-
-        def cp_bres(src, dst):
-            for a, r in list(src.items()):
-                dst[a] = {"bres_stat": r.bres_stat,
-                          "log": os.path.join("/log", r.get_pkglog_dir(package.get_status() == package.INSTALLED), r.buildlog_name)}
-
-        self.success = {}
-        cp_bres(package.success, self.success)
-
-        self.failed = {}
-        cp_bres(package.failed, self.failed)
-
-    def __str__(self):
-        return self.identity
-
-
 def package_close(daemon, package):
     """Close package. Just continue on errors, but log them; guarantee to remove it from the packages dict."""
     try:
         package.move_to_pkglog()
         package.notify()
-        daemon.last_packages.appendleft(LastPackage(package))
+        mini_buildd.models.history.PackageHistory.mbd_add(package)
     except BaseException as e:
         mini_buildd.config.log_exception(LOG, "Error closing package '{p}'".format(p=package.pid), e, level=logging.CRITICAL)
     finally:
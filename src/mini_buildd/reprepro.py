@@ -3,6 +3,7 @@
 import os
 import shutil
 import threading
+import contextlib
 
 import logging
 
@@ -12,6 +13,9 @@ LOG = logging.getLogger(__name__)
 
 _LOCKS = {}
 
+# Deferred index exports: {basedir: set of distributions to export}
+_DEFERRED_EXPORTS = {}
+
 
 class Reprepro():
     """
@@ -27,6 +31,13 @@ class Reprepro():
     For the case that someone else is using reprepro
     manually, we also always run it with '--waitforlock'.
 
+    *Deferred exports*
+
+    Each modifying reprepro call exports the indices of the changed
+    distribution. For bulk operations (see ``deferred_export()``),
+    migrations and removals skip that, and all changed distributions
+    are exported with one call in the end.
+
     *Ignoring 'unusedarch' check*
 
     Known broken use case is linux' 'make deb-pkg' up to version 4.13.
@@ -53,7 +64,7 @@ class Reprepro():
     def __init__(self, basedir):
         self._basedir = basedir
         self._cmd = ["reprepro", "--verbose", "--waitforlock", "10", "--ignore", "unusedarch", "--basedir", "{b}".format(b=basedir)]
-        self._lock = _LOCKS.setdefault(self._basedir, threading.Lock())
+        self._lock = _LOCKS.setdefault(self._basedir, threading.RLock())
         LOG.debug("Lock for reprepro repository '{r}': {o}".format(r=self._basedir, o=self._lock))
 
     def _call(self, args, show_command=False):
@@ -64,6 +75,32 @@ class Reprepro():
         with self._lock:
             return self._call(args, show_command)
 
+    def _call_modifying(self, args, distribution):
+        with self._lock:
+            deferred = _DEFERRED_EXPORTS.get(self._basedir)
+            if deferred is None:
+                return self._call(args, show_command=True)
+            deferred.add(distribution)
+            return self._call(["--export=silent-never"] + args, show_command=True)
+
+    @contextlib.contextmanager
+    def deferred_export(self):
+        """Lock repository, and defer index exports of migrations and removals to one export on exit."""
+        with self._lock:
+            if self._basedir in _DEFERRED_EXPORTS:
+                # Nested: Outermost exports
+                yield
+                return
+
+            _DEFERRED_EXPORTS[self._basedir] = set()
+            try:
+                yield
+            finally:
+                distributions = sorted(_DEFERRED_EXPORTS.pop(self._basedir))
+                if distributions:
+                    LOG.info("Exporting {n} distributions: {d}".format(n=len(distributions), d=" ".join(distributions)))
+                    self._call(["export"] + distributions)
+
     def reindex(self):
         with self._lock:
             # Update reprepro dbs, and delete any packages no longer in dists.
@@ -113,11 +150,36 @@ class Reprepro():
                                })
         return result
 
+    @classmethod
+    def _parse_source_references(cls, references):
+        """
+        Parse (source, version without epoch) tuples from 'dumpreferences' output.
+
+        >>> sorted(Reprepro._parse_source_references('''\\
+        ... buster-test-unstable|main|source pool/main/f/foo/foo_1.0-1.dsc
+        ... buster-test-unstable|main|source pool/main/f/foo/foo_1.0.orig.tar.gz
+        ... buster-test-unstable|main|amd64 pool/main/f/foo/foo_1.0-1_amd64.deb
+        ... buster-test-unstable-rollback0|main|source pool/main/f/foo/foo_0.9-1.dsc
+        ... '''))
+        [('foo', '0.9-1'), ('foo', '1.0-1')]
+        """
+        result = set()
+        for line in references.splitlines():
+            filekey = line.rpartition(" ")[2]
+            if filekey.endswith(".dsc"):
+                source, _sep, version = os.path.basename(filekey)[:-4].partition("_")
+                result.add((source, version))
+        return result
+
+    def source_versions(self):
+        """Get all source package versions (as (source, version without epoch) tuples) in this repository, with one call."""
+        return self._parse_source_references(self._call_locked(["dumpreferences"]))
+
     def migrate(self, package, src_distribution, dst_distribution, version=None):
-        return self._call_locked(["copysrc", dst_distribution, src_distribution, package] + ([version] if version else []), show_command=True)
+        return self._call_modifying(["copysrc", dst_distribution, src_distribution, package] + ([version] if version else []), dst_distribution)
 
     def remove(self, package, distribution, version=None):
-        return self._call_locked(["removesrc", distribution, package] + ([version] if version else []), show_command=True)
+        return self._call_modifying(["removesrc", distribution, package] + ([version] if version else []), distribution)
 
     def install(self, changes, distribution):
         return self._call_locked(["include", distribution, changes], show_command=True)
@@ -0,0 +1,191 @@
+"""
+API command schema for thin clients (like ``mini-buildd-tool``).
+
+The schema (see ``mini_buildd.api.get_schema()``) describes all API
+commands and their arguments as json. Clients fetch it once from the
+server (``/mini_buildd/api?output=json``), and keep it in a local
+cache; so they neither need to import ``mini_buildd.api`` nor django.
+
+A cached schema is dropped as soon as an API call response announces
+another fingerprint (see ``check()``). If the server does not provide
+a schema (mini-buildd < 1.9.x, or not reachable), the schema of the
+locally installed API is used; it's cached for that server as well
+(marked as fallback, so the server is asked again after
+``FALLBACK_TTL`` seconds).
+
+.. note:: Keep this module's imports light (client start-up time).
+"""
+
+import os
+import re
+import time
+import json
+import argparse
+import logging
+
+import mini_buildd
+
+LOG = logging.getLogger(__name__)
+
+# Increment on incompatible changes of the schema's format (see mini_buildd.api.get_schema())
+SCHEMA_VERSION = 1
+# HTTP header: Fingerprint of the server's schema (on all API call responses)
+SCHEMA_HEADER = "X-Mini-Buildd-Api-Schema"
+# Command 'auth' value for anonymous access
+AUTH_NONE = 0
+# Seconds to use the local API's schema for a server that did not provide one, before asking it again
+FALLBACK_TTL = 3600
+
+# Argument type -> additional argparse keyword arguments
+_ARGPARSE_TYPES = {"string": {"action": "store"},
+                   "url": {"action": "store"},
+                   "text": {"action": "store"},
+                   "int": {"action": "store", "type": int},
+                   "bool": {"action": "store_true"}}
+
+
+def get_cache_dir():
+    return os.path.join(os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "mini-buildd")
+
+
+def _cache_path(key):
+    """
+    Get cache file path for key (like an URL).
+
+    >>> os.path.basename(_cache_path("http://my.ho.st:8066"))
+    'api-schema-http___my.ho.st_8066.json'
+    """
+    return os.path.join(get_cache_dir(), "api-schema-{k}.json".format(k=re.sub(r"[^\w.-]", "_", key)))
+
+
+class Schema():
+    """
+    API command schema.
+
+    >>> s = Schema({"version": 1, "fingerprint": "0", "commands": [{"command": "list", "group": "Package commands.", "doc": "List packages.", "auth": 0, "confirm": False, "needs_running_daemon": False,
+    ...                                                              "arguments": [{"id_list": ["pattern"], "type": "select", "doc": "limit packages by name (glob pattern)", "default": None, "choices": []},
+    ...                                                                            {"id_list": ["--with-rollbacks", "-r"], "type": "bool", "doc": "also list rollbacks", "default": False, "choices": []}]}]})
+    >>> parser = argparse.ArgumentParser()
+    >>> s.add_parsers(parser.add_subparsers(dest="command"), func=None)
+    >>> args = parser.parse_args(["list", "-r", "mbd-*"])
+    >>> args.command, args.pattern, args.with_rollbacks, args.command_schema["auth"]
+    ('list', 'mbd-*', True, 0)
+    """
+
+    def __init__(self, document):
+        if document.get("version") != SCHEMA_VERSION:
+            raise Exception("API schema: Unsupported version {v} (we support {s})".format(v=document.get("version"), s=SCHEMA_VERSION))
+        self.document = document
+
+    @property
+    def fingerprint(self):
+        return self.document["fingerprint"]
+
+    @property
+    def commands(self):
+        return self.document["commands"]
+
+    @property
+    def fallback(self):
+        """Time stamp if this is the local API's schema cached for a server that did not provide one (else None)."""
+        return self.document.get("fallback")
+
+    def fallback_expired(self):
+        """
+        Check if this is an expired fallback.
+
+        >>> s = Schema({"version": 1, "fingerprint": "0", "commands": []})
+        >>> s.fallback_expired(), Schema(dict(s.document, fallback=time.time())).fallback_expired(), Schema(dict(s.document, fallback=0.0)).fallback_expired()
+        (False, False, True)
+        """
+        return self.fallback is not None and time.time() - self.fallback > FALLBACK_TTL
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{p}.{pid}".format(p=path, pid=os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self.document, f)
+        os.replace(tmp_path, path)
+
+    def add_parsers(self, subparsers, func):
+        """Add argparse subparsers for all commands (parsed args get 'func', 'command' and 'command_schema')."""
+        for command in self.commands:
+            cmd_parser = subparsers.add_parser(command["command"], help=command["doc"])
+            for argument in command["arguments"]:
+                kwargs = dict(_ARGPARSE_TYPES.get(argument["type"], {}), help=argument["doc"])
+                if argument["default"] is not None:
+                    kwargs["default"] = argument["default"]
+                if argument["choices"]:
+                    kwargs["choices"] = argument["choices"]
+                cmd_parser.add_argument(*argument["id_list"], **kwargs)
+
+            if command["confirm"]:
+                cmd_parser.add_argument("--confirm", action="store", default="", metavar="COMMAND",
+                                        help="this command needs user confirmation; this option allows to force-bypass that, by explicitly repeating the command")
+
+            cmd_parser.set_defaults(func=func, command=command["command"], command_schema=command)
+
+
+def _load_cached(key):
+    path = _cache_path(key)
+    try:
+        return Schema.load(path)
+    except FileNotFoundError:
+        return None
+    except BaseException as e:
+        LOG.info("Ignoring broken API schema cache {p}: {e}".format(p=path, e=e))
+        return None
+
+
+def _save_cached(key, schema):
+    try:
+        schema.save(_cache_path(key))
+    except BaseException as e:
+        LOG.info("Can't write API schema cache (ignoring): {e}".format(e=e))
+
+
+def get_local():
+    """Get schema of the locally installed API."""
+    key = "local-{v}".format(v=mini_buildd.__version__)
+    schema = _load_cached(key)
+    if schema is None:
+        import mini_buildd.api as mini_buildd_api  # Note: Import here: Only needed to (re-)generate the cache
+        schema = Schema(mini_buildd_api.get_schema())
+        _save_cached(key, schema)
+    return schema
+
+
+def get(url, opener=None, cached_only=False):
+    """Get schema of the server at url (like 'http://my.ho.st:8066'); falls back to the locally installed API's schema."""
+    schema = _load_cached(url)
+    if schema is not None and schema.fallback_expired() and not cached_only:
+        schema = None
+    if schema is None and not cached_only:
+        import urllib.request  # Note: Import here: Only needed to fetch
+        try:
+            with (opener or urllib.request.build_opener()).open("{u}/mini_buildd/api?output=json".format(u=url), timeout=30) as response:
+                schema = Schema(json.loads(response.read().decode("UTF-8")))
+            _save_cached(url, schema)
+            LOG.info("API schema fetched from {u}: {f}".format(u=url, f=schema.fingerprint))
+        except BaseException as e:
+            LOG.info("API schema not available from {u} (using local API's for {t} seconds): {e}".format(u=url, t=FALLBACK_TTL, e=e))
+            schema = Schema(dict(get_local().document, fallback=time.time()))
+            _save_cached(url, schema)
+    return schema or get_local()
+
+
+def check(url, headers):
+    """Drop the cached schema of the server at url if its fingerprint differs from the one announced in headers (of an API call response)."""
+    fingerprint = headers.get(SCHEMA_HEADER)
+    schema = _load_cached(url)
+    if fingerprint and schema is not None and schema.fingerprint != fingerprint:
+        LOG.info("API schema changed on {u}: Dropping cache.".format(u=url))
+        try:
+            os.remove(_cache_path(url))
+        except FileNotFoundError:
+            pass
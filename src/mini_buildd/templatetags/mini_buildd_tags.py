@@ -60,6 +60,7 @@ def mbd_api(context, cmd, name=None, title=None, output="html", **kwargs):
     api_cls = mini_buildd.api.COMMANDS_DICT.get(cmd, None)
     auth_err = api_cls.auth_err(context.get("user"))
     api_cmd = api_cls(_kwargs("value_"), daemon=mini_buildd.daemon.get())
+    api_cmd.update_choices()
 
     return {"api_cmd": api_cmd,
             "auth_err": auth_err,
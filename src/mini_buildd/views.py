@@ -1,14 +1,20 @@
 import os
+import re
+import time
 import pickle
 import logging
 
 import django.core.exceptions
 import django.http
+import django.utils.cache
+import django.utils.text
 import django.shortcuts
 import django.template
 import django.views.generic.base
 
 import mini_buildd.daemon
+import mini_buildd.httpd
+import mini_buildd.schema
 
 import mini_buildd.models.gnupg
 import mini_buildd.models.repository
@@ -135,18 +141,84 @@ def log(request, repository, package, version):
                                              ("Failed", get_logs(installed=False))]})
 
 
-LIVE_BUILDLOGS_404 = """\
-This live buildlog is not yet (or no longer) available.
+def _live_buildlog_read(buildlog, first, length):
+    with open(buildlog, "rb") as f:
+        f.seek(first)
+        while length > 0:
+            data = f.read(min(length, mini_buildd.httpd.LIVE_BUILDLOGS_CHUNK))
+            if not data:
+                break
+            length -= len(data)
+            yield data
 
-Please just retry later if this build is currently pending.
-"""
 
-
-def live_buildlogs(_request, logfile):
-    buildlog = os.path.join(mini_buildd.config.SPOOL_DIR, logfile)
-    if not os.path.exists(buildlog):
-        return django.http.HttpResponse(LIVE_BUILDLOGS_404, content_type="text/plain")
-    return django.http.FileResponse(open(buildlog, "rb"), content_type="text/plain")
+def _live_buildlog_follow(buildlog, logfile, offset, sse):
+    """Stream buildlog from offset as it grows (see ``mini_buildd.httpd.LiveBuildlogFollower``)."""
+    follower = mini_buildd.httpd.LiveBuildlogFollower(buildlog, logfile, offset, sse)
+    try:
+        while not follower.finished:
+            data = follower.read()
+            if data is None:
+                time.sleep(mini_buildd.httpd.LIVE_BUILDLOGS_POLL)
+            elif data:
+                yield data
+    finally:
+        follower.close()
+
+
+def live_buildlogs(request, logfile):
+    """
+    Live buildlog.
+
+    .. note:: The twisted HTTP server serves these natively (see ``mini_buildd.httpd_twisted.LiveBuildlogsResource``); this view is only used with other WSGI servers.
+
+    Supports (single) byte ranges via HTTP 'Range', and gzip transfer for non-range requests.
+
+    With ``?follow``, new data is streamed as the build goes on
+    (starting at ``?offset=N``). With ``?follow=sse`` (or
+    'Accept: text/event-stream'), the buildlog is streamed as
+    server-sent events, resumable via 'Last-Event-ID'.
+
+    Follow requests end after ``mini_buildd.httpd.LIVE_BUILDLOGS_FOLLOW_MAX`` seconds at
+    the latest (each occupies a web server thread); clients should
+    just resume from their last offset (EventSource does that
+    automatically), until an 'eof' event is received (sse) or the
+    build is no longer running.
+    """
+    buildlog = mini_buildd.httpd.live_buildlog_path(logfile)
+    if buildlog is None:
+        return django.http.HttpResponse(mini_buildd.httpd.LIVE_BUILDLOGS_404, content_type="text/plain")
+
+    sse = request.GET.get("follow") == "sse" or "text/event-stream" in request.META.get("HTTP_ACCEPT", "")
+    byte_range = None
+    if sse or "follow" in request.GET:
+        try:
+            offset = int(request.GET.get("offset", request.META.get("HTTP_LAST_EVENT_ID", 0)))
+        except ValueError:
+            return django.http.HttpResponseBadRequest("Invalid offset", content_type="text/plain")
+        response = django.http.StreamingHttpResponse(_live_buildlog_follow(buildlog, logfile, offset, sse), content_type="text/event-stream" if sse else "text/plain")
+        response["Cache-Control"] = "no-cache"
+    else:
+        size = os.path.getsize(buildlog)
+        try:
+            byte_range = mini_buildd.httpd.parse_range(request.META.get("HTTP_RANGE", ""), size)
+        except ValueError:
+            response = django.http.HttpResponse(status=416)
+            response["Content-Range"] = "bytes */{s}".format(s=size)
+            return response
+
+        first, last = byte_range if byte_range else (0, size - 1)
+        response = django.http.StreamingHttpResponse(_live_buildlog_read(buildlog, first, last - first + 1), content_type="text/plain", status=206 if byte_range else 200)
+        response["Accept-Ranges"] = "bytes"
+        if byte_range:
+            response["Content-Range"] = "bytes {f}-{l}/{s}".format(f=first, l=last, s=size)
+            response["Content-Length"] = last - first + 1
+
+    if not byte_range and re.search(r"\bgzip\b", request.META.get("HTTP_ACCEPT_ENCODING", "")):
+        response.streaming_content = django.utils.text.compress_sequence(response.streaming_content)
+        response["Content-Encoding"] = "gzip"
+    django.utils.cache.patch_vary_headers(response, ("Accept-Encoding",))
+    return response
 
 
 def api(request):  # pylint: disable=too-many-return-statements,too-many-branches
@@ -159,9 +231,14 @@ def api(request):  # pylint: disable=too-many-return-statements,too-many-branche
         if not request.GET:
             return django.shortcuts.render(request,
                                            "mini_buildd/api_index.html",
-                                           {"COMMANDS": mini_buildd.api.COMMANDS_DEFAULTS,
+                                           {"COMMANDS": mini_buildd.api.get_commands_defaults(),
                                             "COMMAND_GROUP": mini_buildd.api.COMMAND_GROUP})
 
+        # Command schema for thin clients (see mini_buildd.schema)
+        if "command" not in request.GET and request.GET.get("output") in mini_buildd.api.STRUCTURED_OUTPUTS:
+            return django.http.HttpResponse(mini_buildd.api.encode_schema(request.GET["output"]),
+                                            content_type=mini_buildd.api.STRUCTURED_OUTPUTS[request.GET["output"]])
+
         # Get API class from 'command' parameter
         command = request.GET.get("command", None)
         if command not in mini_buildd.api.COMMANDS_DICT:
@@ -192,6 +269,17 @@ def api(request):  # pylint: disable=too-many-return-statements,too-many-branche
                                                 "referer": _referer(request, output)})
             return error401_unauthorized(request, "API: '{c}': Needs to be confirmed".format(c=command))
 
+        # Conditional GET: Result unchanged since the client's last call (html output may differ per user, so skip that)
+        etag = None
+        if output != "html" and output[:7] != "referer":
+            etag = api_cmd.etag()
+        if etag:
+            etag = '"{e}-{o}"'.format(e=etag, o=output)
+            if etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+                response = django.http.HttpResponseNotModified()
+                response["ETag"] = etag
+                return response
+
         # Show api command name and user calling it.
         api_cmd.msglog.info("API call '{c}' by user '{u}'".format(c=command, u=request.user))
 
@@ -215,6 +303,10 @@ def api(request):  # pylint: disable=too-many-return-statements,too-many-branche
             response = django.http.HttpResponse(pickle.dumps(api_cmd, pickle.HIGHEST_PROTOCOL),
                                                 content_type="application/python-pickle")
 
+        elif output in mini_buildd.api.STRUCTURED_OUTPUTS:
+            response = django.http.HttpResponse(mini_buildd.api.encode(api_cmd, output),
+                                                content_type=mini_buildd.api.STRUCTURED_OUTPUTS[output])
+
         elif output[:7] == "referer":
             # Add all plain result lines as info messages on redirect
             for line in api_cmd.__str__().splitlines():
@@ -226,6 +318,12 @@ def api(request):  # pylint: disable=too-many-return-statements,too-many-branche
         # Add all user messages as as custom HTTP headers
         _add_api_messages(response, api_cmd)
 
+        if etag:
+            response["ETag"] = etag
+
+        # Let thin clients know when their cached command schema is outdated
+        response[mini_buildd.schema.SCHEMA_HEADER] = mini_buildd.api.get_schema()["fingerprint"]
+
         return response
 
     except BaseException as e: